@@ -0,0 +1,69 @@
+"""
+Compare the pattern interpreter with the code generation backend.
+
+    PYTHONPATH=. python benchmarks/bench_codegen.py
+
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+from collections import namedtuple
+
+from pyfpm.matcher import Matcher
+from pyfpm.codegen import compile_matcher, NATIVE_MATCH
+
+Add = namedtuple('Add', 'left right')
+Mul = namedtuple('Mul', 'left right')
+Neg = namedtuple('Neg', 'operand')
+
+m = Matcher()
+
+@m.handler('Add(0, x) | Add(x, 0)')
+def add_zero(x):
+    return x
+
+@m.handler('Mul(1, x) | Mul(x, 1)')
+def mul_one(x):
+    return x
+
+@m.handler('Neg(Neg(x))')
+def double_neg(x):
+    return x
+
+@m.handler('[op:str, a, b] if op in ("+", "*")')
+def prefix(op, a, b):
+    return (op, a, b)
+
+@m.handler('head :: tail')
+def sequence(head, tail):
+    return head
+
+@m.handler('x')
+def other(x):
+    return x
+
+SUBJECTS = [
+    Add(0, 1), Mul(Neg(Neg(2)), 1), ['+', 1, 2], ['-', 1, 2], (1, 2, 3),
+    'abc', 42,
+]
+
+def run(f):
+    for subject in SUBJECTS:
+        f(subject)
+
+def main(number=20000):
+    interpreted = timeit.timeit(lambda: run(m), number=number)
+    print('interpreter: %.3fs' % interpreted)
+    if not NATIVE_MATCH:
+        print('native match statement not available on %s' %
+                sys.version.split()[0])
+        return
+    compiled = compile_matcher(m)
+    assert [compiled(s) for s in SUBJECTS] == [m(s) for s in SUBJECTS]
+    native = timeit.timeit(lambda: run(compiled), number=number)
+    print('compiled:    %.3fs (%.1fx), native cases %s of %d' % (native,
+        interpreted / native, compiled.native, len(m.bindings)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Compare the memory used by a large routing matcher, and the time garbage
+collection passes take while it's alive, as pattern objects and in compact
+form.
+
+    PYTHONPATH=. python benchmarks/bench_compact.py
+
+"""
+from __future__ import print_function
+
+import gc
+import timeit
+import tracemalloc
+
+from pyfpm.matcher import Matcher
+from pyfpm.pattern import build as _
+
+CASES = 10000
+
+def routes():
+    m = Matcher()
+    for i in range(CASES):
+        m.register(_({
+            'method': _('GET') | _('HEAD'),
+            'route': i,
+            'path': _('users', _(int)%'user', 'items'),
+            'query': _(dict)%'query',
+            }), lambda user, query, i=i: (i, user))
+    m.register(_()%'request', lambda request: None)
+    return m
+
+REQUESTS = [
+    {'method': 'GET', 'route': CASES // 2, 'path': ('users', 7, 'items'),
+        'query': {}},
+    {'method': 'POST', 'route': 1, 'path': ('users', 7, 'items'),
+        'query': {}},
+    {'method': 'HEAD', 'route': CASES - 1, 'path': ('users', 1, 'items'),
+        'query': {'a': 1}},
+]
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    obj = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    pause = min(timeit.repeat(gc.collect, number=1, repeat=5))
+    return obj, size, pause
+
+def dispatch_time(f):
+    [f(r) for r in REQUESTS]
+    return timeit.timeit(lambda: [f(r) for r in REQUESTS], number=200)
+
+def main():
+    matcher, matcher_size, matcher_pause = measure(routes)
+    print('pattern objects: %6.0f bytes/case, gc pass %5.1fms, dispatch '
+            '%.3fs' % (matcher_size / float(CASES), matcher_pause * 1000,
+                dispatch_time(matcher)))
+    expected = [matcher(r) for r in REQUESTS]
+    matcher = None
+    compact, compact_size, compact_pause = measure(
+            lambda: routes().compact())
+    assert [compact(r) for r in REQUESTS] == expected
+    print('compact:         %6.0f bytes/case, gc pass %5.1fms, dispatch '
+            '%.3fs' % (compact_size / float(CASES), compact_pause * 1000,
+                dispatch_time(compact)))
+    print('memory %.1fx smaller, gc pass %.1fx faster' % (
+        matcher_size / float(compact_size), matcher_pause / compact_pause))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Compare simplifying large expression trees with repeated subtrees by
+recursively applying a matcher until a fixpoint, and with a memoized
+rewriter.
+
+    PYTHONPATH=. python benchmarks/bench_rewrite.py
+
+"""
+from __future__ import print_function
+
+import random
+import sys
+import timeit
+from collections import namedtuple
+
+from pyfpm.matcher import Matcher
+from pyfpm.rewrite import Rewriter
+
+Add = namedtuple('Add', 'left right')
+Mul = namedtuple('Mul', 'left right')
+
+RULES = [
+    ('Add(0, x) | Add(x, 0)', lambda x: x),
+    ('Mul(1, x) | Mul(x, 1)', lambda x: x),
+    ('Mul(0, _) | Mul(_, 0)', lambda: 0),
+    ('Add(x:int, y:int)', lambda x, y: x + y),
+    ('Mul(x:int, y:int)', lambda x, y: x * y),
+]
+
+DEPTH = 14
+# distinct subtrees per level; the rest are rebuilt copies of them
+VARIETY = 8
+
+def expression(depth, rng, pool):
+    """A random expression tree, built from fresh copies of a few subtrees
+    per level, so it's large but has few distinct subterms."""
+    if depth == 0:
+        return rng.choice([0, 1, 2, 'a', 'b'])
+    level = pool.setdefault(depth, [])
+    if len(level) < VARIETY:
+        level.append((rng.choice([Add, Mul]), rng.randrange(1 << 30)))
+    cls, seed = rng.choice(level)
+    child_rng = random.Random(seed)
+    return cls(expression(depth - 1, child_rng, pool),
+            expression(depth - 1, child_rng, pool))
+
+def naive_simplifier():
+    m = Matcher(RULES + [('_', lambda: None)])
+    def simplify(term):
+        if isinstance(term, tuple):
+            term = term.__class__(*[simplify(child) for child in term])
+        while True:
+            replaced = m(term)
+            if replaced is None or replaced == term:
+                return term
+            term = simplify(replaced)
+    return simplify
+
+def main():
+    sys.setrecursionlimit(10000)
+    pool = {}
+    terms = [expression(DEPTH, random.Random(i), pool) for i in range(4)]
+    naive = naive_simplifier()
+    expected = [naive(t) for t in terms]
+    naive_time = timeit.timeit(lambda: [naive(t) for t in terms], number=1)
+    print('recursive fixpoint: %.3fs' % naive_time)
+    rewriter = Rewriter(RULES)
+    assert [rewriter(t) for t in terms] == expected
+    rewriter_time = min(timeit.repeat(
+        lambda: [Rewriter(RULES)(t) for t in terms], number=1, repeat=3))
+    print('memoized rewriter:  %.3fs' % rewriter_time)
+    print('%.1fx faster' % (naive_time / rewriter_time))
+
+if __name__ == '__main__':
+    main()
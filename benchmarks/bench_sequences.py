@@ -0,0 +1,66 @@
+"""
+Time building sequence patterns of up to 100k elements and matching them
+against sequences of that length, compared with a recursive matcher that
+slices off the tail at each element, as list patterns used to.
+
+    PYTHONPATH=. python benchmarks/bench_sequences.py
+
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+
+from pyfpm.pattern import Match, ListPattern, build
+
+SIZES = (1000, 10000, 100000)
+# the largest size the recursive matcher gets to run on
+RECURSIVE_LIMIT = 10000
+
+class RecursiveListPattern(ListPattern):
+    def _does_match(self, other, ctx):
+        try:
+            if self.head_pattern is None and len(other) == 0:
+                return Match(ctx)
+            head, tail = other[0], other[1:]
+        except (IndexError, TypeError):
+            return None
+        if self.head_pattern is None:
+            return None
+        match = self.head_pattern.match(head, ctx)
+        if not match:
+            return None
+        match = self.tail_pattern.match(tail, match.ctx)
+        if not match:
+            return None
+        return Match(match.ctx)
+
+def recursive(size):
+    pattern = RecursiveListPattern()
+    for i in range(size):
+        pattern = RecursiveListPattern(build(int), pattern)
+    return pattern
+
+def best(function):
+    return min(timeit.repeat(function, number=1, repeat=3))
+
+def main():
+    sys.setrecursionlimit(10 * RECURSIVE_LIMIT)
+    for size in SIZES:
+        items = list(range(size))
+        build_time = best(lambda: build(*[int] * size))
+        pattern = build(*[int] * size)
+        assert pattern.match(items) and not pattern.match(items + [0])
+        match_time = best(lambda: pattern.match(items))
+        line = '%6d items: build %7.1fms, match %7.1fms' % (size,
+                build_time * 1000, match_time * 1000)
+        if size <= RECURSIVE_LIMIT:
+            old = recursive(size)
+            assert old.match(items)
+            old_time = best(lambda: old.match(items))
+            line += ' (recursive %7.1fms, %.1fx slower)' % (old_time * 1000,
+                    old_time / match_time)
+        print(line)
+
+if __name__ == '__main__':
+    main()
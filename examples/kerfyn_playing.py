@@ -69,6 +69,19 @@ length = Matcher([
 for x in range(10):
     print(length([None]*x))
 
+# Tail-recursive versions run in constant stack depth
+print('-'*80)
+factTail = Matcher([
+        ('0', lambda acc: acc),
+        ('n:int', lambda acc, n: factTail.tailcall(n - 1, acc * n)),
+        ])
+print(factTail(1000, 1) > 0)
+lengthTail = Matcher([
+        ('_ :: tail', lambda acc, tail: lengthTail.tailcall(tail, acc + 1)),
+        ('[]', lambda acc: acc)
+        ])
+print(lengthTail([None]*5000, 0))
+
 print('-'*80)
 def setLanguageTo(lang):
     print('language set to:', lang)
@@ -4,3 +4,21 @@ __version__ = '0.1.3-dev'
 __author__ = 'Martin Blech'
 __copyright__ = '2012, ' + __author__
 __license__ = 'MIT'
+
+def search(pattern, obj):
+    """
+    Find every subobject of a nested structure that matches a pattern. See
+    :func:`pyfpm.traversal.search`.
+
+    """
+    from pyfpm.traversal import _search
+    return _search(pattern, obj)
+
+def findall(patterns, obj):
+    """
+    Find every subobject of a nested structure that matches any of several
+    patterns, in a single traversal. See :func:`pyfpm.traversal.findall`.
+
+    """
+    from pyfpm.traversal import _findall
+    return _findall(patterns, obj)
@@ -0,0 +1,105 @@
+"""
+asyncio support for :class:`pyfpm.matcher.Matcher`.
+
+Patterns are always evaluated synchronously, right when an object is
+dispatched; only the handlers' awaitables get scheduled on the event loop.
+Handlers may be regular functions or coroutine functions:
+
+    >>> import asyncio
+    >>> from pyfpm.matcher import Matcher
+    >>> m = Matcher()
+    >>> @m.handler('x:int')
+    ... async def double(x):
+    ...     await asyncio.sleep(0)
+    ...     return x * 2
+    >>> @m.handler('x')
+    ... def same(x):
+    ...     return x
+    >>> asyncio.run(m.amatch(21))
+    42
+    >>> asyncio.run(m.amatch('abc'))
+    'abc'
+
+Whole streams can be dispatched with bounded concurrency:
+
+    >>> async def collect():
+    ...     return [r async for r in m.adispatch([1, 'a', 2], concurrency=2)]
+    >>> asyncio.run(collect())
+    [2, 'a', 4]
+
+.. note:: this module requires Python 3.6 or later.
+
+"""
+import asyncio
+import collections
+import inspect
+
+from pyfpm.matcher import TailCall
+
+async def amatch(matcher, obj, *args):
+    """
+    Match `obj` with `matcher` and await the handler's result if it's
+    awaitable. Async handlers may return a :class:`pyfpm.matcher.TailCall`
+    too. See :func:`pyfpm.matcher.Matcher.amatch`.
+
+    """
+    return await _settle(matcher.match(obj, *args))
+
+async def _settle(result):
+    """Await `result` while it's awaitable, following the tail calls the
+    awaited handlers return."""
+    while inspect.isawaitable(result):
+        result = await result
+        if result.__class__ is TailCall:
+            result = result.matcher.match(result.obj, *result.args)
+    return result
+
+def _resolved(result=None, exception=None):
+    future = asyncio.get_event_loop().create_future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+def _schedule(matcher, obj, args):
+    try:
+        result = matcher.match(obj, *args)
+    except Exception as e:
+        return _resolved(exception=e)
+    if inspect.isawaitable(result):
+        return asyncio.ensure_future(_settle(result))
+    return _resolved(result)
+
+async def _aiter(iterable):
+    if hasattr(iterable, '__aiter__'):
+        async for obj in iterable:
+            yield obj
+    else:
+        for obj in iterable:
+            yield obj
+
+async def adispatch(matcher, iterable, *args, concurrency=1):
+    """
+    Dispatch every object in `iterable` with `matcher`, yielding the results
+    in input order. See :func:`pyfpm.matcher.Matcher.adispatch`.
+
+    Errors (including :class:`pyfpm.matcher.NoMatch`) are raised when the
+    result for the offending object is reached, and any handlers still in
+    flight are cancelled.
+
+    """
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1')
+    pending = collections.deque()
+    try:
+        async for obj in _aiter(iterable):
+            pending.append(_schedule(matcher, obj, args))
+            while (len(pending) >= concurrency or
+                    (pending and pending[0].done())):
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
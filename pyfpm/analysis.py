@@ -0,0 +1,298 @@
+"""
+Static analysis of pattern trees.
+
+This module can tell, without matching any object, whether a pattern is
+subsumed by another one (i.e. every object the latter matches is also
+matched by the former). :class:`pyfpm.matcher.Matcher` uses it to find cases
+that can never fire because an earlier case shadows them:
+
+    >>> from pyfpm.matcher import Matcher
+    >>> m = Matcher([
+    ...     ('_:str', lambda: 'a string'),
+    ...     ('"one"', lambda: 'one'),
+    ...     ('x', lambda x: x),
+    ...     ('[]', lambda: 'empty'),
+    ...     ])
+    >>> unreachable_cases(m.bindings)
+    [(1, 0), (3, 2)]
+
+A constant after a case for its type, like `1` after `_:int`, still matches
+equal objects of other types, such as `1.0`: it's only reported with `loose`
+(see :func:`subsumes`), and analyzing matchers warn about it but never prune
+it.
+
+The analysis is conservative: patterns with conditions, or that bind the same
+name more than once, are never considered to subsume anything, since whether
+they match depends on more than the object's shape.
+
+"""
+import warnings
+
+from pyfpm.pattern import (_basestring, _Mapping, _positional_attributes,
+        AnyPattern, EqualsPattern, InstanceOfPattern,
+        RegexPattern, ListPattern, NamedTuplePattern, MappingPattern,
+        ClassPattern, OrPattern, StructPattern)
+
+class UnreachableCaseWarning(UserWarning):
+    """
+    Issued by analyzing matchers when a newly registered case can never be
+    reached because an earlier case matches everything it matches.
+
+    """
+
+def _walk(pattern):
+    stack = [pattern]
+    while stack:
+        pattern = stack.pop()
+        yield pattern
+        stack.extend(reversed(pattern.children()))
+
+def is_unconditional(pattern):
+    """
+    Whether matching `pattern` depends only on the shape of the object, i.e.
+    it has no conditions and binds no name more than once.
+
+    """
+    names = set()
+    for node in _walk(pattern):
+        if node.condition is not None:
+            return False
+        if node.bound_name is not None:
+            if node.bound_name in names:
+                return False
+            names.add(node.bound_name)
+    return True
+
+def subsumes(general, specific, loose=False):
+    """
+    Whether every object matched by `specific` is also matched by `general`.
+    A `False` answer means "not provably", as the analysis is conservative.
+
+        >>> from pyfpm.pattern import build as _
+        >>> subsumes(_(str), _('a'))
+        True
+        >>> subsumes(_(_(), _()), _(1, str))
+        True
+        >>> subsumes(_(1), _(int))
+        False
+
+    Constants match every object equal to them, which may be of other types
+    (`1` matches `1.0` too), so a type only covers the constants of the few
+    types whose instances compare equal to nothing else. With `loose`, it
+    covers every constant that is one of its instances:
+
+        >>> subsumes(_(int), _(1))
+        False
+        >>> subsumes(_(int), _(1), loose=True)
+        True
+
+    """
+    return is_unconditional(general) and _covers(general, specific, loose)
+
+def _same_constant(a, b):
+    return a.__class__ is b.__class__ and a == b
+
+# types whose instances compare equal only to instances of the same type
+_CLOSED_EQUALITY = (type(None),) if str is bytes else (type(None), str)
+
+def _classes(cls):
+    """The classes an :class:`InstanceOfPattern` accepts instances of."""
+    return cls if isinstance(cls, tuple) else (cls,)
+
+def _subclasses(classes, cls):
+    """Whether every class in `classes` (a class or a tuple of them) is a
+    subclass of `cls`."""
+    return all(issubclass(c, cls) for c in _classes(classes))
+
+def _covers_type(cls, pattern, loose=False):
+    """Whether every object matched by `pattern` is an instance of `cls`."""
+    if cls is object:
+        return True
+    if isinstance(pattern, OrPattern):
+        return all(_covers_type(cls, p, loose) for p in pattern.patterns)
+    if isinstance(pattern, EqualsPattern):
+        return isinstance(pattern.obj, cls) and (loose or
+                pattern.obj.__class__ in _CLOSED_EQUALITY)
+    if isinstance(pattern, InstanceOfPattern):
+        return _subclasses(pattern.cls, cls)
+    if isinstance(pattern, NamedTuplePattern):
+        return issubclass(pattern.casecls, cls)
+    if isinstance(pattern, ClassPattern):
+        return issubclass(pattern.cls, cls)
+    if isinstance(pattern, MappingPattern):
+        return issubclass(_Mapping, cls)
+    return False
+
+def _covers_all_fields(general, cls):
+    """Whether a NamedTuplePattern matches every instance of `cls`."""
+    if general.field_patterns is None:
+        return True
+    if any(not isinstance(p, AnyPattern) for p in general.children()):
+        return False
+    arity = len(getattr(cls, '_fields', ()))
+    if general.rest_pattern is None:
+        return len(general.field_patterns) == arity
+    return len(general.field_patterns) <= arity
+
+def _covers_attributes(general, cls):
+    """Whether a ClassPattern matches every instance of `cls`."""
+    if general.self_pattern is not None:
+        return False
+    declared = _positional_attributes(cls)
+    return all(isinstance(p, AnyPattern) and name in declared
+            for (name, p) in general.attributes)
+
+def _covers(general, specific, loose=False):
+    if isinstance(specific, OrPattern):
+        return all(_covers(general, p, loose) for p in specific.patterns)
+    if isinstance(general, AnyPattern):
+        return True
+    if isinstance(general, OrPattern):
+        return any(_covers(p, specific, loose) for p in general.patterns)
+    if isinstance(general, EqualsPattern):
+        return (isinstance(specific, EqualsPattern) and
+                _same_constant(general.obj, specific.obj))
+    if isinstance(general, InstanceOfPattern):
+        return _covers_type(general.cls, specific, loose)
+    if isinstance(general, RegexPattern):
+        if isinstance(specific, RegexPattern):
+            return (general.regex.pattern == specific.regex.pattern and
+                    general.regex.flags == specific.regex.flags)
+        if (isinstance(specific, EqualsPattern) and
+                isinstance(specific.obj, _basestring)):
+            return bool(general.regex.match(specific.obj))
+        return False
+    if isinstance(general, ListPattern):
+        # the chain of tails is walked in a loop, so that long sequence
+        # patterns don't hit the recursion limit
+        while True:
+            # binary heads span several items, so both must split alike
+            if specific.__class__ is not general.__class__:
+                return False
+            if general.head_pattern is None or specific.head_pattern is None:
+                return general.head_pattern is specific.head_pattern is None
+            if not _covers(general.head_pattern, specific.head_pattern,
+                    loose):
+                return False
+            general, specific = general.tail_pattern, specific.tail_pattern
+            if (not isinstance(general, ListPattern) or
+                    isinstance(specific, OrPattern)):
+                return _covers(general, specific, loose)
+    if isinstance(general, NamedTuplePattern):
+        if isinstance(specific, InstanceOfPattern):
+            return all(issubclass(cls, general.casecls) and
+                    _covers_all_fields(general, cls)
+                    for cls in _classes(specific.cls))
+        if (not isinstance(specific, NamedTuplePattern) or
+                not issubclass(specific.casecls, general.casecls)):
+            return False
+        if general.field_patterns is None:
+            return True
+        if specific.field_patterns is None:
+            return _covers_all_fields(general, specific.casecls)
+        if (len(general.field_patterns) != len(specific.field_patterns) or
+                specific.rest_pattern is not None or
+                general.rest_pattern is not None):
+            return False
+        return all(_covers(g, s, loose) for (g, s) in
+                zip(general.field_patterns, specific.field_patterns))
+    if isinstance(general, ClassPattern):
+        if isinstance(specific, (InstanceOfPattern, NamedTuplePattern,
+                ClassPattern)):
+            classes = _classes(getattr(specific, 'cls', None) or
+                    specific.casecls)
+            if not _subclasses(classes, general.cls):
+                return False
+            if all(_covers_attributes(general, cls) for cls in classes):
+                return True
+        if not isinstance(specific, ClassPattern):
+            return False
+        if general.self_pattern is not None and (
+                specific.self_pattern is None or
+                not _covers(general.self_pattern, specific.self_pattern,
+                    loose)):
+            return False
+        attributes = dict(specific.attributes)
+        return all(name in attributes and _covers(p, attributes[name], loose)
+                for (name, p) in general.attributes)
+    if isinstance(general, StructPattern):
+        return (isinstance(specific, StructPattern) and
+                general._struct.format == specific._struct.format)
+    if isinstance(general, MappingPattern):
+        if not isinstance(specific, MappingPattern):
+            return False
+        return all(key in specific.mapping and
+                _covers(p, specific.mapping[key], loose)
+                for (key, p) in general.mapping.items())
+    return False
+
+def unreachable_cases(bindings, loose=False):
+    """
+    Find the cases in a list of pattern-handler pairs that can never be
+    reached.
+
+    :param loose: bool -- also report the cases that can only be reached by
+        objects equal to a constant but of another type (see
+        :func:`subsumes`)
+    :returns: a list of `(unreachable_position, shadowing_position)` pairs
+    """
+    unreachable = []
+    reachable = []
+    for position, (pattern, handler) in enumerate(bindings):
+        for earlier in reachable:
+            if subsumes(bindings[earlier][0], pattern, loose):
+                unreachable.append((position, earlier))
+                break
+        else:
+            reachable.append(position)
+    return unreachable
+
+def _leaf_classes(base):
+    seen = set()
+    stack = [base]
+    leaves = []
+    while stack:
+        cls = stack.pop()
+        if cls in seen:
+            continue
+        seen.add(cls)
+        subclasses = cls.__subclasses__()
+        if subclasses:
+            stack.extend(reversed(subclasses))
+        else:
+            leaves.append(cls)
+    return leaves
+
+def missing_cases(bindings, base):
+    """
+    Exhaustiveness check for a closed class hierarchy: find the concrete
+    (leaf) subclasses of `base` whose instances aren't all matched by some
+    unconditional case. It may report classes that a combination of several
+    cases actually covers.
+
+        >>> from collections import namedtuple
+        >>> from pyfpm.pattern import build as _
+        >>> class Shape(object): pass
+        >>> class Circle(Shape): pass
+        >>> class Square(Shape): pass
+        >>> missing_cases([(_(Circle), None)], Shape) == [Square]
+        True
+
+    :param bindings: a list of pattern-handler pairs, such as
+        :attr:`pyfpm.matcher.Matcher.bindings`
+    :param base: the root of the class hierarchy
+
+    """
+    patterns = [pattern for (pattern, handler) in bindings
+            if is_unconditional(pattern)]
+    return [cls for cls in _leaf_classes(base)
+            if not any(_covers(p, InstanceOfPattern(cls)) for p in patterns)]
+
+def warn_unreachable(position, shadowing_position, pattern, shadowing_pattern,
+        stacklevel=2, loose=False):
+    warnings.warn('case %d (%s) is unreachable%s: case %d (%s) matches '
+            'everything %sit matches' % (position, pattern,
+                ' by all but equal objects of other types' if loose else '',
+                shadowing_position, shadowing_pattern,
+                'else ' if loose else ''), UnreachableCaseWarning,
+            stacklevel=stacklevel + 1)
@@ -0,0 +1,314 @@
+"""
+Code generation backend for :class:`pyfpm.matcher.Matcher`.
+
+On Python 3.10 and later, :func:`compile_matcher` translates a matcher's
+cases into the source of a single function built around a native `match`
+statement, so that CPython's own bytecode does the sequence, class and mapping
+matching:
+
+    >>> from pyfpm.matcher import Matcher
+    >>> m = Matcher([
+    ...     ("['-h'|'--help', None]", lambda: 'help'),
+    ...     ("['-o'|'--optim', level:int] if 1<=level<=5",
+    ...         lambda level: 'level %d' % level),
+    ...     ('head :: tail', lambda head, tail: (head, tail)),
+    ...     ('x', lambda x: x),
+    ...     ])
+    >>> f = compile_matcher(m)
+    >>> f(('-o', 3))
+    'level 3'
+    >>> f(('-o', 7))
+    ('-o', (7,))
+    >>> f('abc')
+    'abc'
+
+Cases that use constructs the `match` statement can't express (regular
+expressions, alternatives that bind different names, conditions inside
+alternatives, open-tailed named tuples...) are still matched by the pattern
+interpreter, in their original order. The generated source can be inspected:
+
+    >>> print(f.source)
+    def _dispatch(_subject, *_args):
+        match _subject:
+            case [(_k.c0 | _k.c1), _k.c2]:
+                return _h0(*_args)
+            case [(_k.c3 | _k.c4), (_k.t0() as level)] if _k.g0(level=level):
+                return _h1(*_args, level=level)
+            case ([head, *_] as _s0):
+                return _h2(*_args, head=head, tail=_s0[1:])
+            case x:
+                return _h3(*_args, x=x)
+    <BLANKLINE>
+
+.. note:: the translated sequence patterns follow the `match` statement's
+    rules, so unlike :class:`pyfpm.pattern.ListPattern` they only match
+    :class:`collections.abc.Sequence` instances other than `str`, `bytes` and
+    `bytearray`.
+
+"""
+import keyword
+import sys
+
+from pyfpm.matcher import NoMatch, TailCall, _call_plan, _wrong_arity
+from pyfpm.pattern import (AnyPattern, EqualsPattern, InstanceOfPattern,
+        ListPattern, NamedTuplePattern, MappingPattern, ClassPattern,
+        OrPattern)
+
+NATIVE_MATCH = sys.version_info >= (3, 10)
+
+class _Unsupported(Exception):
+    pass
+
+class _Constants(object):
+    """Namespace for the constants referenced as value patterns."""
+
+def _irrefutable(source):
+    return source == '_' or source.isidentifier()
+
+class _Case(object):
+    """Translation of a single pattern into `match` statement syntax."""
+    def __init__(self, translator, bindings=None, order=()):
+        self.translator = translator
+        # name -> python expression that evaluates to its value
+        self.bindings = dict(bindings or {})
+        self.order = list(order)
+        self.guards = []
+
+    def bind(self, name, expression):
+        if name in self.bindings:
+            # names bound twice must be bound to equal values
+            self.guards.append('not (%s != %s)' % (self.bindings[name],
+                expression))
+        else:
+            self.bindings[name] = expression
+            self.order.append(name)
+
+    def variable(self, name):
+        """The capture variable for `name`: the name itself the first time
+        it's bound, a fresh helper name otherwise."""
+        if name in self.bindings or keyword.iskeyword(name):
+            return self.translator.fresh('_v')
+        return name
+
+    def translate(self, pattern):
+        if pattern.__class__ is ListPattern:
+            source = self.translate_list(pattern)
+        elif pattern.__class__ is OrPattern:
+            source = self.translate_or(pattern)
+        else:
+            source = self.translate_node(pattern)
+        if pattern.bound_name is not None:
+            variable = self.variable(pattern.bound_name)
+            if source == '_':
+                source = variable
+            else:
+                source = '(%s as %s)' % (source, variable)
+            self.bind(pattern.bound_name, variable)
+        if pattern.condition is not None:
+            name = self.translator.constant(pattern.condition, 'g')
+            self.guards.append('%s(%s)' % (name, ', '.join('%s=%s' % (
+                n, self.bindings[n]) for n in self.order)))
+        return source
+
+    def translate_node(self, pattern):
+        constant = self.translator.constant
+        cls = pattern.__class__
+        if cls is AnyPattern:
+            return '_'
+        if cls is EqualsPattern:
+            return constant(pattern.obj, 'c')
+        if cls is InstanceOfPattern:
+            return '%s()' % constant(pattern.cls, 't')
+        if cls is NamedTuplePattern:
+            if pattern.rest_pattern is not None:
+                raise _Unsupported('open-tailed named tuple pattern')
+            if pattern.field_patterns is None:
+                return '%s()' % constant(pattern.casecls, 't')
+            if (len(pattern.field_patterns) !=
+                    len(getattr(pattern.casecls, '_fields', ()))):
+                raise _Unsupported('named tuple arity mismatch')
+            return '%s(%s)' % (constant(pattern.casecls, 't'),
+                    ', '.join(map(self.translate, pattern.field_patterns)))
+        if cls is ClassPattern:
+            arguments = []
+            if pattern.self_pattern is not None:
+                arguments.append(self.translate(pattern.self_pattern))
+            arguments.extend('%s=%s' % (name, self.translate(p))
+                    for (name, p) in pattern.attributes)
+            return '%s(%s)' % (constant(pattern.cls, 't'),
+                    ', '.join(arguments))
+        if cls is MappingPattern:
+            return '{%s}' % ', '.join('%s: %s' % (constant(key, 'c'),
+                self.translate(p)) for (key, p) in pattern.mapping.items())
+        raise _Unsupported('%s has no native equivalent' % cls.__name__)
+
+    def translate_or(self, pattern):
+        alternatives = []
+        names = None
+        for alternative in pattern.patterns:
+            case = _Case(self.translator, self.bindings, self.order)
+            source = case.translate(alternative)
+            new = case.order[len(self.order):]
+            # every alternative must capture the same plain names
+            if (case.guards or ' as _' in source or
+                    any(case.bindings[name] != name for name in new)):
+                raise _Unsupported('alternative needs helpers or guards')
+            if names is None:
+                names = new
+            elif set(new) != set(names):
+                raise _Unsupported('alternatives bind different names')
+            alternatives.append(source)
+            if _irrefutable(source):
+                # the remaining alternatives can never be tried
+                break
+        for name in names:
+            self.bind(name, name)
+        return '(%s)' % ' | '.join(alternatives)
+
+    def translate_list(self, pattern):
+        plain = lambda node: (node is pattern or (node.bound_name is None and
+            node.condition is None))
+        heads = []
+        node = pattern
+        while (node.__class__ is ListPattern and
+                node.head_pattern is not None and plain(node)):
+            heads.append(node.head_pattern)
+            node = node.tail_pattern
+        items = list(map(self.translate, heads))
+        if (node.__class__ is ListPattern and node.head_pattern is None and
+                plain(node)):
+            return '[%s]' % ', '.join(items)
+        if node.__class__ is not AnyPattern or node.condition is not None:
+            raise _Unsupported('sequence tail pattern')
+        if node.bound_name is None:
+            return '[%s]' % ', '.join(items + ['*_'])
+        helper = self.translator.fresh('_s')
+        self.bind(node.bound_name, '%s[%d:]' % (helper, len(heads)))
+        return '([%s] as %s)' % (', '.join(items + ['*_']), helper)
+
+class _Translator(object):
+    def __init__(self):
+        self.namespace = {'NoMatch': NoMatch}
+        self.constants = _Constants()
+        self.namespace['_k'] = self.constants
+        self.counters = {}
+
+    def fresh(self, prefix):
+        number = self.counters.get(prefix, 0)
+        self.counters[prefix] = number + 1
+        return '%s%d' % (prefix, number)
+
+    def constant(self, value, prefix):
+        name = self.fresh(prefix)
+        setattr(self.constants, name, value)
+        return '_k.%s' % name
+
+    def case(self, position, pattern, plan):
+        """Source lines for one case, falling back to the interpreter, and
+        whether the case matches everything. The handler gets called as
+        `plan` says (see :func:`pyfpm.matcher._call_plan`)."""
+        handler = '_h%d' % position
+        try:
+            if not NATIVE_MATCH:
+                raise _Unsupported('no native match statement')
+            case = _Case(self)
+            source = case.translate(pattern)
+        except _Unsupported:
+            self.namespace['_p%d' % position] = pattern
+            self.namespace['_c%d' % position] = plan
+            return ['        case _ if (_m := _p%d.match(_subject)):' % (
+                position), '            return _c%d.call(%s, _args, _m.ctx)'
+                % (position, handler)], False
+        guard = ''
+        if case.guards:
+            guard = ' if %s' % ' and '.join(case.guards)
+        if plan.exact and plan.names is not None:
+            arguments = [case.bindings[name] for name in plan.names]
+        else:
+            arguments = ['%s=%s' % (name, case.bindings[name])
+                    for name in case.order
+                    if plan.keywords is None or name in plan.keywords]
+        call = ', '.join(['*_args'] + arguments)
+        return ['        case %s%s:' % (source, guard),
+                '            return %s(%s)' % (handler, call)
+                ], not guard and _irrefutable(source)
+
+def generate(bindings, plans=None):
+    """
+    Generate the source of a dispatch function for a list of pattern-handler
+    pairs.
+
+    :param plans: how each handler gets called (see
+        :func:`pyfpm.matcher._call_plan`), by default worked out from its
+        signature
+    :returns: a `(source, namespace, native)` tuple, where `namespace` holds
+        the objects the source refers to and `native` is the list of the
+        positions of the cases translated to native patterns.
+
+    """
+    translator = _Translator()
+    lines = ['def _dispatch(_subject, *_args):',
+            '    match _subject:']
+    native = []
+    if plans is None:
+        plans = [_call_plan(pattern, handler)
+                for (pattern, handler) in bindings]
+    for position, (pattern, handler) in enumerate(bindings):
+        translator.namespace['_h%d' % position] = handler
+        case_lines, irrefutable = translator.case(position, pattern,
+                plans[position])
+        if '_p%d' % position not in translator.namespace:
+            native.append(position)
+        lines.extend(case_lines)
+        if irrefutable:
+            # the `match` statement rejects cases after a catch-all one
+            return '\n'.join(lines) + '\n', translator.namespace, native
+    lines.append('    raise NoMatch(obj=_subject)')
+    return '\n'.join(lines) + '\n', translator.namespace, native
+
+class CompiledMatcher(object):
+    """
+    Callable returned by :func:`compile_matcher`. Calling it behaves like
+    calling the original matcher, tail calls included.
+
+    :ivar source: the generated source code
+    :ivar native: the positions of the cases matched by the native `match`
+        statement; the rest fall back to the pattern interpreter
+
+    """
+    def __init__(self, matcher):
+        self.matcher = matcher
+        cases = matcher._active_cases()
+        if NATIVE_MATCH:
+            self.source, namespace, self.native = generate(
+                    [(case.pattern, case.handler) for case in cases],
+                    [case.plan for case in cases])
+            exec(compile(self.source, '<pyfpm codegen>', 'exec'), namespace)
+            self.dispatch = namespace['_dispatch']
+        else:
+            self.source, self.native = None, []
+            self.dispatch = matcher.match
+
+    def __call__(self, obj, *args):
+        extra_args = self.matcher.extra_args
+        if extra_args is not None and len(args) != extra_args:
+            _wrong_arity(extra_args, args)
+        result = self.dispatch(obj, *args)
+        while result.__class__ is TailCall:
+            if result.matcher is self.matcher:
+                if extra_args is not None and len(result.args) != extra_args:
+                    _wrong_arity(extra_args, result.args)
+                result = self.dispatch(result.obj, *result.args)
+            else:
+                result = result.matcher.match(result.obj, *result.args)
+        return result
+
+def compile_matcher(matcher):
+    """
+    Compile `matcher`'s current cases into a :class:`CompiledMatcher`. Cases
+    registered afterwards are not seen by the compiled function. On Python
+    versions without the `match` statement the compiled matcher just
+    delegates to the interpreter.
+
+    """
+    return CompiledMatcher(matcher)
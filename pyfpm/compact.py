@@ -0,0 +1,331 @@
+"""
+Compact, array-backed form of very large matchers.
+
+Every node of a pattern is a Python object with its own `__dict__`, which
+adds up for matchers with tens of thousands of cases, such as routing tables,
+and makes every garbage collection pass walk all of them. A
+:class:`CompactMatcher` stores its cases instead as a single array of
+instructions over a constant pool, run by a small interpreter loop, so the
+patterns themselves can be thrown away:
+
+    >>> from pyfpm.matcher import Matcher
+    >>> routes = Matcher([
+    ...     ("{'method': 'GET', 'path': '/users/' :: user}",
+    ...         lambda user: 'show %s' % user),
+    ...     ("{'method': 'POST', 'path': '/users', 'body': body:dict}",
+    ...         lambda body: 'create %s' % body['name']),
+    ...     ("{'method': method}", lambda method: '%s not allowed' % method),
+    ...     ])
+    >>> compact = routes.compact()
+    >>> del routes
+    >>> compact({'method': 'GET', 'path': '/users/ana'})
+    'show ana'
+    >>> compact({'method': 'POST', 'path': '/users', 'body': {'name': 'bo'}})
+    'create bo'
+    >>> compact({'method': 'PUT', 'path': '/users'})
+    'PUT not allowed'
+
+Constants, type tests, sequences, mappings, alternatives, names and
+conditions are translated to instructions. Other patterns (named tuples,
+class patterns, regular expressions, string prefixes and binary data) are
+kept as objects in the constant pool and matched by the pattern interpreter.
+The program can be inspected:
+
+    >>> print(compact.disassemble(0))
+       0 MAP
+       2 KEY 'method'
+       4 EQ 'GET'
+       6 POP
+       8 KEY 'path'
+      10 MATCH PrefixPattern
+      12 POP
+      14 DONE
+
+"""
+from array import array
+
+from pyfpm.matcher import (Case, NoMatch, TailCall, _build_index, _call_plan,
+        _wrong_arity)
+from pyfpm.pattern import (_basestring, _Mapping, _MISSING, _is_noop,
+        AnyPattern, EqualsPattern, InstanceOfPattern, ListPattern,
+        MappingPattern, OrPattern)
+
+# opcodes; each is followed by one operand (0 if unused)
+EQ, TYPE, BIND, GUARD, MATCH, LEN_EQ, LEN_GE, ITEM, SLICE, MAP, KEY, POP, \
+        TRY, COMMIT, DONE = range(15)
+
+OPCODE_NAMES = ('EQ', 'TYPE', 'BIND', 'GUARD', 'MATCH', 'LEN_EQ', 'LEN_GE',
+        'ITEM', 'SLICE', 'MAP', 'KEY', 'POP', 'TRY', 'COMMIT', 'DONE')
+
+# opcodes whose operand is a position in the constant pool
+_CONSTANT_OPERANDS = frozenset((EQ, TYPE, BIND, GUARD, MATCH, KEY))
+
+class _Assembler(object):
+    def __init__(self):
+        self.code = array('i')
+        self.constants = []
+        self._positions = {}
+
+    def constant(self, value):
+        """The position of `value` in the constant pool, adding it if it's
+        not there yet."""
+        try:
+            key = (value.__class__, value)
+            return self._positions[key]
+        except TypeError:
+            # unhashable, so it can't be shared
+            self.constants.append(value)
+            return len(self.constants) - 1
+        except KeyError:
+            position = self._positions[key] = len(self.constants)
+            self.constants.append(value)
+            return position
+
+    def emit(self, opcode, operand=0):
+        """Append an instruction, and return the offset of its operand."""
+        self.code.append(opcode)
+        self.code.append(operand)
+        return len(self.code) - 1
+
+    def case(self, pattern):
+        start = len(self.code)
+        self.node(pattern)
+        self.emit(DONE)
+        return start
+
+    def node(self, pattern):
+        cls = pattern.__class__
+        if cls is AnyPattern:
+            pass
+        elif cls is EqualsPattern:
+            self.emit(EQ, self.constant(pattern.obj))
+        elif cls is InstanceOfPattern:
+            self.emit(TYPE, self.constant(pattern.cls))
+        elif cls is ListPattern:
+            self.sequence(pattern)
+        elif cls is MappingPattern:
+            self.emit(MAP)
+            for key, value_pattern in pattern.mapping.items():
+                self.emit(KEY, self.constant(key))
+                self.node(value_pattern)
+                self.emit(POP)
+        elif cls is OrPattern:
+            self.alternatives(pattern)
+        else:
+            # the pattern binds its name and checks its condition itself
+            self.emit(MATCH, self.constant(pattern))
+            return
+        if pattern.bound_name:
+            self.emit(BIND, self.constant(pattern.bound_name))
+        if pattern.condition is not None:
+            self.emit(GUARD, self.constant(pattern.condition))
+
+    def sequence(self, pattern):
+        plain = lambda node: (node is pattern or (node.bound_name is None and
+            node.condition is None))
+        heads = []
+        node = pattern
+        while (node.__class__ is ListPattern and
+                node.head_pattern is not None and plain(node)):
+            heads.append(node.head_pattern)
+            node = node.tail_pattern
+        if (node.__class__ is ListPattern and node.head_pattern is None and
+                plain(node)):
+            self.emit(LEN_EQ, len(heads))
+            node = None
+        else:
+            self.emit(LEN_GE, len(heads))
+        for i, head in enumerate(heads):
+            if not _is_noop(head):
+                self.emit(ITEM, i)
+                self.node(head)
+                self.emit(POP)
+        if node is not None and not _is_noop(node):
+            self.emit(SLICE, len(heads))
+            self.node(node)
+            self.emit(POP)
+
+    def alternatives(self, pattern):
+        commits = []
+        for alternative in pattern.patterns[:-1]:
+            retry = self.emit(TRY)
+            self.node(alternative)
+            commits.append(self.emit(COMMIT))
+            self.code[retry] = len(self.code)
+        self.node(pattern.patterns[-1])
+        for commit in commits:
+            self.code[commit] = len(self.code)
+
+def _run(code, constants, pc, value):
+    """Run the program of a case from offset `pc` against `value`, and
+    return the bound names, or `None` if it doesn't match."""
+    ctx = {}
+    stack = []
+    # backtracking points: (offset, ctx, value, stack depth)
+    trail = []
+    while True:
+        opcode = code[pc]
+        operand = code[pc + 1]
+        pc += 2
+        if opcode == EQ:
+            ok = constants[operand] == value
+        elif opcode == KEY:
+            stack.append(value)
+            value = value.get(constants[operand], _MISSING)
+            ok = value is not _MISSING
+        elif opcode == POP:
+            value = stack.pop()
+            continue
+        elif opcode == ITEM:
+            stack.append(value)
+            try:
+                value = value[operand]
+                ok = True
+            except (IndexError, TypeError):
+                ok = False
+        elif opcode == TYPE:
+            ok = isinstance(value, constants[operand])
+        elif opcode == BIND:
+            name = constants[operand]
+            if name in ctx:
+                ok = not ctx[name] != value
+            else:
+                ctx[name] = value
+                continue
+        elif opcode == DONE:
+            return ctx
+        elif opcode == MAP:
+            ok = value.__class__ is dict or isinstance(value, _Mapping)
+        elif opcode == LEN_EQ or opcode == LEN_GE:
+            if operand and isinstance(value, _basestring):
+                ok = False
+            else:
+                try:
+                    length = len(value)
+                except TypeError:
+                    ok = opcode == LEN_GE
+                else:
+                    ok = (length == operand if opcode == LEN_EQ
+                            else length >= operand)
+        elif opcode == SLICE:
+            stack.append(value)
+            try:
+                value = value[operand:]
+                ok = True
+            except TypeError:
+                ok = False
+        elif opcode == GUARD:
+            ok = constants[operand](**ctx)
+        elif opcode == MATCH:
+            match = constants[operand].match(value, ctx)
+            ok = match is not None
+            if ok:
+                ctx = match.ctx
+        elif opcode == TRY:
+            trail.append((operand, dict(ctx), value, len(stack)))
+            continue
+        elif opcode == COMMIT:
+            trail.pop()
+            pc = operand
+            continue
+        else:
+            raise ValueError('bad opcode %d at offset %d' % (opcode, pc - 2))
+        if not ok:
+            if not trail:
+                return None
+            pc, ctx, value, depth = trail.pop()
+            del stack[depth:]
+
+def _positions(cases):
+    return array('i', (case.order for case in cases))
+
+class CompactMatcher(object):
+    """
+    Matcher whose cases are compiled into flat arrays. Calling it behaves
+    like calling a :class:`pyfpm.matcher.Matcher` with the same cases, tail
+    calls included. Cases are looked up through the same dispatch indexes.
+
+    :param bindings: a list of pattern-handler pairs, such as
+        :attr:`pyfpm.matcher.Matcher.bindings`
+    :param extra_args: the number of extra arguments of the handlers, as
+        declared by the matcher (see :class:`pyfpm.matcher.Matcher`)
+    :ivar code: the instructions, as an array of opcode-operand pairs
+    :ivar constants: the constant pool
+    :ivar starts: the offset of the program of each case in `code`
+    :ivar handlers: the handler of each case
+    :ivar plans: how each handler gets called (see
+        :func:`pyfpm.matcher._call_plan`)
+
+    """
+    def __init__(self, bindings, extra_args=None):
+        assembler = _Assembler()
+        self.extra_args = extra_args
+        self.starts = array('i')
+        self.handlers = []
+        self.plans = []
+        for pattern, handler in bindings:
+            self.starts.append(assembler.case(pattern))
+            self.handlers.append(handler)
+            self.plans.append(_call_plan(pattern, handler, extra_args))
+        self.code = assembler.code
+        self.constants = assembler.constants
+        self._index = _build_index([Case(pattern, None, position)
+            for (position, (pattern, handler)) in enumerate(bindings)])
+        self._index.map_cases(_positions)
+
+    def _find(self, obj):
+        code, constants, starts = self.code, self.constants, self.starts
+        for position in self._index.cases(obj):
+            ctx = _run(code, constants, starts[position], obj)
+            if ctx is not None:
+                return position, ctx
+        return None
+
+    def match(self, obj, *args):
+        """
+        Match `obj` against the cases until the first match, and call its
+        handler. See :func:`pyfpm.matcher.Matcher.match`.
+
+        """
+        while True:
+            if self.extra_args is not None and len(args) != self.extra_args:
+                _wrong_arity(self.extra_args, args)
+            found = self._find(obj)
+            if found is None:
+                raise NoMatch(obj=obj)
+            position, ctx = found
+            result = self.plans[position].call(self.handlers[position], args,
+                    ctx)
+            if result.__class__ is not TailCall:
+                return result
+            if result.matcher is not self:
+                return result.matcher.match(result.obj, *result.args)
+            obj, args = result.obj, result.args
+
+    def __call__(self, obj, *args):
+        return self.match(obj, *args)
+
+    def disassemble(self, position):
+        """The program of the case at `position`, one instruction per
+        line."""
+        pc = self.starts[position]
+        lines = []
+        while True:
+            opcode, operand = self.code[pc], self.code[pc + 1]
+            if opcode in _CONSTANT_OPERANDS:
+                argument = self.constants[operand]
+                if opcode == MATCH:
+                    argument = argument.__class__.__name__
+                elif opcode != TYPE:
+                    argument = repr(argument)
+                else:
+                    argument = argument.__name__
+                line = '%s %s' % (OPCODE_NAMES[opcode], argument)
+            elif opcode in (LEN_EQ, LEN_GE, ITEM, SLICE, TRY, COMMIT):
+                line = '%s %d' % (OPCODE_NAMES[opcode], operand)
+            else:
+                line = OPCODE_NAMES[opcode]
+            lines.append('%4d %s' % (pc, line))
+            if opcode == DONE:
+                return '\n'.join(lines)
+            pc += 2
@@ -0,0 +1,226 @@
+"""
+Node-level profiling of pattern matching, in the spirit of SQL's
+`EXPLAIN ANALYZE`.
+
+:func:`explain` matches a sample of objects with an instrumented copy of a
+pattern and reports, for each node of the pattern tree (and for each
+condition), how many times it was visited, how many times it matched and
+failed, the time spent in it (including its sub-patterns), and how many
+times it was the first node to fail while matching an object, i.e. where
+objects got rejected:
+
+    >>> from pyfpm.pattern import build as _
+    >>> explanation = explain(_(_(int)%'n', _(str)) / (lambda n: n > 0),
+    ...     (1, 'a'), (0, 'a'), ('x', 'a'))
+    >>> explanation.matches, explanation.runs
+    (1, 3)
+    >>> print(explanation.report(timing=False))
+    ListPattern                    visits=3 matched=1 failed=2
+      InstanceOfPattern(cls=int) n visits=3 matched=2 failed=1 first=1
+      ListPattern                  visits=2 matched=2
+        InstanceOfPattern(cls=str) visits=2 matched=2
+        ListPattern                visits=2 matched=2
+      if <condition>               visits=2 matched=1 failed=1 first=1
+
+:func:`explain_matcher` does the same for every case of a
+:class:`pyfpm.matcher.Matcher`, trying them in order like the matcher does.
+
+"""
+import copy
+import timeit
+
+from pyfpm.pattern import Pattern
+
+class NodeStats(object):
+    """
+    Counters for one node of an explained pattern, or for its condition.
+
+    :ivar label: a description of the node
+    :ivar depth: the depth of the node in the tree
+    :ivar visits: how many times the node was matched
+    :ivar matched: how many of those it succeeded
+    :ivar failed: how many of those it failed
+    :ivar time: the cumulative time spent matching it, in seconds
+    :ivar first: how many times it was the first node to fail while
+        matching an object
+
+    """
+    def __init__(self, label, depth):
+        self.label = label
+        self.depth = depth
+        self.visits = 0
+        self.matched = 0
+        self.failed = 0
+        self.time = 0.
+        self.first = 0
+
+    def __repr__(self):
+        return 'NodeStats(%s, visits=%d, matched=%d, failed=%d, first=%d)' % (
+                self.label, self.visits, self.matched, self.failed, self.first)
+
+def _has_patterns(value):
+    if isinstance(value, Pattern):
+        return True
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (tuple, list)):
+        return any(map(_has_patterns, value))
+    return False
+
+def _label(pattern):
+    params = ', '.join('%s=%s' % (k, getattr(v, '__name__', None) or repr(v))
+            for (k, v) in sorted(pattern._state().items())
+            if k not in ('bound_name', 'condition') and v is not None and
+            not _has_patterns(v))
+    label = pattern.__class__.__name__
+    if params:
+        label += '(%s)' % params
+    if pattern.bound_name is not None:
+        label += ' %s' % pattern.bound_name
+    return label
+
+def _condition_label(condition):
+    source = getattr(condition, 'source', None)
+    if source is None:
+        return 'if <condition>'
+    return 'if %s' % source
+
+class Explanation(object):
+    """
+    An instrumented copy of a pattern, with the statistics gathered by
+    matching objects with it.
+
+    :ivar pattern: the instrumented pattern
+    :ivar nodes: the :class:`NodeStats` of every node, in tree order
+    :ivar runs: how many objects were matched
+    :ivar matches: how many of them matched
+
+    """
+    def __init__(self, pattern):
+        self.nodes = []
+        self.runs = 0
+        self.matches = 0
+        self._first = None
+        self.pattern = self._instrument(pattern)
+
+    def _instrument(self, pattern):
+        # the tree is walked off an explicit stack, so that long sequence
+        # patterns don't hit the recursion limit; the stats of each node come
+        # before those of its sub-patterns, and its condition after them
+        done = []
+        todo = [(pattern, 0, None)]
+        while todo:
+            pattern, depth, stats = todo.pop()
+            children = pattern.children()
+            if stats is None:
+                stats = NodeStats(_label(pattern), depth)
+                self.nodes.append(stats)
+                todo.append((pattern, depth, stats))
+                todo.extend((child, depth + 1, None)
+                        for child in reversed(children))
+                continue
+            if children:
+                node = pattern._with_children(
+                        tuple(done[len(done) - len(children):]))
+                del done[len(done) - len(children):]
+            else:
+                node = copy.copy(pattern)
+            node._memoize = False
+            node._inline = False
+            if pattern.condition is not None:
+                guard = NodeStats(_condition_label(pattern.condition),
+                        depth + 1)
+                self.nodes.append(guard)
+                node.condition = self._timed(guard, pattern.condition)
+            node.match = self._timed(stats, node.match)
+            done.append(node)
+        (node,) = done
+        return node
+
+    def _timed(self, stats, function):
+        def timed(*args, **kwargs):
+            # a node that matches recovers from the failures inside it (e.g.
+            # of the alternatives of an OrPattern), so only the first failure
+            # that propagates gets charged
+            first = self._first
+            stats.visits += 1
+            start = timeit.default_timer()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                stats.time += timeit.default_timer() - start
+            if result:
+                stats.matched += 1
+                self._first = first
+            else:
+                stats.failed += 1
+                if self._first is None:
+                    self._first = stats
+            return result
+        return timed
+
+    def run(self, obj):
+        """Match `obj` with the instrumented pattern, and return the
+        result."""
+        self._first = None
+        self.runs += 1
+        match = self.pattern.match(obj)
+        if match:
+            self.matches += 1
+        elif self._first is not None:
+            self._first.first += 1
+        return match
+
+    def report(self, timing=True):
+        """
+        The annotated pattern tree, one node per line.
+
+        :param timing: bool -- whether to include the time spent in each node
+        """
+        labels = ['%s%s' % ('  ' * node.depth, node.label)
+                for node in self.nodes]
+        width = max(map(len, labels))
+        lines = []
+        for label, node in zip(labels, self.nodes):
+            counters = ['visits=%d' % node.visits]
+            if node.matched:
+                counters.append('matched=%d' % node.matched)
+            if node.failed:
+                counters.append('failed=%d' % node.failed)
+            if timing:
+                counters.append('time=%.3fms' % (node.time * 1000))
+            if node.first:
+                counters.append('first=%d' % node.first)
+            lines.append('%s %s' % (label.ljust(width), ' '.join(counters)))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.report()
+
+def explain(pattern, *objects):
+    """
+    Match each of `objects` with an instrumented copy of `pattern`, and
+    return the :class:`Explanation` with the statistics.
+
+    """
+    explanation = Explanation(pattern)
+    for obj in objects:
+        explanation.run(obj)
+    return explanation
+
+def explain_matcher(matcher, *objects):
+    """
+    Dispatch each of `objects` through instrumented copies of the cases of
+    `matcher`, without calling any handler. Every case is tried in order
+    until one matches, so the statistics show where the matching time of
+    each object goes.
+
+    :returns: a list with the :class:`Explanation` of each case
+    """
+    explanations = [Explanation(pattern)
+            for (pattern, handler) in matcher._active_bindings()]
+    for obj in objects:
+        for explanation in explanations:
+            if explanation.run(obj):
+                break
+    return explanations
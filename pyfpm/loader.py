@@ -0,0 +1,224 @@
+"""
+Bulk loading of cases from pattern table files.
+
+Large tables of cases, such as routing rules, can be kept in text files with
+one case per line: a pattern, `=>`, and a reference to its handler, either
+`module:name` or the name of a handler in the matcher's context. Blank lines
+and lines starting with `#` are skipped:
+
+    >>> from io import StringIO
+    >>> from pyfpm.matcher import Matcher
+    >>> def show(user):
+    ...     return 'show %s' % user
+    >>> table = StringIO(u'''
+    ... # user routes
+    ... 'GET /users/' :: user => show
+    ... _ => pyfpm.loader:not_found
+    ... ''')
+    >>> routes = Matcher()
+    >>> cases = routes.load(table)
+    >>> routes('GET /users/ana')
+    'show ana'
+    >>> routes('PUT /users/ana')
+
+The file is read line by line, and each distinct handler reference and type
+name is resolved once. Nothing is registered unless the whole file loads;
+otherwise a :class:`LoadError` lists every bad line:
+
+    >>> try:
+    ...     routes.load(StringIO(u'[x, => show\\n_ => missing\\n'))
+    ... except LoadError as e:
+    ...     print(e)
+    2 errors in <stream>:
+      line 1, column 3: Expected ']'
+      line 2: cannot resolve handler missing: 'missing'
+
+Huge tables can be parsed across a pool of worker processes with
+`processes=n`. The workers parse the patterns in the globals of the module
+the matcher's context belongs to.
+
+"""
+import collections
+import importlib
+import multiprocessing
+import re
+import sys
+
+from pyparsing import ParseBaseException
+
+from pyfpm.matcher import _call_plan
+from pyfpm.parser import Parser
+from pyfpm.pattern import _basestring
+
+# lines per task sent to a worker process
+CHUNK_LINES = 500
+
+class LoadError(ValueError):
+    """
+    Raised when a pattern table can't be loaded.
+
+    :ivar errors: a list of `(line number, message)` pairs, one per bad line
+
+    """
+    def __init__(self, name, errors):
+        self.name = name
+        self.errors = errors
+        ValueError.__init__(self, '%d error%s in %s:\n%s' % (len(errors),
+            '' if len(errors) == 1 else 's', name, '\n'.join(
+                '  line %d%s' % (lineno, message)
+                for (lineno, message) in errors)))
+
+def not_found():
+    """Handler that returns `None`, for catch-all cases."""
+    return None
+
+def _split(line):
+    """The pattern source and handler reference of a line, `None` if it's
+    blank or a comment."""
+    stripped = line.strip()
+    if not stripped or stripped.startswith('#'):
+        return None
+    source, arrow, reference = line.rpartition('=>')
+    if not (source.strip() and reference.strip()):
+        raise ValueError("expected 'pattern => handler'")
+    return source.rstrip(), reference.strip()
+
+def _parse(parse, lines):
+    """Parse `(line number, pattern source, handler reference)` triples into
+    `(line number, handler reference, pattern, error message)` tuples."""
+    results = []
+    for lineno, source, reference in lines:
+        try:
+            results.append((lineno, reference, parse(source), None))
+        except ParseBaseException as e:
+            results.append((lineno, reference, None,
+                ', column %d: %s' % (e.col, e.msg)))
+        except SyntaxError as e:
+            results.append((lineno, reference, None,
+                ': bad condition: %s' % e.msg))
+        except re.error as e:
+            results.append((lineno, reference, None,
+                ': bad regular expression: %s' % e))
+        except (AttributeError, ImportError, ValueError) as e:
+            results.append((lineno, reference, None, ': %s' % e))
+    return results
+
+_worker_parser = None
+
+def _init_worker(module_name):
+    global _worker_parser
+    _worker_parser = Parser(importlib.import_module(module_name).__dict__)
+
+def _parse_chunk(lines):
+    return _parse(_worker_parser, lines)
+
+def _chunks(lines, size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _parse_in_pool(lines, context, processes):
+    """Parse lines like :func:`_parse` in worker processes, keeping at most
+    two chunks per worker in flight, and yield the results in order."""
+    module_name = context.get('__name__')
+    module = sys.modules.get(module_name)
+    if module is None or module.__dict__ is not context:
+        raise ValueError('parsing in worker processes needs a module\'s '
+                'globals as the matcher context')
+    pool = multiprocessing.Pool(processes, _init_worker, (module_name,))
+    try:
+        pending = collections.deque()
+        for chunk in _chunks(lines, CHUNK_LINES):
+            pending.append(pool.apply_async(_parse_chunk, (chunk,)))
+            if len(pending) >= 2 * (processes or multiprocessing.cpu_count()):
+                for result in pending.popleft().get():
+                    yield result
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+    finally:
+        pool.terminate()
+
+def _resolve(reference, context):
+    """The handler a reference names: `module:name`, or a name in the
+    parser's context. Dotted names are looked up attribute by attribute."""
+    module_name, colon, name = reference.rpartition(':')
+    first, dot, rest = name.partition('.')
+    if colon:
+        handler = getattr(importlib.import_module(module_name), first)
+    else:
+        handler = context[first]
+    for attribute in rest.split('.') if rest else ():
+        handler = getattr(handler, attribute)
+    if not callable(handler):
+        raise TypeError('%s is not callable' % reference)
+    return handler
+
+def load(matcher, source, processes=None):
+    """
+    Register the cases in a pattern table file, in order.
+
+    :param matcher: the :class:`pyfpm.matcher.Matcher` to register them in
+    :param source: a path, or a file-like object open in text mode
+    :param processes: if given, parse the patterns in a pool of that many
+        worker processes (0 for one per CPU)
+    :returns: the list of the :class:`pyfpm.matcher.Case` handles of the new
+        cases
+    :raises: LoadError -- if any line can't be parsed, or its handler
+        resolved or called with the names its pattern binds; no case is
+        registered then
+
+    """
+    if isinstance(source, _basestring):
+        with open(source) as stream:
+            return load(matcher, stream, processes)
+    context = matcher.parser.context
+    errors = []
+    def lines():
+        for lineno, line in enumerate(source, 1):
+            try:
+                split = _split(line)
+            except ValueError as e:
+                errors.append((lineno, ': %s' % e))
+            else:
+                if split is not None:
+                    yield (lineno,) + split
+    if processes is None:
+        parsed = (result for chunk in _chunks(lines(), CHUNK_LINES)
+                for result in _parse(matcher.parser, chunk))
+    else:
+        parsed = _parse_in_pool(lines(), context, processes or None)
+    handlers = {}
+    cases = []
+    for lineno, reference, pattern, message in parsed:
+        if pattern is None:
+            errors.append((lineno, message))
+        if reference not in handlers:
+            try:
+                handlers[reference] = _resolve(reference, context)
+            except (ImportError, AttributeError, KeyError, TypeError) as e:
+                handlers[reference] = e
+        handler = handlers[reference]
+        if isinstance(handler, Exception):
+            errors.append((lineno, ': cannot resolve handler %s: %s' % (
+                reference, handler)))
+            continue
+        if pattern is None:
+            continue
+        try:
+            _call_plan(pattern, handler, matcher.extra_args)
+        except TypeError as e:
+            errors.append((lineno, ': %s' % e))
+        if not errors:
+            cases.append((pattern, handler))
+    if errors:
+        errors.sort()
+        raise LoadError(getattr(source, 'name', '<stream>'), errors)
+    with matcher.batch():
+        return [matcher.register(pattern, handler)
+                for (pattern, handler) in cases]
@@ -10,6 +10,12 @@ This module lets you unpack objects:
     >>> unpacker.tail
     (2, 3)
 
+or straight into local variables:
+
+    >>> head, tail = unpack('head :: tail', (1, 2, 3))
+    >>> head, tail
+    (1, (2, 3))
+
 or function parameters:
 
     >>> @match_args('[x:str, [y:int, z:int]]')
@@ -61,17 +67,574 @@ or more complex ones using a decorator:
     >>> parse_options(('-v', 'x'))
     "unknown options: ('-v', 'x')"
 
+Mapping patterns only look up the keys they name. When several cases require
+a constant value at the same key, the matcher indexes them by that value, so
+routing events by type doesn't test every case:
+
+    >>> route = Matcher([
+    ...     ("{'type': 'order', 'items': items}", lambda items: len(items)),
+    ...     ("{'type': 'refund', 'amount': n}", lambda n: -n),
+    ...     ('_', lambda: None),
+    ...     ])
+    >>> route({'type': 'order', 'items': ['a', 'b'], 'id': 1})
+    2
+    >>> route({'type': 'refund', 'amount': 10})
+    -10
+    >>> route({'type': 'unknown'})
+
+Likewise, cases that require strings to start with a constant prefix are laid
+out in a character trie, so only the cases whose prefix the string starts with
+are tested:
+
+    >>> http = Matcher([
+    ...     ("'GET ' :: path", lambda path: 'get %s' % path),
+    ...     ("'POST ' :: path", lambda path: 'post %s' % path),
+    ...     ('_', lambda: 'bad request'),
+    ...     ])
+    >>> http('GET /index.html')
+    'get /index.html'
+    >>> http('PUT /index.html')
+    'bad request'
+
 """
+import bisect
+import heapq
+import inspect
+import itertools
+import sys
 from functools import wraps
+from operator import itemgetter
 
-from pyfpm.parser import Parser, _get_caller_globals
-from pyfpm.pattern import _basestring
+from pyfpm import analysis, optimizer
+from pyfpm.parser import (Parser, _get_caller_globals, _bound_names,
+        _always_bound)
+from pyfpm.pattern import (_basestring, _Mapping, _MISSING, _postorder,
+        EqualsPattern, OrPattern, MappingPattern, PrefixPattern, PatternTable,
+        Memo)
 
 class NoMatch(Exception):
     """
     Thrown by matchers when no registered pattern could match the given object.
 
+    Unless an explicit message is given, the message is only formatted (which
+    may mean calling `repr` on a large object) when the exception is rendered.
+
+    :ivar obj: the object that didn't match
+    :ivar pattern: the pattern it didn't match, if there was only one
+
+    """
+    def __init__(self, message=None, obj=None, pattern=None):
+        args = () if message is None else (message,)
+        super(NoMatch, self).__init__(*args)
+        self.obj = obj
+        self.pattern = pattern
+
+    def __str__(self):
+        if self.args:
+            return super(NoMatch, self).__str__()
+        if self.pattern is None:
+            return 'no registered pattern could match %s' % repr(self.obj)
+        return "%s doesn't match %s" % (self.pattern, self.obj)
+
+class _NoMatchType(object):
+    def __repr__(self):
+        return 'NO_MATCH'
+
+NO_MATCH = _NoMatchType()
+"""Default value returned by :func:`Matcher.try_match` and friends when
+nothing matches."""
+
+# default value that makes a failed match raise NoMatch
+_RAISE = object()
+
+# value types whose hash is consistent with their equality, and can thus be
+# looked up in a dispatch index instead of being compared one by one
+_INDEXABLE_TYPES = frozenset((str, bytes, int, float, bool, type(None)))
+try:
+    _INDEXABLE_TYPES |= frozenset((unicode, long))
+except NameError:
+    pass
+
+# string types whose prefixes can be looked up in a trie
+_STRING_TYPES = frozenset(t for t in _INDEXABLE_TYPES
+        if issubclass(t, _basestring))
+
+def _constant_values(pattern):
+    if isinstance(pattern, EqualsPattern):
+        patterns = (pattern,)
+    elif isinstance(pattern, OrPattern):
+        patterns = pattern.patterns
+    else:
+        return None
+    values = []
+    for p in patterns:
+        if (not isinstance(p, EqualsPattern) or
+                p.obj.__class__ not in _INDEXABLE_TYPES):
+            return None
+        values.append(p.obj)
+    return values
+
+def _discriminators(pattern):
+    """Map each key that `pattern` requires to hold one of a few constant
+    values to the list of those values."""
+    if not isinstance(pattern, MappingPattern):
+        return {}
+    discriminators = {}
+    for key, value_pattern in pattern.mapping.items():
+        values = _constant_values(value_pattern)
+        if values is not None:
+            discriminators[key] = values
+    return discriminators
+
+def _merge(first, second):
+    """Merge two ordered lists of cases, dropping repeated ones."""
+    if not second:
+        return first
+    if not first:
+        return second
+    merged = []
+    for case in heapq.merge(first, second):
+        if not merged or merged[-1] != case:
+            merged.append(case)
+    return merged
+
+def _remove(cases, case):
+    """Remove `case` from an ordered list of cases."""
+    position = bisect.bisect_left(cases, case)
+    if position == len(cases) or cases[position] is not case:
+        raise ValueError('%r is not in the index' % (case,))
+    del cases[position]
+
+class _KeyIndex(object):
+    """
+    Dispatch index over the cases that require a constant value at a shared
+    mapping key. For each value it holds the (ordered) list of cases that may
+    match a mapping with that value, so all the others are skipped.
+
+    Cases can be added and removed one by one: each update only touches the
+    lists of the values the case requires, and the merged lists handed out
+    by :func:`cases` are rebuilt on demand.
+
+    """
+    def __init__(self, key, cases):
+        self.key = key
+        self.entries = []
+        self.generic = []
+        self.specific = {}
+        self._merged = {}
+        for case in cases:
+            self.add(case, case.pattern)
+
+    def _values(self, pattern):
+        values = _discriminators(pattern).get(self.key)
+        if values is None:
+            return None
+        return set(values)
+
+    def add(self, case, pattern):
+        bisect.insort(self.entries, case)
+        values = self._values(pattern)
+        if values is None:
+            bisect.insort(self.generic, case)
+            self._merged = {}
+            return
+        for value in values:
+            bisect.insort(self.specific.setdefault(value, []), case)
+            self._merged.pop(value, None)
+
+    def remove(self, case, pattern):
+        _remove(self.entries, case)
+        values = self._values(pattern)
+        if values is None:
+            _remove(self.generic, case)
+            self._merged = {}
+            return
+        for value in values:
+            cases = self.specific[value]
+            _remove(cases, case)
+            if not cases:
+                del self.specific[value]
+            self._merged.pop(value, None)
+
+    def cases(self, obj):
+        if obj.__class__ is not dict and not isinstance(obj, _Mapping):
+            return self.generic
+        value = obj.get(self.key, _MISSING)
+        if value is _MISSING:
+            return self.generic
+        if value.__class__ not in _INDEXABLE_TYPES:
+            return self.entries
+        merged = self._merged.get(value)
+        if merged is None:
+            specific = self.specific.get(value)
+            if specific is None:
+                return self.generic
+            merged = self._merged[value] = _merge(specific, self.generic)
+        return merged
+
+    def map_cases(self, function):
+        """Replace every list of cases with `function(cases)`."""
+        self.entries = function(self.entries)
+        self.generic = function(self.generic)
+        self.specific = dict((value, function(cases))
+                for (value, cases) in self.specific.items())
+        self._merged = {}
+
+def _string_prefixes(pattern):
+    """The literal prefixes one of which a string must start with to match
+    `pattern`, or `None` if there's no such requirement."""
+    if pattern.__class__ is EqualsPattern:
+        if pattern.obj.__class__ in _STRING_TYPES:
+            return [pattern.obj]
+        return None
+    if pattern.__class__ is OrPattern:
+        prefixes = []
+        for p in pattern.patterns:
+            alternative = _string_prefixes(p)
+            if alternative is None:
+                return None
+            prefixes.extend(alternative)
+        return prefixes
+    if pattern.__class__ is not PrefixPattern:
+        return None
+    prefix = []
+    while pattern.__class__ is PrefixPattern:
+        prefix.append(pattern.head_pattern.obj)
+        pattern = pattern.tail_pattern
+    return [''.join(prefix)]
+
+class _TrieNode(object):
+    __slots__ = ('children', 'entries', 'cases', 'version')
+
+    def __init__(self):
+        self.children = {}
+        self.entries = []
+        self.cases = None
+        self.version = None
+
+class _TrieIndex(object):
+    """
+    Dispatch index over the cases that require strings to start with a
+    literal prefix. The prefixes are laid out in a character trie whose
+    nodes hold the cases that require them; the (ordered) list of cases that
+    may match a string reaching a node, including those of the nodes above
+    it, is merged on demand and kept until the next update. Finding the
+    candidates for a string only walks its longest matching prefix.
+
+    """
+    def __init__(self, cases):
+        self.entries = []
+        self.root = _TrieNode()
+        self._version = 0
+        for case in cases:
+            self.add(case, case.pattern)
+
+    def _nodes(self, pattern, create):
+        prefixes = _string_prefixes(pattern)
+        if prefixes is None:
+            return [self.root]
+        nodes = []
+        for prefix in set(prefixes):
+            node = self.root
+            for char in prefix:
+                if create:
+                    node = node.children.setdefault(char, _TrieNode())
+                else:
+                    node = node.children[char]
+            nodes.append(node)
+        return nodes
+
+    def add(self, case, pattern):
+        bisect.insort(self.entries, case)
+        for node in self._nodes(pattern, True):
+            bisect.insort(node.entries, case)
+        self._version += 1
+
+    def remove(self, case, pattern):
+        _remove(self.entries, case)
+        for node in self._nodes(pattern, False):
+            _remove(node.entries, case)
+        self._version += 1
+
+    def cases(self, obj):
+        if obj.__class__ not in _STRING_TYPES:
+            return self.entries
+        node = self.root
+        cases = node.entries
+        for char in obj:
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.entries:
+                if node.version != self._version:
+                    node.cases = _merge(cases, node.entries)
+                    node.version = self._version
+                cases = node.cases
+        return cases
+
+    def map_cases(self, function):
+        """Replace every list of cases with `function(cases)`."""
+        self.entries = function(self.entries)
+        self._version += 1
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            node.entries = function(node.entries)
+            stack.extend(node.children.values())
+
+class _LinearIndex(object):
+    """Trivial dispatch index: every case may match every object."""
+    def __init__(self, cases):
+        self.entries = list(cases)
+
+    def add(self, case, pattern):
+        bisect.insort(self.entries, case)
+
+    def remove(self, case, pattern):
+        _remove(self.entries, case)
+
+    def cases(self, obj):
+        return self.entries
+
+    def map_cases(self, function):
+        """Replace every list of cases with `function(cases)`."""
+        self.entries = function(self.entries)
+
+def _build_index(cases):
+    """The best dispatch index for a list of :class:`Case` objects, in
+    order."""
+    counts = {}
+    prefixed = 0
+    for case in cases:
+        for key in _discriminators(case.pattern):
+            if key.__class__ in _INDEXABLE_TYPES:
+                counts[key] = counts.get(key, 0) + 1
+        if _string_prefixes(case.pattern) is not None:
+            prefixed += 1
+    key = None
+    if counts:
+        key = max(counts, key=counts.get)
+    if prefixed >= 2 and (key is None or prefixed > counts[key]):
+        return _TrieIndex(cases)
+    if key is None or counts[key] < 2:
+        return _LinearIndex(cases)
+    return _KeyIndex(key, cases)
+
+def _parameters(function):
     """
+    `(positional, keyword_only, required, var_positional, var_keyword)` for
+    the parameters of `function`: the names of the positional and
+    keyword-only ones, the set of those without a default, and whether it
+    takes `*args` and `**kwargs`; or `None` if its signature can't be
+    inspected.
+
+    """
+    try:
+        signature = inspect.signature(function)
+    except AttributeError:
+        # python 2.x
+        try:
+            spec = inspect.getargspec(function)
+        except TypeError:
+            return None
+        defaults = len(spec.defaults or ())
+        return (spec.args, [], set(spec.args[:len(spec.args) - defaults]),
+                spec.varargs is not None, spec.keywords is not None)
+    except (TypeError, ValueError):
+        return None
+    positional, keyword_only, required = [], [], set()
+    var_positional = var_keyword = False
+    for parameter in signature.parameters.values():
+        if parameter.kind == parameter.VAR_POSITIONAL:
+            var_positional = True
+            continue
+        if parameter.kind == parameter.VAR_KEYWORD:
+            var_keyword = True
+            continue
+        if parameter.kind == parameter.KEYWORD_ONLY:
+            keyword_only.append(parameter.name)
+        else:
+            positional.append(parameter.name)
+        if parameter.default is parameter.empty:
+            required.add(parameter.name)
+    return positional, keyword_only, required, var_positional, var_keyword
+
+def _values(names):
+    """A function that takes the values of `names`, as a tuple, from a match
+    context."""
+    if len(names) > 1:
+        return itemgetter(*names)
+    if names:
+        name, = names
+        return lambda ctx: (ctx[name],)
+    return lambda ctx: ()
+
+class _CallPlan(object):
+    """
+    How a case calls its handler, as worked out by :func:`_call_plan`.
+
+    :ivar leading: the number of extra arguments the handler takes before the
+        bound names
+    :ivar exact: whether the matcher always gets exactly `leading` extra
+        arguments
+    :ivar names: the bound names the handler takes positionally after them,
+        or `None` if it must get them as keyword arguments
+    :ivar keywords: the names to pass when calling the handler with keyword
+        arguments, or `None` for every bound name
+
+    """
+    __slots__ = ('leading', 'exact', 'names', 'keywords', 'values')
+
+    def __init__(self, leading=0, exact=False, names=None, keywords=None):
+        self.leading = leading
+        self.exact = exact
+        self.names = names
+        self.keywords = keywords
+        self.values = None if names is None else _values(names)
+
+    def call(self, handler, args, ctx):
+        """Call `handler` with the extra `args` and the names bound in the
+        match context `ctx`."""
+        if self.values is not None and len(args) == self.leading:
+            if args:
+                return handler(*(tuple(args) + self.values(ctx)))
+            return handler(*self.values(ctx))
+        if self.keywords is None:
+            return handler(*args, **ctx)
+        return handler(*args, **dict((name, ctx[name])
+            for name in self.keywords if name in ctx))
+
+def _call_plan(pattern, handler, extra_args=None):
+    """
+    Work out how to call `handler` after the `extra_args` arguments of
+    :func:`Matcher.match`, with the names `pattern` binds. They're passed
+    positionally, in parameter order, unless the handler takes `**kwargs`,
+    keyword-only names or names not always bound; then only the names it
+    takes are passed, as keyword arguments. If `extra_args` is `None`, the
+    parameters before the first bound name are taken to be extra arguments,
+    and any other number of them gets the keyword call.
+
+    :returns: a :class:`_CallPlan`
+    :raises: TypeError -- if the handler can't take the extra arguments, or
+        requires an argument that neither they nor the pattern always give
+
+    """
+    parameters = _parameters(handler)
+    if parameters is None:
+        return _CallPlan()
+    positional, keyword_only, required, var_positional, var_keyword = \
+            parameters
+    name = getattr(handler, '__name__', handler)
+    bound = set(_bound_names(pattern))
+    always = _always_bound(pattern)
+    leading = extra_args
+    if leading is None:
+        leading = len(positional)
+        for i, parameter in enumerate(positional):
+            if parameter in bound:
+                leading = i
+                break
+    elif len(positional) < leading and not var_positional:
+        raise TypeError('handler %s does not take %d extra argument%s' % (
+            name, leading, '' if leading == 1 else 's'))
+    twice = [name for name in positional[:leading] if name in bound]
+    if twice:
+        raise TypeError('handler %s gets %s both as an extra argument and '
+                'from its pattern' % (name, ', '.join(twice)))
+    rest = positional[leading:]
+    missing = [name for name in rest + keyword_only
+            if name in required and name not in always]
+    if missing:
+        raise TypeError('handler %s requires %s, which its pattern does not '
+                'always bind' % (name, ', '.join(missing)))
+    keywords = None
+    if not var_keyword:
+        keywords = tuple(name for name in positional + keyword_only
+                if name in bound)
+    names = [name for name in rest if name in bound]
+    if (var_keyword or len(positional) < leading or
+            names != rest[:len(names)] or
+            any(name not in always for name in names) or
+            any(name in bound for name in keyword_only)):
+        names = None
+    return _CallPlan(leading, extra_args is not None, names, keywords)
+
+def _wrong_arity(extra_args, args):
+    raise TypeError('matcher takes %d extra argument%s, got %d' % (
+        extra_args, '' if extra_args == 1 else 's', len(args)))
+
+class Case(object):
+    """
+    Handle for a case of a :class:`Matcher`, as returned by
+    :func:`Matcher.register`. It can be passed to :func:`Matcher.unregister`
+    and :func:`Matcher.replace`, and it unpacks like a `(pattern, handler)`
+    pair:
+
+        >>> m = Matcher()
+        >>> case = m.register('x:int', lambda x: x)
+        >>> pattern, handler = case
+        >>> pattern
+        InstanceOfPattern(bound_name='x', cls=<class 'int'>)
+
+    Cases are ordered like their position in the matcher.
+
+    :ivar pattern: Pattern -- the (parsed) pattern
+    :ivar handler: the handler function
+    :ivar plan: how the handler gets called (see :func:`_call_plan`)
+
+    """
+    __slots__ = ('pattern', 'handler', 'order', 'plan')
+
+    def __init__(self, pattern, handler, order, plan=None):
+        self.pattern = pattern
+        self.handler = handler
+        self.order = order
+        self.plan = _CallPlan() if plan is None else plan
+
+    def __iter__(self):
+        return iter((self.pattern, self.handler))
+
+    def __lt__(self, other):
+        return self.order < other.order
+
+    def __repr__(self):
+        return 'Case(%r, %r)' % (self.pattern, self.handler)
+
+class _BatchUpdate(object):
+    """Context manager returned by :func:`Matcher.batch`."""
+    def __init__(self, matcher):
+        self.matcher = matcher
+
+    def __enter__(self):
+        matcher = self.matcher
+        matcher._batch_depth += 1
+        if matcher._pending is None:
+            matcher._pending = []
+        return matcher
+
+    def __exit__(self, *exc_info):
+        matcher = self.matcher
+        matcher._batch_depth -= 1
+        if not matcher._batch_depth:
+            matcher._flush()
+            matcher._pending = None
+
+class TailCall(object):
+    """
+    Marker returned by handlers to ask the running :class:`Matcher` to continue
+    matching `obj` with `matcher` instead of recursing. Use
+    :func:`Matcher.tailcall` to build it.
+
+    """
+    __slots__ = ('matcher', 'obj', 'args')
+
+    def __init__(self, matcher, obj, args=()):
+        self.matcher = matcher
+        self.obj = obj
+        self.args = args
+
+    def __repr__(self):
+        return 'TailCall(%r, %r, %r)' % (self.matcher, self.obj, self.args)
 
 class Matcher(object):
     """
@@ -83,10 +646,42 @@ class Matcher(object):
     :param context: an optional context for the :class:`Parser`.
         If absent, it uses the caller's `globals()`
     :type context: dict
+    :param analyze: bool -- if true, each registered case is checked against
+        the earlier ones, and an :class:`pyfpm.analysis.UnreachableCaseWarning`
+        is issued if it can never be reached, or only by objects equal to
+        one of its constants but of another type. See :mod:`pyfpm.analysis`.
+    :param prune: bool -- if true, unreachable cases are also left out of
+        the dispatch path (they're still kept in `bindings`), but not the
+        ones still reachable by equal objects of other types. Implies
+        `analyze`.
+    :param optimize: bool -- if true (the default), registered patterns are
+        rewritten into cheaper equivalent ones. See :mod:`pyfpm.optimizer`.
+    :param dump: an optional file-like object to write the tree of each
+        registered pattern to, before and after the optimization.
+    :param extra_args: int -- the number of extra positional arguments
+        :func:`match` gets and passes on to the handlers, before the bound
+        names. If it's not given, any number is accepted, and the handler
+        parameters before the first name their pattern binds are taken to be
+        extra arguments.
 
     """
-    def __init__(self, bindings=[], context=None):
+    def __init__(self, bindings=[], context=None, analyze=False, prune=False,
+            optimize=True, dump=None, extra_args=None):
         self.bindings = []
+        self.extra_args = extra_args
+        self.analyze = analyze or prune
+        self.prune = prune
+        self.optimize = optimize
+        self.dump = dump
+        # the Case of each binding, in the same order
+        self._cases_in_order = []
+        self._counter = itertools.count()
+        # unreachable case -> the earlier case that shadows it
+        self._unreachable = {}
+        self._patterns = PatternTable()
+        self._index = None
+        self._pending = None
+        self._batch_depth = 0
         if context is None:
             context = _get_caller_globals()
         self.parser = Parser(context)
@@ -98,13 +693,217 @@ class Matcher(object):
         Register a new pattern-handler pair. If the pattern is a string, it will
         be parsed automatically.
 
+        Identical sub-patterns across the registered patterns are shared (see
+        :class:`pyfpm.pattern.PatternTable`), and the shared ones without
+        names or conditions are tested only once per matched object.
+
+        Names that the handler doesn't take as arguments aren't bound at all,
+        so their values aren't computed (see :func:`pyfpm.optimizer.unbind`);
+        handlers that take `**kwargs` get every name:
+
+            >>> m = Matcher()
+            >>> case = m.register('x :: tail', lambda x: x)
+            >>> m((1, 2, 3))
+            1
+
+        Handlers are called with the extra arguments of :func:`match`
+        followed by the bound names, positionally where their signature
+        allows it. Handlers that require an argument that the pattern doesn't
+        always bind, and that can't be an extra argument either, are
+        rejected; so are those that can't take the matcher's `extra_args`, if
+        it declares them:
+
+            >>> try:
+            ...     m.register('[x] | [x, y]', lambda x, y: y)
+            ... except TypeError as e:
+            ...     print(e)
+            handler <lambda> requires y, which its pattern does not always bind
+
         :param pattern: Pattern or str -- the pattern
         :param handler: callable -- the handler function for the pattern
+        :returns: the :class:`Case` handle of the new case
+        :raises: TypeError -- if the handler doesn't fit the extra arguments
+            and the names the pattern always binds
+
+        """
+        pattern = self._prepare(pattern, handler)
+        case = Case(pattern, handler, next(self._counter),
+                _call_plan(pattern, handler, self.extra_args))
+        self.bindings.append((case.pattern, handler))
+        self._cases_in_order.append(case)
+        if self.analyze:
+            self._check_reachable(case, len(self.bindings) - 1)
+        if case not in self._unreachable or not self.prune:
+            self._index_update(True, case)
+        return case
 
+    def unregister(self, case):
         """
+        Remove a case, given the :class:`Case` handle that :func:`register`
+        returned. The dispatch index is updated in place, so the cost doesn't
+        depend on how many other cases there are:
+
+            >>> m = Matcher()
+            >>> one = m.register('1', lambda: 'one')
+            >>> any = m.register('_', lambda: 'any')
+            >>> m(1)
+            'one'
+            >>> m.unregister(one)
+            >>> m(1)
+            'any'
+
+        :raises: ValueError -- if the case isn't registered in this matcher
+
+        """
+        position = self._position(case)
+        del self.bindings[position]
+        del self._cases_in_order[position]
+        active = case not in self._unreachable or not self.prune
+        self._unreachable.pop(case, None)
+        if active:
+            self._index_update(False, case)
+        if self.analyze:
+            self._recheck_shadowed(case)
+
+    def replace(self, case, pattern, handler):
+        """
+        Replace the pattern and handler of a case, keeping its position (and
+        its :class:`Case` handle):
+
+            >>> m = Matcher()
+            >>> small = m.register('1', lambda: 'one')
+            >>> rest = m.register('x', lambda x: x)
+            >>> m.replace(small, '1 | 2', lambda: 'small')
+            >>> m(2)
+            'small'
+
+        :raises: ValueError -- if the case isn't registered in this matcher
+
+        """
+        position = self._position(case)
+        pattern = self._prepare(pattern, handler)
+        plan = _call_plan(pattern, handler, self.extra_args)
+        if case not in self._unreachable or not self.prune:
+            self._index_update(False, case)
+        self._unreachable.pop(case, None)
+        case.pattern, case.handler, case.plan = pattern, handler, plan
+        self.bindings[position] = (pattern, handler)
+        if self.analyze:
+            self._check_reachable(case, position)
+        if case not in self._unreachable or not self.prune:
+            self._index_update(True, case)
+        if self.analyze:
+            self._recheck_shadowed(case)
+            self._check_shadowing(case, position)
+
+    def batch(self):
+        """
+        Context manager that groups updates: the dispatch index is patched
+        once, when the block exits (or before matching an object inside it).
+        If the block changes many of the cases, the index is rebuilt instead.
+
+            >>> m = Matcher()
+            >>> with m.batch():
+            ...     cases = [m.register(str(i), lambda i=i: i)
+            ...         for i in range(3)]
+            ...     m.unregister(cases[0])
+            >>> len(m.bindings)
+            2
+
+        """
+        return _BatchUpdate(self)
+
+    def _prepare(self, pattern, handler):
         if isinstance(pattern, _basestring):
             pattern = self.parser(pattern)
-        self.bindings.append((pattern, handler))
+        pattern = optimizer.unbind(pattern, handler)
+        if self.optimize:
+            pattern = optimizer.optimize(pattern, dump=self.dump)
+        return self._patterns.share(pattern)
+
+    def _position(self, case):
+        cases = self._cases_in_order
+        position = bisect.bisect_left(cases, case)
+        if position == len(cases) or cases[position] is not case:
+            raise ValueError('%r is not a case of this matcher' % (case,))
+        return position
+
+    def _index_update(self, add, case):
+        if self._index is None:
+            return
+        # the pattern is recorded, since :func:`replace` changes the case's
+        # before a batch is flushed
+        if self._pending is not None:
+            self._pending.append((add, case, case.pattern))
+        elif add:
+            self._index.add(case, case.pattern)
+        else:
+            self._index.remove(case, case.pattern)
+
+    def _flush(self):
+        """Apply the index updates of a batch."""
+        pending = self._pending
+        if not pending or self._index is None:
+            del pending[:]
+            return
+        if len(pending) > len(self._cases_in_order) // 2:
+            self._index = None
+        else:
+            for add, case, pattern in pending:
+                if add:
+                    self._index.add(case, pattern)
+                else:
+                    self._index.remove(case, pattern)
+        del pending[:]
+
+    def _check_reachable(self, case, position):
+        """Check `case`, at `position`, against the earlier cases."""
+        loosely = None
+        for earlier_position in range(position):
+            earlier = self._cases_in_order[earlier_position]
+            if earlier in self._unreachable:
+                continue
+            if analysis.subsumes(earlier.pattern, case.pattern):
+                analysis.warn_unreachable(position, earlier_position,
+                        case.pattern, earlier.pattern, stacklevel=3)
+                self._unreachable[case] = earlier
+                return
+            if loosely is None and analysis.subsumes(earlier.pattern,
+                    case.pattern, loose=True):
+                loosely = earlier_position
+        if loosely is not None:
+            # still reachable by equal objects of other types, so kept
+            analysis.warn_unreachable(position, loosely, case.pattern,
+                    self._cases_in_order[loosely].pattern, stacklevel=3,
+                    loose=True)
+
+    def _recheck_shadowed(self, case):
+        """Check again the cases that `case` used to shadow."""
+        shadowed = [c for (c, shadowing) in self._unreachable.items()
+                if shadowing is case]
+        for other in sorted(shadowed):
+            del self._unreachable[other]
+            self._check_reachable(other, self._position(other))
+            if other not in self._unreachable and self.prune:
+                self._index_update(True, other)
+
+    def _check_shadowing(self, case, position):
+        """Check whether `case` now shadows any of the cases after it."""
+        if case in self._unreachable:
+            return
+        for later_position in range(position + 1, len(self._cases_in_order)):
+            later = self._cases_in_order[later_position]
+            if later in self._unreachable:
+                continue
+            if analysis.subsumes(case.pattern, later.pattern):
+                analysis.warn_unreachable(later_position, position,
+                        later.pattern, case.pattern, stacklevel=3)
+                self._unreachable[later] = case
+                if self.prune:
+                    self._index_update(False, later)
+            elif analysis.subsumes(case.pattern, later.pattern, loose=True):
+                analysis.warn_unreachable(later_position, position,
+                        later.pattern, case.pattern, stacklevel=3, loose=True)
 
     def match(self, obj, *args):
         """
@@ -116,6 +915,8 @@ class Matcher(object):
         :param args: the extra positional arguments that the handler function
             will get called with
         :raises: NoMatch -- if none of the patterns can match de object
+        :raises: TypeError -- if not given the matcher's `extra_args`, when
+            it declares them
 
         Example:
 
@@ -129,11 +930,203 @@ class Matcher(object):
             ('numbers', 1, (2, 3))
 
         """
-        for pattern, handler in self.bindings:
-            match = pattern << obj
+        return self._run(obj, args, _RAISE)
+
+    def try_match(self, obj, *args, **kwargs):
+        """
+        Like :func:`match`, but return a default value instead of raising
+        :class:`NoMatch` when none of the patterns can match the object (even
+        after a :class:`TailCall`), so misses cost no exception:
+
+            >>> m = Matcher([('x:int', lambda x: x + 1)])
+            >>> m.try_match(1)
+            2
+            >>> m.try_match('a')
+            NO_MATCH
+            >>> m.try_match('a', default=None)
+
+        :param default: the value returned when nothing matches, defaults to
+            :data:`NO_MATCH`
+
+        """
+        default = kwargs.pop('default', NO_MATCH)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s' %
+                    ', '.join(kwargs))
+        return self._run(obj, args, default)
+
+    def _run(self, obj, args, default):
+        matcher = self
+        while True:
+            if (matcher.extra_args is not None and
+                    len(args) != matcher.extra_args):
+                _wrong_arity(matcher.extra_args, args)
+            found = matcher._find(obj)
+            if found is None:
+                if default is _RAISE:
+                    raise NoMatch(obj=obj)
+                return default
+            case, match = found
+            plan = case.plan
+            if plan.values is None or len(args) != plan.leading:
+                result = plan.call(case.handler, args, match.ctx)
+            elif args:
+                result = case.handler(*(tuple(args) + plan.values(match.ctx)))
+            else:
+                result = case.handler(*plan.values(match.ctx))
+            if result.__class__ is not TailCall:
+                return result
+            matcher, obj, args = result.matcher, result.obj, result.args
+
+    def _find(self, obj):
+        """The first case that matches `obj` and its match, or `None`."""
+        if self._patterns.memoizing:
+            with Memo():
+                return self._find_unmemoized(obj)
+        return self._find_unmemoized(obj)
+
+    def _find_unmemoized(self, obj):
+        for case in self._cases(obj):
+            match = case.pattern << obj
             if match:
-                return handler(*args, **match.ctx)
-        raise NoMatch('no registered pattern could match %s' % repr(obj))
+                return case, match
+        return None
+
+    def _cases(self, obj):
+        """The registered cases that may match `obj`, in order."""
+        if self._pending:
+            self._flush()
+        index = self._index
+        if index is None:
+            index = self._index = _build_index(self._active_cases())
+        return index.cases(obj)
+
+    def _active_cases(self):
+        """The cases in the dispatch path, i.e. without pruned ones."""
+        return [case for case in self._cases_in_order
+                if not self.prune or case not in self._unreachable]
+
+    def _active_bindings(self):
+        """The bindings in the dispatch path, i.e. without pruned ones."""
+        return [(case.pattern, case.handler) for case in self._active_cases()]
+
+    def tailcall(self, obj, *args):
+        """
+        Build a :class:`TailCall` marker. When a handler returns it, the
+        running :func:`match` goes on matching `obj` with this matcher (and
+        `args` as the extra handler arguments) in a loop instead of recursing,
+        so tail-recursive matchers run in constant stack depth:
+
+            >>> length = Matcher()
+            >>> @length.handler('_ :: tail')
+            ... def _nonempty(acc, tail):
+            ...     return length.tailcall(tail, acc + 1)
+            >>> @length.handler('[]')
+            ... def _empty(acc):
+            ...     return acc
+            >>> length([None] * 10000, 0)
+            10000
+
+        Tail calls can also jump to other matchers, for mutually recursive
+        definitions.
+
+        """
+        return TailCall(self, obj, args)
+
+    def amatch(self, obj, *args):
+        """
+        Asynchronous version of :func:`match`. Pattern evaluation is still
+        synchronous; if the handler returns an awaitable (e.g. it was defined
+        with `async def`), it gets awaited.
+
+        :returns: a coroutine that resolves to the handler's result.
+        :raises: NoMatch -- when awaited, if none of the patterns can match the
+            object
+
+        .. note:: requires Python 3.6 or later, see :mod:`pyfpm.aio`.
+
+        """
+        from pyfpm.aio import amatch
+        return amatch(self, obj, *args)
+
+    def adispatch(self, iterable, *args, **kwargs):
+        """
+        Match every object in an (async) iterable and yield the handler
+        results, in order, as an async iterator. At most `concurrency` handler
+        awaitables are in flight at any time, and no new objects are pulled
+        from `iterable` while that limit is reached.
+
+        :param iterable: an async iterable or a regular iterable
+        :param args: the extra positional arguments for the handler functions
+        :param concurrency: int -- maximum number of pending handler
+            awaitables, defaults to 1
+
+        .. note:: requires Python 3.6 or later, see :mod:`pyfpm.aio`.
+
+        """
+        from pyfpm.aio import adispatch
+        return adispatch(self, iterable, *args, **kwargs)
+
+    def match_columns(self, columns, dispatch=False, args=()):
+        """
+        Match a batch of homogeneous tuples given in columnar form, evaluating
+        the patterns and guards that allow it as vectorized masks.
+
+        :param columns: a sequence of one-dimensional NumPy arrays, one per
+            tuple position, or a structured array (one column per field)
+        :param dispatch: bool -- if true, call the handler of the winning
+            case for each row
+        :param args: tuple -- the extra positional arguments for the handler
+            functions, when dispatching
+        :returns: an int array with the position in `bindings` of the
+            winning case for each row, -1 if none matches; or the list of
+            handler results if `dispatch` is true.
+        :raises: NoMatch -- when dispatching, if a row has no matching case
+
+        .. note:: requires NumPy, see :mod:`pyfpm.vectorized`.
+
+        """
+        from pyfpm.vectorized import match_columns
+        return match_columns(self, columns, dispatch, args)
+
+    def load(self, source, processes=None):
+        """
+        Register the cases in a pattern table file, with one
+        `pattern => handler` line per case. See :mod:`pyfpm.loader`.
+
+        :param source: a path, or a file-like object open in text mode
+        :param processes: if given, parse the patterns in a pool of that many
+            worker processes (0 for one per CPU)
+        :returns: the list of the :class:`Case` handles of the new cases
+        :raises: pyfpm.loader.LoadError -- listing every line that can't be
+            parsed or whose handler can't be found; no case is registered
+            then
+
+        """
+        from pyfpm.loader import load
+        return load(self, source, processes)
+
+    def compact(self):
+        """
+        Compile the current cases into a
+        :class:`pyfpm.compact.CompactMatcher`, which stores them as flat
+        arrays of instructions instead of pattern objects, for very large
+        matchers. See :mod:`pyfpm.compact`.
+
+        """
+        from pyfpm.compact import CompactMatcher
+        return CompactMatcher(self._active_bindings(), self.extra_args)
+
+    def explain(self, *objects):
+        """
+        Profile the matching of a sample of objects, node by node, without
+        calling any handler. See :mod:`pyfpm.explain`.
+
+        :returns: a list with the :class:`pyfpm.explain.Explanation` of each
+            case
+        """
+        from pyfpm.explain import explain_matcher
+        return explain_matcher(self, *objects)
 
     def __call__(self, obj, *args):
         """
@@ -179,13 +1172,15 @@ class Matcher(object):
                 ','.join('='.join((str(k), repr(v)))
                     for (k, v) in self.__dict__.items()))
 
-def match_args(pattern, context=None):
+def match_args(pattern, context=None, default=_RAISE):
     """
     Decorator for matching a function's arglist.
 
     :param pattern: Pattern or str -- the pattern
     :param context: dict -- an optional context for the pattern parser. If
         absent, it defaults to the caller's `globals()`.
+    :param default: if given, the decorated function returns it instead of
+        raising :class:`NoMatch` when the arguments don't match.
 
     Usage:
 
@@ -194,6 +1189,10 @@ def match_args(pattern, context=None):
         ...     return (head, tail)
         >>> do_something(1, 2, 3, 4)
         (1, (2, 3, 4))
+        >>> @match_args('[x:int]', default=None)
+        ... def inc(x):
+        ...     return x + 1
+        >>> inc('a')
 
     """
     if isinstance(pattern, _basestring):
@@ -201,25 +1200,100 @@ def match_args(pattern, context=None):
             context = _get_caller_globals()
         pattern = Parser(context)(pattern)
     def wrapper(function):
+        unbound = optimizer.unbind(pattern, function)
         @wraps(function)
         def f(*args):
-            match = pattern.match(args)
+            match = unbound.match(args)
             if not match:
-                raise NoMatch("%s doesn't match %s" % (pattern, args))
+                if default is _RAISE:
+                    raise NoMatch(obj=args, pattern=pattern)
+                return default
             return function(**match.ctx)
         return f
     return wrapper
 
+# parsed patterns by call site: (code, offset, pattern string) ->
+# (globals, pattern, names)
+_call_sites = {}
+_CALL_SITES_SIZE = 1024
+# parsers by id() of the globals they resolve names in
+_parsers = {}
+
+def _parse_at_call_site(pattern, depth):
+    """
+    Parse a string pattern in the globals of the function `depth` frames
+    above the caller, once per call site: the parsed pattern and the names
+    it binds are cached under the calling code object and bytecode offset.
+
+    """
+    try:
+        frame = sys._getframe(depth + 1)
+    except AttributeError:
+        context = _get_caller_globals()
+        pattern = Parser(context)(pattern)
+        return pattern, _bound_names(pattern)
+    key = (frame.f_code, frame.f_lasti, pattern)
+    context = frame.f_globals
+    entry = _call_sites.get(key)
+    if entry is None or entry[0] is not context:
+        entry = _parsers.get(id(context))
+        if entry is None or entry[0] is not context:
+            entry = _parsers[id(context)] = (context, Parser(context))
+        parsed = entry[1](pattern)
+        if len(_call_sites) >= _CALL_SITES_SIZE:
+            _call_sites.clear()
+        entry = _call_sites[key] = (context, parsed, _bound_names(parsed))
+    return entry[1], entry[2]
+
+def unpack(pattern, obj, default=_RAISE):
+    """
+    Match `obj` with `pattern` and return the bound values as a tuple, in the
+    order in which their names first appear in the pattern:
+
+        >>> x, y, z = unpack('[x, [y, z]]', (1, (2, 3)))
+        >>> x, y, z
+        (1, 2, 3)
+        >>> unpack('[x:int]', ('a',), default=None)
+
+    String patterns are parsed in the caller's `globals()` the first time
+    each call site runs, and taken from a cache afterwards, so unpacking in a
+    loop doesn't pay for parsing.
+
+    :param pattern: Pattern or str -- the pattern
+    :param obj: the object to unpack
+    :param default: if given, it's returned instead of raising
+        :class:`NoMatch` when `obj` doesn't match
+    :returns: a tuple with the value of each bound name
+
+    """
+    if isinstance(pattern, _basestring):
+        pattern, names = _parse_at_call_site(pattern, 1)
+    else:
+        names = _bound_names(pattern)
+    match = pattern.match(obj)
+    if not match:
+        if default is _RAISE:
+            raise NoMatch(obj=obj, pattern=pattern)
+        return default
+    ctx = match.ctx
+    return tuple(ctx.get(name) for name in names)
+
 class _UnpackerHelper(object):
     def __init__(self, vars, pattern):
         self.vars = vars
         self.pattern = pattern
 
     def _do(self, other):
+        if not self.try_unpack(other):
+            raise NoMatch(obj=other, pattern=self.pattern)
+
+    def try_unpack(self, other):
+        """Unpack `other` if it matches, and return whether it did."""
         match = self.pattern.match(other)
         if not match:
-            raise NoMatch("%s doesn't match %s" % (self.pattern, other))
+            return False
         self.vars.update(match.ctx)
+        return True
 
     def __lshift__(self, other):
         return self._do(other)
@@ -237,10 +1311,23 @@ class Unpacker(object):
         >>> unpacker.z
         3
 
+    To test and unpack at once, without raising :class:`NoMatch`:
+
+        >>> unpacker('[a, b]').try_unpack((1, 2, 3))
+        False
+        >>> unpacker('[a, b]').try_unpack((1, 2))
+        True
+        >>> unpacker.a
+        1
+
+    String patterns parsed in the caller's `globals()` are cached per call
+    site, so only the first call from each place in the code parses them.
+
     """
     def __call__(self, pattern, context=None):
         if isinstance(pattern, _basestring):
             if context is None:
-                context = _get_caller_globals()
-            pattern = Parser(context)(pattern)
+                pattern = _parse_at_call_site(pattern, 1)[0]
+            else:
+                pattern = Parser(context)(pattern)
         return _UnpackerHelper(self.__dict__, pattern)
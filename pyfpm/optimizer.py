@@ -0,0 +1,323 @@
+"""
+Optimization passes over pattern trees.
+
+Parsed patterns mirror their source literally. :func:`optimize` runs them
+through a pipeline of passes that rewrite them into equivalent trees that
+are cheaper to match: nested alternatives are flattened, `_` checks that
+can't fail are skipped, independent sibling checks are reordered so that the
+cheap ones run first, and sequence patterns reject objects of the wrong
+length with a single `len()` call before looking at any item:
+
+    >>> from pyfpm.parser import Parser
+    >>> pattern = Parser()("[1 | (2 | 3), _, {'a': /a+/, 'b': _:str}]")
+    >>> print(format_tree(optimize(pattern)))
+    ListPattern len=3
+      OrPattern
+        EqualsPattern(obj=1)
+        EqualsPattern(obj=2)
+        EqualsPattern(obj=3)
+      ListPattern len=2 skip=head
+        AnyPattern
+        ListPattern len=1
+          MappingPattern
+            InstanceOfPattern(cls=str)
+            RegexPattern(regex=re.compile('a+'))
+          ListPattern len=0
+
+:class:`pyfpm.matcher.Matcher` optimizes every registered pattern, unless
+created with `optimize=False`, after dropping the names its handler doesn't
+use with :func:`unbind`.
+
+Each pass is a function that takes a pattern node and returns its
+replacement. Passes are applied bottom-up to copies of the nodes, after the
+node's sub-patterns have been rewritten, so they're free to modify the node
+they get. The default pipeline is :data:`PASSES`, and any other sequence of
+passes can be given to :func:`optimize`.
+
+"""
+import copy
+import inspect
+import types
+
+from pyfpm.analysis import _walk
+from pyfpm.explain import _condition_label, _label
+from pyfpm.pattern import (_is_noop, _postorder, AnyPattern, EqualsPattern,
+        InstanceOfPattern, RegexPattern, StructPattern, ListPattern,
+        NamedTuplePattern, MappingPattern, ClassPattern, OrPattern)
+
+def _is_plain(pattern):
+    return pattern.bound_name is None and pattern.condition is None
+
+def flatten_alternatives(pattern):
+    """
+    Inline the alternatives of nested alternatives that neither bind a name
+    nor have a condition, drop repeated alternatives, and replace plain
+    alternatives left with a single branch by that branch.
+
+    """
+    if pattern.__class__ is not OrPattern:
+        return pattern
+    alternatives = []
+    for alternative in pattern.patterns:
+        if alternative.__class__ is OrPattern and _is_plain(alternative):
+            branches = alternative.patterns
+        else:
+            branches = (alternative,)
+        alternatives.extend(branch for branch in branches
+                if branch not in alternatives)
+    if len(alternatives) == 1:
+        if _is_plain(pattern):
+            return alternatives[0]
+        return pattern
+    return pattern._with_children(alternatives)
+
+def skip_noops(pattern):
+    """
+    Skip the `_` sub-patterns that don't bind a name or have a condition,
+    since they always match, and the alternatives that follow one of them,
+    since they're never tried.
+
+    """
+    if isinstance(pattern, ListPattern) and pattern.head_pattern is not None:
+        pattern._skip_head = _is_noop(pattern.head_pattern)
+        pattern._skip_tail = _is_noop(pattern.tail_pattern)
+    elif pattern.__class__ is OrPattern:
+        alternatives = []
+        for alternative in pattern.patterns:
+            alternatives.append(alternative)
+            if _is_noop(alternative):
+                break
+        if len(alternatives) < len(pattern.patterns):
+            if len(alternatives) > 1:
+                return pattern._with_children(alternatives)
+            if _is_plain(pattern):
+                return alternatives[0]
+    return pattern
+
+# the relative cost of matching one node of each type, excluding its
+# sub-patterns
+_COSTS = {
+    AnyPattern: 0,
+    EqualsPattern: 1,
+    InstanceOfPattern: 1,
+    StructPattern: 2,
+    RegexPattern: 4,
+}
+_DEFAULT_COST = 2
+_CONDITION_COST = 8
+
+def cost(pattern):
+    """
+    The estimated relative cost of matching `pattern`: type and constant
+    checks are the cheapest, then structures, then regular expressions, and
+    conditions the most expensive.
+
+    """
+    return sum(_COSTS.get(node.__class__, _DEFAULT_COST) +
+            (_CONDITION_COST if node.condition is not None else 0)
+            for node in _walk(pattern))
+
+def _check_order(patterns):
+    """
+    The positions of `patterns`, cheapest first. Those that contain
+    conditions go last, in their original order, since they may depend on
+    names bound by the ones before them.
+
+    """
+    conditional = set(i for (i, pattern) in enumerate(patterns)
+            if any(node.condition is not None for node in _walk(pattern)))
+    unconditional = sorted((i for i in range(len(patterns))
+        if i not in conditional), key=lambda i: cost(patterns[i]))
+    return unconditional + sorted(conditional)
+
+def reorder_checks(pattern):
+    """
+    Reorder the independent sub-patterns of named tuple, class and mapping
+    patterns, so that the cheapest ones are checked first and expensive ones
+    only run on objects that passed them.
+
+    """
+    if pattern.__class__ is NamedTuplePattern and pattern.field_patterns:
+        order = _check_order(pattern.field_patterns)
+        if order != sorted(order):
+            pattern._order = tuple(order)
+            pattern._checks = pattern._field_checks()
+    elif pattern.__class__ is ClassPattern and pattern.attributes:
+        order = _check_order([p for (name, p) in pattern.attributes])
+        if order != sorted(order):
+            pattern._order = tuple(order)
+            pattern._checks = tuple(pattern.attributes[i] for i in order)
+    elif pattern.__class__ is MappingPattern:
+        items = list(pattern.mapping.items())
+        order = _check_order([p for (key, p) in items])
+        pattern.mapping = dict(items[i] for i in order)
+    return pattern
+
+def _length_bounds(pattern):
+    if pattern.__class__ is not ListPattern:
+        return 0, None
+    if pattern._lengths is not None:
+        return pattern._lengths
+    if pattern.head_pattern is None:
+        return 0, 0
+    low, high = _length_bounds(pattern.tail_pattern)
+    return low + 1, None if high is None else high + 1
+
+def check_lengths(pattern):
+    """
+    Compute the minimum and maximum length of the sequences matched by each
+    sequence pattern, so that objects of any other length get rejected with
+    a single `len()` call instead of item by item.
+
+    """
+    if pattern.__class__ is ListPattern:
+        low, high = _length_bounds(pattern)
+        if high is not None or low > 1:
+            pattern._lengths = low, high
+    return pattern
+
+PASSES = (flatten_alternatives, skip_noops, reorder_checks, check_lengths)
+
+def _rewrite(pattern, function):
+    def rebuild(node, children):
+        if children:
+            return function(node._with_children(children))
+        return function(copy.copy(node))
+    return _postorder(pattern, rebuild)
+
+def _annotations(pattern):
+    annotations = []
+    lengths = getattr(pattern, '_lengths', None)
+    if lengths is not None:
+        low, high = lengths
+        if high is None:
+            annotations.append('len>=%d' % low)
+        elif low == high:
+            annotations.append('len=%d' % low)
+        else:
+            annotations.append('len=%d..%d' % (low, high))
+    if isinstance(pattern, ListPattern) and pattern.head_pattern is not None:
+        skipped = [part for (part, skip) in (('head', pattern._skip_head),
+            ('tail', pattern._skip_tail)) if skip]
+        if skipped:
+            annotations.append('skip=%s' % (','.join(skipped) or '-'))
+    order = getattr(pattern, '_order', None)
+    if order is not None:
+        annotations.append('order=%s' % ','.join(map(str, order)))
+    return annotations
+
+def format_tree(pattern):
+    """
+    A pattern tree, one node per line, with the annotations added by the
+    optimizer.
+
+    """
+    lines = []
+    stack = [(pattern, 0)]
+    while stack:
+        node, depth = stack.pop()
+        lines.append('  ' * depth + ' '.join([_label(node)] +
+            _annotations(node)))
+        if node.condition is not None:
+            lines.append('  ' * (depth + 1) + _condition_label(node.condition))
+        stack.extend((child, depth + 1)
+                for child in reversed(node.children()))
+    return '\n'.join(lines)
+
+def _code_names(code):
+    """The global names a code object (or the ones nested in it) use."""
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            names.update(_code_names(constant))
+    return names
+
+def _accepted_names(function):
+    """
+    The names of the keyword arguments `function` accepts, or `None` if it
+    takes any keyword argument or its signature can't be inspected.
+
+    """
+    code = getattr(function, 'code', None)
+    if isinstance(code, types.CodeType):
+        # a condition parsed from an `if` clause
+        return frozenset(_code_names(code))
+    try:
+        signature = inspect.signature(function)
+    except AttributeError:
+        # python 2.x
+        try:
+            spec = inspect.getargspec(function)
+        except TypeError:
+            return None
+        return None if spec.keywords else frozenset(spec.args)
+    except (TypeError, ValueError):
+        return None
+    names = []
+    for parameter in signature.parameters.values():
+        if parameter.kind == parameter.VAR_KEYWORD:
+            return None
+        if parameter.kind in (parameter.POSITIONAL_OR_KEYWORD,
+                parameter.KEYWORD_ONLY):
+            names.append(parameter.name)
+    return frozenset(names)
+
+def unbind(pattern, handler):
+    """
+    Drop the names bound by `pattern` that `handler` doesn't take as
+    arguments, so that their values (tail slices, regular expression
+    groups...) aren't computed while matching:
+
+        >>> from pyfpm.parser import Parser
+        >>> pattern = Parser()('head :: tail')
+        >>> unbound = unbind(pattern, lambda head: head)
+        >>> unbound.head_pattern.bound_name, unbound.tail_pattern.bound_name
+        ('head', None)
+
+    Names bound more than once are kept, since they only match equal values,
+    and so are the names the pattern's conditions take. Handlers that take
+    `**kwargs` get every name. The pattern itself is left untouched.
+
+    """
+    keep = _accepted_names(handler)
+    if keep is None:
+        return pattern
+    keep = set(keep)
+    bound = set()
+    for node in _walk(pattern):
+        if node.condition is not None:
+            names = _accepted_names(node.condition)
+            if names is None:
+                return pattern
+            keep.update(names)
+        if node.bound_name is not None:
+            if node.bound_name in bound:
+                keep.add(node.bound_name)
+            bound.add(node.bound_name)
+    if bound <= keep:
+        return pattern
+    def drop(node):
+        if node.bound_name is not None and node.bound_name not in keep:
+            node.bound_name = None
+        return node
+    return _rewrite(pattern, drop)
+
+def optimize(pattern, passes=PASSES, dump=None):
+    """
+    Run `pattern` through a pipeline of optimization passes. The pattern
+    itself is left untouched.
+
+    :param pattern: Pattern -- the pattern to optimize
+    :param passes: the passes to run, in order
+    :param dump: an optional file-like object to write the tree before and
+        after the optimization to
+    :returns: the optimized pattern
+
+    """
+    result = pattern
+    for function in passes:
+        result = _rewrite(result, function)
+    if dump is not None:
+        dump.write('before:\n%s\nafter:\n%s\n' % (format_tree(pattern),
+            format_tree(result)))
+    return result
@@ -1,24 +1,40 @@
 """
 Scala-like pattern syntax parser.
 """
-import re
+import ast
+import importlib
 import inspect
+import pickle
+import re
+import sys
+
+try:
+    import builtins
+except ImportError:
+    # python 2.x
+    import __builtin__ as builtins
 
 from pyparsing import Literal, Word, Group, Combine, Suppress,\
         Forward, Optional, alphas, nums, alphanums, QuotedString,\
         quotedString, dblQuotedString, removeQuotes, delimitedList,\
-        ParseException, Keyword, restOfLine, ParseFatalException
+        ParseException, Keyword, restOfLine, ParseFatalException, MatchFirst
 
-from pyfpm.pattern import build as _
+from pyfpm.pattern import build as _, _MISSING, MappingPattern,\
+        ClassPattern, StructPattern, STRUCT_FIELDS, OrPattern, _postorder
 
 def _get_caller_globals():
-    frame = inspect.getouterframes(inspect.currentframe())[2][0]
+    try:
+        frame = sys._getframe(2)
+    except AttributeError:
+        # python implementations without sys._getframe
+        frame = inspect.getouterframes(inspect.currentframe())[2][0]
     return frame.f_globals
 
 class _IfCondition(object):
-    def __init__(self, code, context):
+    def __init__(self, code, context, source=None):
         self.code = code
         self.context = context
+        self.source = source
 
     def __call__(self, **kwargs):
         return eval(self.code, self.context, kwargs)
@@ -26,12 +42,138 @@ class _IfCondition(object):
     def __eq__(self, other):
         return (isinstance(other, _IfCondition) and
                 self.__dict__ == other.__dict__)
+
+    def __hash__(self):
+        return hash(self.code)
     
     def __str__(self):
         return '_IfCondition(code=%s, context=%s)' % (
                 self.code,
                 self.context)
 
+    def __reduce__(self):
+        # code objects and globals can't be pickled, so the condition is
+        # compiled again from its source in the module it was parsed in
+        name = self.context.get('__name__')
+        module = sys.modules.get(name)
+        if (self.source is None or module is None or
+                module.__dict__ is not self.context):
+            raise pickle.PicklingError('condition %s is not defined in the '
+                    'globals of a module' % self.source)
+        return _load_condition, (self.source, name)
+
+def _load_condition(source, module_name):
+    context = importlib.import_module(module_name).__dict__
+    return _IfCondition(compile(source, '<pattern_condition>', 'eval'),
+            context, source)
+
+def _bound_names(pattern):
+    names = []
+    stack = [pattern]
+    while stack:
+        node = stack.pop()
+        if node.bound_name is not None and node.bound_name not in names:
+            names.append(node.bound_name)
+        stack.extend(reversed(node.children()))
+    return names
+
+def _always_bound(pattern):
+    """The names `pattern` binds whenever it matches, i.e. without those
+    bound by only some of the alternatives of an :class:`OrPattern`."""
+    def names(node, children):
+        if node.__class__ is OrPattern:
+            bound = frozenset.intersection(*children)
+        else:
+            bound = frozenset().union(*children)
+        if node.bound_name is not None:
+            bound |= frozenset((node.bound_name,))
+        return bound
+    return _postorder(pattern, names)
+
+def _binding_nodes(pattern):
+    """
+    The nodes of `pattern` that bind names, in matching order, the position
+    of the node that binds each name first, and the names that may be bound
+    before that, or at all, by only some alternatives. Names bound by every
+    alternative count as bound by the whole
+    :class:`pyfpm.pattern.OrPattern`, whose branches are not looked into.
+
+    """
+    nodes = []
+    positions = {}
+    maybe = set()
+    stack = [(pattern, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if isinstance(node, OrPattern):
+            always = _always_bound(node)
+            bound = [name for name in _bound_names(node) if name in always]
+            maybe.update(name for name in _bound_names(node)
+                    if name not in always and name not in positions)
+        elif expanded:
+            bound = [node.bound_name] if node.bound_name is not None else []
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.children()))
+            continue
+        bound = [name for name in bound if name not in positions]
+        if bound:
+            for name in bound:
+                positions[name] = len(nodes)
+            nodes.append(node)
+    return nodes, positions, maybe
+
+def _hoist_condition(pattern, source, context):
+    """
+    Attach the condition in `source` to `pattern`, splitting it into its
+    `and` conjuncts and moving each one down to the node that binds the last
+    of the pattern names it uses, so that it's checked as soon as possible.
+    The conjuncts are still evaluated in their original order.
+
+    """
+    tree = ast.parse(source, mode='eval').body
+    conjuncts = [tree]
+    if (isinstance(tree, ast.BoolOp) and isinstance(tree.op, ast.And) and
+            hasattr(ast, 'get_source_segment')):
+        conjuncts = tree.values
+    nodes, positions, maybe = _binding_nodes(pattern)
+    def position_of(name):
+        if name in positions:
+            return positions[name]
+        # names some alternatives may bind are left for the whole pattern
+        if name in maybe:
+            return len(nodes)
+        if name in context or hasattr(builtins, name):
+            return 0
+        # unknown names are left for the whole pattern to fail on
+        return len(nodes)
+    groups = []
+    position = 0
+    for conjunct in conjuncts:
+        position = max([position] + [position_of(node.id)
+            for node in ast.walk(conjunct) if isinstance(node, ast.Name)])
+        target = nodes[position] if position < len(nodes) else pattern
+        if len(conjuncts) == 1:
+            segment = source
+        else:
+            segment = ast.get_source_segment(source, conjunct)
+        if groups and groups[-1][0] is target:
+            groups[-1][1].append(segment)
+        else:
+            groups.append((target, [segment]))
+    for target, segments in groups:
+        if len(segments) > 1:
+            segments = ['(%s)' % segment for segment in segments]
+        group_source = ' and '.join(segments)
+        code = compile(group_source, '<pattern_condition>', 'eval')
+        target.if_(_IfCondition(code, context, group_source))
+    return pattern
+
+class _KeywordArg(object):
+    def __init__(self, name, pattern):
+        self.name = name
+        self.pattern = pattern
+
 def Parser(context=None):
     """
     Create a parser.
@@ -91,6 +233,11 @@ def Parser(context=None):
         >>> parser('a::b::c') << (0, 1, 2, 3, 4)
         Match({'a': 0, 'c': (2, 3, 4), 'b': 1})
 
+    split strings by a constant prefix:
+
+        >>> parser("'GET ' :: path") << 'GET /index.html'
+        Match({'path': '/index.html'})
+
     match named tuples (as if they were Scala case classes)
 
         >>> try:
@@ -103,6 +250,36 @@ def Parser(context=None):
         ...     Match({'y': 2, 'x': 1, 'z': 3}) # no namedtuple in python < 2.6
         Match({'y': 2, 'x': 1, 'z': 3})
 
+    match mappings by looking up only the given keys:
+
+        >>> parser("{'type': 'order', 'items': [_, _]}") << {
+        ...     'type': 'order', 'id': 1, 'items': ('a', 'b')}
+        Match({})
+        >>> parser("{'id': n:int}") << {'id': 1}
+        Match({'n': 1})
+        >>> parser("{'id': n:int}") << {'id': 'abc'}
+
+    match other objects by attribute, positionally through their
+    `__match_args__` (or dataclass fields, or `__slots__`) or by keyword:
+
+        >>> class Point(object):
+        ...     __match_args__ = ('x', 'y')
+        ...     def __init__(self, x, y):
+        ...         self.x, self.y = x, y
+        >>> parser = Parser() # Point has to be in the context
+        >>> parser('Point(0, y:int)') << Point(0, 1)
+        Match({'y': 1})
+        >>> parser('Point(y=0)') << Point(1, 0)
+        Match({})
+
+    match binary data with bytes constants and fixed-width fields (`u8`,
+    `i16le`, `u32be`, `f64be`...), binding the rest as a memoryview:
+
+        >>> m = parser(r"b'\\x01' :: length:u16be :: payload") << (
+        ...     b'\\x01\\x00\\x03abc')
+        >>> m.ctx['length'], bytes(m.ctx['payload'])
+        (3, b'abc')
+
     boolean or between expressions:
 
         >>> parser('a:int|b:str') << 1
@@ -124,14 +301,27 @@ def Parser(context=None):
     if context is None:
         context = _get_caller_globals()
 
+    # type name -> (type or error message, the object its first component
+    # named when it was resolved)
+    types = {}
+
     # parsing actions
     def get_type(type_name):
+        root = context.get(type_name.split('.', 1)[0])
         try:
-            t = eval(type_name, context)
-        except NameError:
-            raise ParseException('unknown type: %s' % type_name)
-        if not isinstance(t, type):
-            raise ParseException('not a type: %s' % type_name)
+            t, cached_root = types[type_name]
+        except KeyError:
+            cached_root = _MISSING
+        if cached_root is not root:
+            try:
+                t = eval(type_name, context)
+                if not isinstance(t, type):
+                    t = 'not a type: %s' % type_name
+            except NameError:
+                t = 'unknown type: %s' % type_name
+            types[type_name] = t, root
+        if isinstance(t, str):
+            raise ParseException(t)
         return t
 
     def get_named_var(var_name):
@@ -141,6 +331,28 @@ def Parser(context=None):
             return _()%var_name
         raise ParseException('var name clashes with type: %s' % var_name)
 
+    def class_pattern(cls, contents):
+        positional = [arg for arg in contents
+                if not isinstance(arg, _KeywordArg)]
+        keyword = dict((arg.name, arg.pattern) for arg in contents
+                if isinstance(arg, _KeywordArg))
+        if issubclass(cls, tuple) and hasattr(cls, '_fields'):
+            if not keyword:
+                return _(cls(*positional))
+            fields = list(positional) + [_()] * (
+                    len(cls._fields) - len(positional))
+            for name, pattern in keyword.items():
+                try:
+                    fields[cls._fields.index(name)] = pattern
+                except ValueError:
+                    raise ParseException('%s has no field %s' % (
+                        cls.__name__, name))
+            return _(cls(*fields))
+        try:
+            return ClassPattern(cls, *positional, **keyword)
+        except TypeError as e:
+            raise ParseException(str(e))
+
     # begin grammar
     type_ = Word(alphas, alphanums + '._')('type_').setParseAction(
             lambda *args: get_type(args[-1].type_))
@@ -152,11 +364,21 @@ def Parser(context=None):
 
     untyped_var = (named_var | anon_var)('untyped_var')
 
-    typed_var = (untyped_var + Suppress(':') + type_)(
-            'typed_var').setParseAction(
-            lambda *args: _(args[-1].type_)%args[-1].untyped_var.bound_name)
+    struct_field = MatchFirst([Keyword(name)
+        for name in sorted(STRUCT_FIELDS)])
+
+    def annotated_var(*args):
+        tokens = args[-1]
+        if len(tokens) == 2:
+            untyped, annotation = tokens
+            if isinstance(annotation, type):
+                return _(annotation)%untyped.bound_name
+            return StructPattern(annotation)%untyped.bound_name
 
-    var = (typed_var | untyped_var)('var')
+    # `name`, `name:type` or `name:field`
+    var = (untyped_var + Optional(Suppress(':') +
+        (struct_field('struct_field') | type_)))('var').setParseAction(
+                annotated_var)
 
     int_const = Combine(Optional('-') + Word(nums))(
             'int_const').setParseAction(lambda *args: int(args[-1].int_const))
@@ -170,6 +392,10 @@ def Parser(context=None):
     str_const = (quotedString | dblQuotedString)('str_const').setParseAction(
             removeQuotes)
 
+    bytes_const = Combine(Literal('b') + quotedString)(
+            'bytes_const').setParseAction(
+                    lambda *args: ast.literal_eval(args[-1].bytes_const))
+
     regex_const = QuotedString(quoteChar='/', escChar='\\')('regex_const'
             ).setParseAction(lambda *args: re.compile(args[-1].regex_const))
 
@@ -177,7 +403,7 @@ def Parser(context=None):
     false = Keyword('False').setParseAction(lambda *args: _(False))
     null = Keyword('None').setParseAction(lambda *args: _(None))
 
-    const = (float_const | int_const | str_const | regex_const |
+    const = (float_const | int_const | bytes_const | str_const | regex_const |
             false | true | null)('const').setParseAction(
                     lambda *args: _(args[-1].const))
 
@@ -185,8 +411,18 @@ def Parser(context=None):
 
     pattern = Forward()
 
-    head_tail = (scalar + Suppress('::') + pattern)(
-            'head_tail').setParseAction(lambda *args: args[-1][0] + args[-1][1])
+    def optional_operand(combine):
+        # the alternatives of each rule share their first operand, so that
+        # it's only parsed once; a lone operand is left as it is
+        def action(*args):
+            tokens = args[-1]
+            if len(tokens) == 2:
+                return combine(tokens[0], tokens[1])
+        return action
+
+    head_tail = (scalar + Optional(Suppress('::') + pattern))(
+            'head_tail').setParseAction(
+                    optional_operand(lambda head, tail: head + tail))
 
     list_item = (pattern | scalar)('list_item')
 
@@ -197,30 +433,45 @@ def Parser(context=None):
 
     list_ = (head_tail | full_list)('list')
 
-    case_class = Combine(type_ + Suppress('(') + list_contents +
+    keyword_arg = (Word(alphas + '_', alphanums + '_')('keyword') +
+            Suppress('=') + list_item)('keyword_arg').setParseAction(
+                    lambda *args: _KeywordArg(*args[-1]))
+
+    class_contents = Optional(delimitedList(keyword_arg | list_item))(
+            'class_contents')
+
+    case_class = (type_ + Suppress('(') + Group(class_contents) +
             Suppress(')'))('case_class').setParseAction(
-                lambda *args: _(args[-1][0].type_(*args[-1][0].list_contents)))
+                lambda *args: class_pattern(*args[-1]))
+
+    mapping_key = (float_const | int_const | str_const)('mapping_key')
+
+    mapping_item = Group(mapping_key + Suppress(':') + list_item)(
+            'mapping_item')
+
+    mapping = (Suppress('{') + Optional(delimitedList(mapping_item)) +
+            Suppress('}'))('mapping').setParseAction(
+                    lambda *args: MappingPattern(dict(
+                        (k, v) for (k, v) in args[-1])))
 
-    scalar << (const | var | case_class |
+    scalar << (const | var | case_class | mapping |
             Suppress('(') + pattern + Suppress(')'))('scalar')
 
-    or_clause = (list_ | scalar)('or_clause')
+    or_clause = list_('or_clause')
 
-    or_expression = (or_clause + Suppress('|') + pattern)(
+    or_expression = (or_clause + Optional(Suppress('|') + pattern))(
             'or_expression').setParseAction(
-                    lambda *args: args[-1][0] | args[-1][1])
+                    optional_operand(lambda first, rest: first | rest))
 
     def conditional_pattern_action(*args):
         try:
             pattern, condition_string = args[-1]
-            code = compile(condition_string.strip(),
-                    '<pattern_condition>', 'eval')
-            pattern.if_(_IfCondition(code, context))
-            return pattern
+            return _hoist_condition(pattern, condition_string.strip(),
+                    context)
         except ValueError:
             pass
 
-    pattern << ((or_expression | or_clause) +
+    pattern << (or_expression +
             Optional(Suppress(Keyword('if')) + restOfLine))(
                     'pattern').setParseAction(conditional_pattern_action)
 
@@ -6,7 +6,11 @@ patterns programatically without making use of the pattern syntax parser.
 
 """
 
+import abc
+import copy
 import re
+import struct
+import threading
 
 try:
     # python 2.x base string
@@ -15,6 +19,32 @@ except NameError:
     # python 3.x base string
     _basestring = str
 
+try:
+    # python 3.3+
+    from collections.abc import Mapping as _Mapping
+except ImportError:
+    # python 2.6+
+    from collections import Mapping as _Mapping
+
+try:
+    # python 3.4+
+    _abc_token = abc.get_cache_token
+except AttributeError:
+    # python 2.x
+    def _abc_token():
+        return abc.ABCMeta._abc_invalidation_counter
+
+_MISSING = object()
+
+# binary data that :class:`BinaryPattern` and :class:`StructPattern` match
+# without copying, through memoryviews (in python 2.x, `bytes` is `str`)
+_BINARY_TYPES = (bytearray, memoryview) + (
+        (bytes,) if bytes is not str else ())
+
+# per-thread memo of the verdicts of shared sub-patterns, active while a
+# Matcher looks for the case that matches an object
+_memo_state = threading.local()
+
 class Match(object):
     """
     Represents the result of matching successfully a pattern against an
@@ -43,6 +73,9 @@ class Pattern(object):
 
     """
 
+    _memoize = False
+    _pure = False
+
     def __init__(self):
         self.bound_name = None
         self.condition = None
@@ -58,10 +91,14 @@ class Pattern(object):
         :returns: a :class:`Match` if successful, `None` otherwise.
 
         """
+        if self._memoize:
+            memo = getattr(_memo_state, 'table', None)
+            if memo is not None:
+                return self._memo_match(memo, other, ctx)
         match = self._does_match(other, ctx)
         if match:
             ctx = match.ctx
-            value = match.value or other
+            value = other if match.value is None else match.value
             if self.bound_name:
                 if ctx is None:
                     ctx = {}
@@ -74,6 +111,18 @@ class Pattern(object):
             if self.condition is None or self.condition(**ctx):
                 return Match(ctx)
         return None
+    def _memo_match(self, memo, other, ctx):
+        # only pure patterns (no names, no conditions) get memoized, so the
+        # verdict depends on nothing but the object. The object is kept in the
+        # memo so that its id can't be reused while the memo is alive.
+        key = (id(self), id(other))
+        entry = memo.get(key)
+        if entry is None:
+            entry = memo[key] = (other, bool(self._does_match(other, ctx)))
+        if entry[1]:
+            return Match(ctx)
+        return None
+
     def __lshift__(self, other):
         return self.match(other)
 
@@ -155,19 +204,104 @@ class Pattern(object):
             Match({})
             >>> p.match([1, 2])
 
+        If this pattern is a string constant, the result also splits strings
+        by prefix (see :class:`PrefixPattern`); if it's a fixed-width binary
+        field, the result matches binary data instead (see
+        :class:`BinaryPattern`).
+
         """
+        if (self.__class__ is EqualsPattern and
+                isinstance(self.obj, _basestring)):
+            return PrefixPattern(self, other)
+        if _binary_width(self) is not None:
+            return BinaryPattern(self, other)
         return ListPattern(self, other)
     def __add__(self, other):
         return self.head_tail_with(other)
 
+    def children(self):
+        """The direct sub-patterns of this pattern, in matching order."""
+        return ()
+
+    def _with_children(self, children):
+        """A shallow copy of this pattern with the given sub-patterns, in the
+        same order as :func:`children`."""
+        return self
+
+    def _state(self):
+        return dict((k, v) for (k, v) in self.__dict__.items()
+                if not k.startswith('_'))
+
     def __eq__(self, other):
         return (self.__class__ == other.__class__ and
-                self.__dict__ == other.__dict__)
+                self._state() == other._state())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        """
+        Structural hash, consistent with `==`. Patterns are mutable (see
+        :func:`bind` and :func:`if_`), so they must not be modified while
+        they're used as keys.
+
+        """
+        return _postorder(self, _hash_node)
+
+    def __repr__(self):
+        return _postorder(self, _repr_node)
+
+def _freeze(value, sub_pattern=None):
+    """A hashable stand-in for `value`, equal for equal values. If given,
+    `sub_pattern` replaces the patterns in it."""
+    if sub_pattern is not None and isinstance(value, Pattern):
+        return sub_pattern(value)
+    if isinstance(value, dict):
+        return frozenset((k, _freeze(v, sub_pattern))
+                for (k, v) in value.items())
+    if isinstance(value, (tuple, list)):
+        return tuple(_freeze(v, sub_pattern) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return value.__class__
+    return value
 
+def _hash_node(pattern, child_hashes):
+    """The hash of `pattern`, given the hashes of its sub-patterns (see
+    :func:`_postorder`)."""
+    hashes = dict(zip(map(id, pattern.children()), child_hashes))
+    def sub_pattern(child):
+        if id(child) in hashes:
+            return hashes[id(child)]
+        return hash(child)
+    return hash((pattern.__class__, _freeze(pattern._state(), sub_pattern)))
+
+class _Repr(str):
+    """A string that is its own repr, standing in for a sub-pattern."""
     def __repr__(self):
-        return '%s(%s)' % (self.__class__.__name__,
-                ', '.join('='.join((str(k), repr(v))) for (k, v) in
-                    self.__dict__.items() if v))
+        return self
+
+def _substitute(value, sub_pattern):
+    """A copy of `value` whose patterns are replaced by `sub_pattern`."""
+    if isinstance(value, Pattern):
+        return sub_pattern(value)
+    if isinstance(value, dict):
+        return dict((k, _substitute(v, sub_pattern))
+                for (k, v) in value.items())
+    if isinstance(value, (list, tuple)) and not hasattr(value, '_fields'):
+        return value.__class__(_substitute(v, sub_pattern) for v in value)
+    return value
+
+def _repr_node(pattern, child_reprs):
+    """The repr of `pattern`, given the reprs of its sub-patterns (see
+    :func:`_postorder`)."""
+    reprs = dict(zip(map(id, pattern.children()), child_reprs))
+    def sub_pattern(child):
+        return _Repr(reprs[id(child)] if id(child) in reprs else repr(child))
+    return '%s(%s)' % (pattern.__class__.__name__,
+            ', '.join('='.join((str(k), repr(_substitute(v, sub_pattern))))
+                for (k, v) in pattern._state().items() if v))
 
 class AnyPattern(Pattern):
     """Pattern that matches anything."""
@@ -186,14 +320,69 @@ class EqualsPattern(Pattern):
         else:
             return None
 
+# the most types whose verdicts are kept per class; more clear them
+_VERDICTS_PER_CLASS = 1024
+
+def _caches_verdicts(cls):
+    """Whether the verdicts of `isinstance(obj, cls)` are worth keeping per
+    type of `obj`: they are for ABCs, whose checks are slow but depend on the
+    type alone; classes with their own `__instancecheck__` may look at the
+    object itself."""
+    classes = cls if isinstance(cls, tuple) else (cls,)
+    checks = [getattr(type(c), '__instancecheck__', None) for c in classes]
+    return (any(check == abc.ABCMeta.__instancecheck__ for check in checks)
+            and all(check == abc.ABCMeta.__instancecheck__ or
+                check == type.__instancecheck__ for check in checks))
+
+class _TypeVerdicts(object):
+    """
+    The `isinstance` verdicts of ABCs per type of object, shared by all the
+    patterns that check them, so that checking an object costs a dict lookup.
+    Registering a class with any ABC forgets them all.
+
+    """
+    def __init__(self):
+        # ABC -> {type: verdict}
+        self.tables = {}
+        self.token = _abc_token()
+
+    def isinstance(self, obj, cls):
+        if _abc_token() != self.token:
+            self.token = _abc_token()
+            self.tables.clear()
+        try:
+            table = self.tables[cls]
+        except KeyError:
+            table = self.tables[cls] = {}
+        obj_type = obj.__class__
+        verdict = table.get(obj_type)
+        if verdict is None:
+            verdict = isinstance(obj, cls)
+            if type(obj) is obj_type:
+                if len(table) >= _VERDICTS_PER_CLASS:
+                    table.clear()
+                table[obj_type] = verdict
+        elif not verdict and type(obj) is not obj_type:
+            # faking `__class__` doesn't hide the actual type from isinstance
+            verdict = isinstance(obj, cls)
+        return verdict
+
+_type_verdicts = _TypeVerdicts()
+
 class InstanceOfPattern(Pattern):
-    """Pattern that only matches instances of the given class."""
+    """Pattern that only matches instances of the given class. For ABCs, the
+    verdict is looked up per type of object."""
     def __init__(self, cls):
         super(InstanceOfPattern, self).__init__()
         self.cls = cls
+        self._abc = _caches_verdicts(cls)
 
     def _does_match(self, other, ctx):
-        if isinstance(other, self.cls):
+        if self._abc:
+            verdict = _type_verdicts.isinstance(other, self.cls)
+        else:
+            verdict = isinstance(other, self.cls)
+        if verdict:
             return Match(ctx)
         else:
             return None
@@ -210,12 +399,90 @@ class RegexPattern(Pattern):
     def _does_match(self, other, ctx):
         re_match = self.regex.match(other)
         if re_match:
-            return Match(ctx, re_match.groups())
+            if self.bound_name is None:
+                # the groups would be thrown away
+                return Match(ctx)
+            return Match(ctx, re_match.groups() or None)
+        return None
+
+# fixed-width binary fields available by name in the pattern syntax, e.g.
+# `length:u16be`
+STRUCT_FIELDS = {
+    'u8': 'B', 'i8': 'b',
+    'u16be': '>H', 'u16le': '<H', 'i16be': '>h', 'i16le': '<h',
+    'u32be': '>I', 'u32le': '<I', 'i32be': '>i', 'i32le': '<i',
+    'u64be': '>Q', 'u64le': '<Q', 'i64be': '>q', 'i64le': '<q',
+    'f32be': '>f', 'f32le': '<f', 'f64be': '>d', 'f64le': '<d',
+}
+
+def _binary_width(pattern):
+    """The number of bytes a binary head pattern spans, or `None` if it's not
+    a fixed-width binary field."""
+    if isinstance(pattern, StructPattern):
+        return pattern._struct.size
+    if isinstance(pattern, EqualsPattern):
+        if isinstance(pattern.obj, _BINARY_TYPES):
+            return len(pattern.obj)
         return None
+    if isinstance(pattern, OrPattern):
+        widths = set(map(_binary_width, pattern.patterns))
+        if len(widths) == 1:
+            return widths.pop()
+    return None
+
+def _binary_view(other):
+    """A flat memoryview of bytes over `other`, or `None` if it's not binary
+    data."""
+    if not isinstance(other, _BINARY_TYPES):
+        return None
+    view = memoryview(other)
+    if view.ndim != 1 or view.itemsize != 1:
+        view = view.cast('B')
+    return view
+
+class StructPattern(Pattern):
+    """Pattern that only matches binary data of exactly the size of the given
+    :mod:`struct` format, and binds the value it decodes to (a tuple if the
+    format has more than one field). Used as the head of a head-tail pattern,
+    it builds a :class:`BinaryPattern`:
+
+        >>> p = StructPattern('>H')%'length'
+        >>> p << b'\\x01\\x00'
+        Match({'length': 256})
+        >>> p << b'\\x01'
+
+    """
+    def __init__(self, fmt):
+        super(StructPattern, self).__init__()
+        if fmt in STRUCT_FIELDS:
+            fmt = STRUCT_FIELDS[fmt]
+        self.fmt = fmt
+        self._struct = struct.Struct(fmt)
+
+    def _does_match(self, other, ctx):
+        if (not isinstance(other, _BINARY_TYPES) or
+                len(other) != self._struct.size):
+            return None
+        values = self._struct.unpack(other)
+        return Match(ctx, values[0] if len(values) == 1 else values)
+
+# the actions of the goals :class:`ListPattern` works through
+_EXPAND, _MATCH, _FINISH, _RECORD = range(4)
 
 class ListPattern(Pattern):
     """Pattern that only matches iterables whose head matches `head_pattern` and
     whose tail matches `tail_pattern`"""
+    # set by :mod:`pyfpm.optimizer`: the `(min, max)` length of the objects
+    # this pattern can match (`max` is `None` if unbounded), checked up front,
+    # and whether the head and tail patterns are no-ops that can be skipped
+    _lengths = None
+    _skip_head = False
+    _skip_tail = False
+    # whether the list pattern it's nested in may match it in its own loop,
+    # rather than through :func:`match`; :mod:`pyfpm.explain` turns it off to
+    # see every node matched
+    _inline = True
+
     def __init__(self, head_pattern=None, tail_pattern=None):
         super(ListPattern, self).__init__()
         if head_pattern is not None and tail_pattern is None:
@@ -224,57 +491,437 @@ class ListPattern(Pattern):
         self.tail_pattern = tail_pattern
 
     def head_tail_with(self, other):
-        return ListPattern(self.head_pattern,
-                self.tail_pattern.head_tail_with(other))
+        chain = []
+        pattern = self
+        while isinstance(pattern, ListPattern):
+            chain.append(pattern)
+            pattern = pattern.tail_pattern
+        result = pattern.head_tail_with(other)
+        for pattern in reversed(chain):
+            result = pattern.__class__(pattern.head_pattern, result)
+        return result
 
-    def _does_match(self, other, ctx):
-        try:
-            if (self.head_pattern is None and
-                    self.tail_pattern is None and
-                    len(other) == 0):
-                return Match(ctx)
-        except TypeError:
-            return None
-        if isinstance(other, _basestring):
-            return None
-        try:
-            head, tail = other[0], other[1:]
-        except (IndexError, TypeError):
-            return None
+    def children(self):
+        return tuple(p for p in (self.head_pattern, self.tail_pattern)
+                if p is not None)
+
+    def _with_children(self, children):
+        pattern = copy.copy(self)
         if self.head_pattern is not None:
-            match = self.head_pattern.match(head, ctx)
-            if match:
+            pattern.head_pattern, pattern.tail_pattern = children
+        return pattern
+
+    def _does_match(self, other, ctx):
+        # the chain of heads and tails, and the list patterns nested in the
+        # heads, are matched off an explicit stack of goals instead of through
+        # recursive calls. A goal is `(action, pattern, seq, start)`, for the
+        # value `seq[start:]`; tails of lists and tuples are visited by index
+        # instead of being sliced.
+        memo = getattr(_memo_state, 'table', None)
+        goals = [(_EXPAND, self, other, 0)]
+        match = self._match_goals(goals, ctx, memo)
+        if match is None and memo is not None:
+            # the failure happened inside every memoized list pattern still
+            # being matched, so none of them matches its part of the object
+            for action, pattern, seq, start in goals:
+                if action == _RECORD:
+                    memo[id(pattern), id(seq), start] = (seq, False)
+        return match
+
+    def _match_goals(self, goals, ctx, memo):
+        while goals:
+            action, pattern, seq, start = goals.pop()
+            if action == _MATCH:
+                match = pattern.match(seq if start == 0 else seq[start:], ctx)
+                if not match:
+                    return None
                 ctx = match.ctx
-                match = self.tail_pattern.match(tail, ctx)
-                if match:
-                    ctx = match.ctx
-                else:
+                continue
+            if action == _FINISH:
+                # the name and condition of a nested list pattern, checked
+                # once everything inside it matched, as in :func:`match`
+                if ctx is None:
+                    ctx = {}
+                if pattern.bound_name:
+                    value = seq if start == 0 else seq[start:]
+                    try:
+                        previous = ctx[pattern.bound_name]
+                        if previous != value:
+                            return None
+                    except KeyError:
+                        ctx[pattern.bound_name] = value
+                if pattern.condition is not None and not pattern.condition(
+                        **ctx):
                     return None
-            else:
+                continue
+            if action == _RECORD:
+                memo[id(pattern), id(seq), start] = (seq, True)
+                continue
+            if pattern._memoize and memo is not None and pattern is not self:
+                # memoized list patterns nested in this one are also matched
+                # in this loop, with their verdicts keyed by position, and
+                # recorded once everything inside them matched
+                entry = memo.get((id(pattern), id(seq), start))
+                if entry is not None:
+                    if entry[1]:
+                        continue
+                    return None
+                goals.append((_RECORD, pattern, seq, start))
+            try:
+                length = len(seq) - start
+            except TypeError:
+                length = None
+            if pattern._lengths is not None and length is not None:
+                low, high = pattern._lengths
+                if length < low or (high is not None and length > high):
+                    return None
+            if pattern.head_pattern is None and pattern.tail_pattern is None:
+                if length is None:
+                    return None
+                if length == 0:
+                    continue
+            if isinstance(seq, _basestring):
                 return None
-        else:
-            if len(other):
+            try:
+                head = seq[start]
+                if pattern._skip_tail:
+                    tail = None
+                elif seq.__class__ is list or isinstance(seq, tuple):
+                    tail = start + 1
+                else:
+                    seq, tail = seq[1:], 0
+            except (IndexError, TypeError):
                 return None
+            if pattern.head_pattern is None:
+                if length:
+                    return None
+                continue
+            # the tail goes first, so that it's matched after the head
+            if tail is not None:
+                self._push(goals, pattern.tail_pattern, seq, tail)
+            if not pattern._skip_head:
+                self._push(goals, pattern.head_pattern, head, 0)
         return Match(ctx)
 
+    @staticmethod
+    def _push(goals, pattern, seq, start):
+        if pattern.__class__ is ListPattern and pattern._inline:
+            if pattern.bound_name or pattern.condition is not None:
+                goals.append((_FINISH, pattern, seq, start))
+            goals.append((_EXPAND, pattern, seq, start))
+        else:
+            goals.append((_MATCH, pattern, seq, start))
+
+class BinaryPattern(ListPattern):
+    """Head-tail pattern over binary data (`bytes`, `bytearray` or
+    `memoryview`) whose head is a fixed-width field: a :class:`StructPattern`
+    or a bytes constant (or alternatives of either, all of the same width).
+    The head and the tail get matched against memoryviews of the data, so
+    nothing is copied and the tail is bound as a sub-view; any other object
+    is matched like by a :class:`ListPattern`:
+
+        >>> p = EqualsPattern(b'\\x01') + StructPattern('u8')%'n' + (
+        ...     AnyPattern()%'payload')
+        >>> match = p << bytearray(b'\\x01\\x02abc')
+        >>> match.ctx['n'], bytes(match.ctx['payload'])
+        (2, b'abc')
+        >>> p << b'\\x02\\x02abc'
+        >>> (EqualsPattern(b'ab') + AnyPattern()%'t') << [b'ab', 1]
+        Match({'t': [1]})
+
+    """
+    def __init__(self, head_pattern, tail_pattern=None):
+        super(BinaryPattern, self).__init__(head_pattern, tail_pattern)
+        self._head_width = _binary_width(head_pattern)
+        if self._head_width is None:
+            raise TypeError('not a fixed-width binary pattern: %r' % (
+                head_pattern,))
+
+    def _does_match(self, other, ctx):
+        view = _binary_view(other)
+        if view is None:
+            return super(BinaryPattern, self)._does_match(other, ctx)
+        if len(view) < self._head_width:
+            return None
+        match = self.head_pattern.match(view[:self._head_width], ctx)
+        if not match:
+            return None
+        if self._skip_tail:
+            return Match(match.ctx)
+        match = self.tail_pattern.match(view[self._head_width:], match.ctx)
+        if not match:
+            return None
+        return Match(match.ctx)
+
+class PrefixPattern(ListPattern):
+    """Head-tail pattern whose head is a string constant. Strings match if
+    they start with it, and the tail gets matched against the rest of the
+    string; any other object is matched like by a :class:`ListPattern`:
+
+        >>> p = EqualsPattern('GET ') + AnyPattern()%'path'
+        >>> p << 'GET /index.html'
+        Match({'path': '/index.html'})
+        >>> p << 'POST /index.html'
+        >>> p << ['GET ', 'x']
+        Match({'path': ['x']})
+
+    """
+    def __init__(self, head_pattern, tail_pattern=None):
+        super(PrefixPattern, self).__init__(head_pattern, tail_pattern)
+        self._prefix = head_pattern.obj
+        self._plain_head = (head_pattern.bound_name is None and
+                head_pattern.condition is None)
+
+    def _does_match(self, other, ctx):
+        if not isinstance(other, _basestring):
+            return super(PrefixPattern, self)._does_match(other, ctx)
+        if not other.startswith(self._prefix):
+            return None
+        width = len(self._prefix)
+        if not self._plain_head:
+            match = self.head_pattern.match(other[:width], ctx)
+            if not match:
+                return None
+            ctx = match.ctx
+        if self._skip_tail:
+            return Match(ctx)
+        match = self.tail_pattern.match(other[width:], ctx)
+        if not match:
+            return None
+        return Match(match.ctx)
+
+def _is_noop(pattern):
+    """Whether matching `pattern` can be skipped altogether."""
+    return (pattern.__class__ is AnyPattern and pattern.bound_name is None and
+            pattern.condition is None)
+
+def _ordered(items, order):
+    """`items` visited in the given order of their positions, if any."""
+    if order is None:
+        return tuple(items)
+    return tuple(items[i] for i in order)
+
+def _is_plain_list(pattern):
+    return (pattern.__class__ is ListPattern and pattern.bound_name is None and
+            pattern.condition is None)
+
 class NamedTuplePattern(Pattern):
     """Pattern that only matches named tuples of the given class and whose
-    contents match the given patterns."""
+    contents match the given patterns.
+
+    The field patterns are checked by indexing the tuple directly: one class
+    check, one arity check and one match per field, skipping fields whose
+    pattern is an anonymous `_`. If the fields are given as a single
+    :class:`ListPattern` with an open tail (e.g. `head + tail`), the tail
+    pattern gets matched against the remaining fields as a tuple."""
+    # the order in which the fields are checked, set by :mod:`pyfpm.optimizer`
+    _order = None
+
     def __init__(self, casecls, *initpatterns):
         super(NamedTuplePattern, self).__init__()
-        self.casecls_pattern = InstanceOfPattern(casecls)
+        self.casecls = casecls
+        self.rest_pattern = None
         if (len(initpatterns) == 1 and
                 isinstance(initpatterns[0], ListPattern)):
-            self.initargs_pattern = initpatterns[0]
+            fields = []
+            pattern = initpatterns[0]
+            while _is_plain_list(pattern) and pattern.head_pattern is not None:
+                fields.append(pattern.head_pattern)
+                pattern = pattern.tail_pattern
+            if not _is_plain_list(pattern):
+                self.rest_pattern = pattern
+            self.field_patterns = tuple(fields)
+        elif initpatterns:
+            self.field_patterns = tuple(map(build, initpatterns))
         else:
-            self.initargs_pattern = build(*initpatterns, **dict(is_list=True))
+            self.field_patterns = None
+        self._checks = self._field_checks()
+
+    def _field_checks(self):
+        return tuple((i, p) for (i, p) in _ordered(
+            list(enumerate(self.field_patterns or ())), self._order)
+            if not _is_noop(p))
+
+    def children(self):
+        children = self.field_patterns or ()
+        if self.rest_pattern is not None:
+            children += (self.rest_pattern,)
+        return children
+
+    def _with_children(self, children):
+        pattern = copy.copy(self)
+        if self.field_patterns is not None:
+            pattern.field_patterns = tuple(children[:len(self.field_patterns)])
+        if self.rest_pattern is not None:
+            pattern.rest_pattern = children[-1]
+        pattern._checks = pattern._field_checks()
+        return pattern
 
     def _does_match(self, other, ctx):
-        match = self.casecls_pattern.match(other, ctx)
-        if not match:
+        if (other.__class__ is not self.casecls and
+                not isinstance(other, self.casecls)):
             return None
-        ctx = match.ctx
-        return self.initargs_pattern.match(other, ctx)
+        if self.field_patterns is None:
+            return Match(ctx)
+        arity = len(self.field_patterns)
+        if self.rest_pattern is None:
+            if len(other) != arity:
+                return None
+        elif len(other) < arity:
+            return None
+        for i, pattern in self._checks:
+            match = pattern.match(other[i], ctx)
+            if not match:
+                return None
+            ctx = match.ctx
+        if self.rest_pattern is not None:
+            match = self.rest_pattern.match(other[arity:] if arity else other,
+                    ctx)
+            if not match:
+                return None
+            ctx = match.ctx
+        return Match(ctx)
+
+class MappingPattern(Pattern):
+    """Pattern that only matches mappings that contain all the given keys and
+    whose values for them match the corresponding patterns. Other keys are
+    ignored, and only the named keys are looked up."""
+    def __init__(self, mapping=None):
+        super(MappingPattern, self).__init__()
+        if mapping is None:
+            mapping = {}
+        self.mapping = dict((k, build(v)) for (k, v) in mapping.items())
+
+    def children(self):
+        return tuple(self.mapping.values())
+
+    def _with_children(self, children):
+        pattern = copy.copy(self)
+        pattern.mapping = dict(zip(self.mapping, children))
+        return pattern
+
+    def _does_match(self, other, ctx):
+        if (other.__class__ is not dict and
+                not _type_verdicts.isinstance(other, _Mapping)):
+            return None
+        for key, pattern in self.mapping.items():
+            value = other.get(key, _MISSING)
+            if value is _MISSING:
+                return None
+            match = pattern.match(value, ctx)
+            if not match:
+                return None
+            ctx = match.ctx
+        return Match(ctx)
+
+# builtin types that match their own positional sub-pattern against the whole
+# object, e.g. `int(x)`, just like in Python's `match` statement
+_SELF_MATCHING_TYPES = (bool, bytearray, bytes, dict, float, frozenset, int,
+        list, set, str, tuple)
+
+def _positional_attributes(cls):
+    """Names of the attributes that positional sub-patterns refer to: the
+    class' `__match_args__`, its dataclass fields or its `__slots__`."""
+    match_args = getattr(cls, '__match_args__', None)
+    if match_args is not None:
+        return tuple(match_args)
+    if hasattr(cls, '__dataclass_fields__'):
+        import dataclasses
+        return tuple(field.name for field in dataclasses.fields(cls))
+    names = []
+    for klass in reversed(cls.__mro__):
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, _basestring):
+            slots = (slots,)
+        names.extend(name for name in slots
+                if name not in ('__dict__', '__weakref__'))
+    return tuple(names)
+
+class ClassPattern(Pattern):
+    """
+    Pattern that only matches instances of the given class whose attributes
+    match the given patterns. Only the attributes named by the pattern are
+    fetched.
+
+    Positional patterns refer to the attributes listed in the class'
+    `__match_args__` (as in Python's `match` statement), or else to its
+    dataclass fields or `__slots__`, in order. Keyword patterns name the
+    attribute explicitly.
+
+    Example:
+
+        >>> class Point(object):
+        ...     __slots__ = ('x', 'y')
+        ...     def __init__(self, x, y):
+        ...         self.x, self.y = x, y
+        >>> ClassPattern(Point, EqualsPattern(0), y=AnyPattern()%'y'
+        ...     ).match(Point(0, 1))
+        Match({'y': 1})
+        >>> ClassPattern(Point, x=EqualsPattern(0)).match(Point(1, 1))
+
+    """
+    # the order in which the attributes are checked, set by
+    # :mod:`pyfpm.optimizer`
+    _order = None
+
+    def __init__(self, cls, *positional, **keyword):
+        super(ClassPattern, self).__init__()
+        self.cls = cls
+        self.self_pattern = None
+        attributes = []
+        if positional and issubclass(cls, _SELF_MATCHING_TYPES) and not (
+                hasattr(cls, '__match_args__')):
+            if len(positional) > 1:
+                raise TypeError('%s accepts 1 positional sub-pattern (%d '
+                        'given)' % (cls.__name__, len(positional)))
+            self.self_pattern = build(positional[0])
+        else:
+            names = _positional_attributes(cls)
+            if len(positional) > len(names):
+                raise TypeError('%s accepts %d positional sub-patterns (%d '
+                        'given)' % (cls.__name__, len(names), len(positional)))
+            attributes.extend(zip(names, map(build, positional)))
+        for name in sorted(keyword):
+            if name in dict(attributes):
+                raise TypeError('%s got multiple sub-patterns for attribute '
+                        '%s' % (cls.__name__, name))
+            attributes.append((name, build(keyword[name])))
+        self.attributes = tuple(attributes)
+        self._checks = self.attributes
+
+    def children(self):
+        children = tuple(p for (name, p) in self.attributes)
+        if self.self_pattern is not None:
+            children = (self.self_pattern,) + children
+        return children
+
+    def _with_children(self, children):
+        pattern = copy.copy(self)
+        if self.self_pattern is not None:
+            pattern.self_pattern = children[0]
+            children = children[1:]
+        pattern.attributes = tuple(zip(
+            (name for (name, p) in self.attributes), children))
+        pattern._checks = _ordered(pattern.attributes, pattern._order)
+        return pattern
+
+    def _does_match(self, other, ctx):
+        if not isinstance(other, self.cls):
+            return None
+        if self.self_pattern is not None:
+            match = self.self_pattern.match(other, ctx)
+            if not match:
+                return None
+            ctx = match.ctx
+        for name, pattern in self._checks:
+            value = getattr(other, name, _MISSING)
+            if value is _MISSING:
+                return None
+            match = pattern.match(value, ctx)
+            if not match:
+                return None
+            ctx = match.ctx
+        return Match(ctx)
 
 class OrPattern(Pattern):
     """Pattern that matches whenever any of the inner patterns match."""
@@ -284,6 +931,14 @@ class OrPattern(Pattern):
         super(OrPattern, self).__init__()
         self.patterns = patterns
 
+    def children(self):
+        return self.patterns
+
+    def _with_children(self, children):
+        pattern = copy.copy(self)
+        pattern.patterns = tuple(children)
+        return pattern
+
     def _does_match(self, other, ctx):
         for pattern in self.patterns:
             if ctx is not None:
@@ -295,6 +950,118 @@ class OrPattern(Pattern):
                 return match
         return None
 
+def _postorder(pattern, rebuild):
+    """
+    Rebuild the tree of `pattern` bottom-up, with an explicit stack so that
+    long sequence patterns don't hit the recursion limit.
+
+    :param rebuild: gets each node and the tuple of its rebuilt sub-patterns,
+        and returns its replacement
+    :returns: the replacement of `pattern`
+
+    """
+    # rebuilt nodes pile up in `done` until their parent is rebuilt
+    done = []
+    todo = [(pattern, None)]
+    while todo:
+        pattern, children = todo.pop()
+        if children is None:
+            children = pattern.children()
+            if children:
+                todo.append((pattern, children))
+                todo.extend((child, None) for child in reversed(children))
+                continue
+        rebuilt = tuple(done[len(done) - len(children):])
+        del done[len(done) - len(children):]
+        done.append(rebuild(pattern, rebuilt))
+    (result,) = done
+    return result
+
+class _Shared(object):
+    """Key of a pattern in a :class:`PatternTable`. Its sub-patterns are
+    hashed by the identity of their canonical versions, given by
+    `canonical_id`, rather than by walking them."""
+    __slots__ = ('pattern', 'key', 'hash')
+
+    def __init__(self, pattern, canonical_id):
+        self.pattern = pattern
+        # constants that are `==` but of different types, such as 1 and True,
+        # must not be merged
+        constant_class = (pattern.obj.__class__
+                if isinstance(pattern, EqualsPattern) else None)
+        self.key = (pattern.__class__, constant_class,
+                _freeze(pattern._state(), canonical_id))
+        self.hash = hash(self.key)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return self.key == other.key and self.pattern == other.pattern
+
+class PatternTable(object):
+    """
+    Hash-consing table for patterns. :func:`share` returns, for any pattern,
+    a structurally equal one whose identical sub-patterns are shared objects,
+    so that equal sub-trees across several patterns exist only once:
+
+        >>> table = PatternTable()
+        >>> a = table.share(build(EqualsPattern(1) | EqualsPattern(2), int))
+        >>> b = table.share(build(EqualsPattern(1) | EqualsPattern(2), str))
+        >>> a.head_pattern is b.head_pattern
+        True
+
+    Shared sub-patterns that neither bind names nor have conditions are
+    flagged for memoization: while a memo is active (see :class:`Memo`) their
+    verdict for a given object is computed only once.
+
+    .. warning:: shared patterns must not be modified afterwards, e.g. with
+        :func:`Pattern.bind` or :func:`Pattern.if_`.
+
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.memoizing = False
+
+    def share(self, pattern):
+        """Return the canonical version of `pattern`."""
+        return _postorder(pattern, self._share)
+
+    def _share(self, pattern, shared):
+        children = pattern.children()
+        canonical_ids = dict((id(child), id(canonical_child))
+                for (child, canonical_child) in zip(children, shared))
+        if any(a is not b for (a, b) in zip(shared, children)):
+            pattern = pattern._with_children(shared)
+        key = _Shared(pattern, lambda p: canonical_ids.get(id(p), id(p)))
+        canonical = self.nodes.setdefault(key, pattern)
+        if canonical is pattern:
+            canonical._pure = (pattern.bound_name is None and
+                    pattern.condition is None and
+                    all(child._pure for child in canonical.children()))
+        elif canonical._pure and children and not canonical._memoize:
+            canonical._memoize = True
+            self.memoizing = True
+        return canonical
+
+    def __len__(self):
+        return len(self.nodes)
+
+class Memo(object):
+    """
+    Context manager that activates, for the current thread, memoization of
+    the verdicts of the patterns flagged by :class:`PatternTable`. Verdicts
+    are keyed by pattern and object identity, and forgotten on exit.
+
+    """
+    def __enter__(self):
+        self.previous = getattr(_memo_state, 'table', None)
+        _memo_state.table = {}
+        return self
+
+    def __exit__(self, *exc_info):
+        _memo_state.table = self.previous
+
 def build(*args, **kwargs):
     """
     Shorthand pattern factory.
@@ -320,6 +1087,8 @@ def build(*args, **kwargs):
         ...     ListPattern(InstanceOfPattern(str),
         ...         ListPattern(EqualsPattern('a'))))
         True
+        >>> build({'a': 1}) == MappingPattern({'a': EqualsPattern(1)})
+        True
         >>> try:
         ...     from collections import namedtuple
         ...     MyTuple = namedtuple('MyTuple', 'a b c')
@@ -331,23 +1100,64 @@ def build(*args, **kwargs):
     """
     arglen = len(args)
     if arglen > 1:
-        head, tail = args[0], args[1:]
-        return ListPattern(build(head), build(*tail, **(dict(is_list=True))))
+        return _build(args)
     if arglen == 0:
         return AnyPattern()
     (arg,) = args
     if kwargs.get('is_list', False):
-        return ListPattern(build(arg))
+        return ListPattern(_build(arg))
+    return _build(arg)
+
+def _items(arg):
+    """The items of `arg` that :func:`build` turns into sub-patterns, `None`
+    if there aren't any."""
+    if isinstance(arg, Pattern):
+        return None
+    if isinstance(arg, tuple) and hasattr(arg, '_fields'):
+        return arg
+    if isinstance(arg, (tuple, list)):
+        return arg
+    if isinstance(arg, dict):
+        return list(arg.values())
+    return None
+
+def _build(arg):
+    """:func:`build` for a single argument, with an explicit stack, so that
+    nesting is limited only by memory."""
+    # (argument, whether its items are built) frames; the patterns built so
+    # far pile up in `built`
+    built = []
+    todo = [(arg, False)]
+    while todo:
+        arg, ready = todo.pop()
+        if not ready:
+            items = _items(arg)
+            if items is None:
+                built.append(_build_leaf(arg))
+            else:
+                todo.append((arg, True))
+                todo.extend((item, False) for item in reversed(items))
+            continue
+        count = len(arg)
+        children = built[len(built) - count:]
+        del built[len(built) - count:]
+        if isinstance(arg, dict):
+            pattern = MappingPattern(dict(zip(arg, children)))
+        elif hasattr(arg, '_fields'):
+            pattern = NamedTuplePattern(arg.__class__, *children)
+        else:
+            pattern = ListPattern()
+            for child in reversed(children):
+                pattern = ListPattern(child, pattern)
+        built.append(pattern)
+    (pattern,) = built
+    return pattern
+
+def _build_leaf(arg):
     if isinstance(arg, Pattern):
         return arg
     if isinstance(arg, _CompiledRegex):
         return RegexPattern(arg)
-    if isinstance(arg, tuple) and hasattr(arg, '_fields'):
-        return NamedTuplePattern(arg.__class__, *map(build, arg))
     if isinstance(arg, type):
         return InstanceOfPattern(arg)
-    if isinstance(arg, (tuple, list)):
-        if len(arg) == 0:
-            return ListPattern()
-        return build(*arg, **(dict(is_list=True)))
     return EqualsPattern(arg)
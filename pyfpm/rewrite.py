@@ -0,0 +1,280 @@
+"""
+Term rewriting with pattern rules.
+
+A :class:`Rewriter` holds rules that map patterns to replacements and
+applies them throughout a term (a tree of tuples, named tuples and lists)
+until none applies anywhere, which is handy for simplifiers and other
+transformations of syntax trees:
+
+    >>> from collections import namedtuple
+    >>> Add = namedtuple('Add', 'left right')
+    >>> Mul = namedtuple('Mul', 'left right')
+    >>> simplify = Rewriter([
+    ...     ('Add(0, x) | Add(x, 0)', lambda x: x),
+    ...     ('Mul(1, x) | Mul(x, 1)', lambda x: x),
+    ...     ('Mul(0, _) | Mul(_, 0)', lambda: 0),
+    ...     ('Add(x:int, y:int)', lambda x, y: x + y),
+    ...     ])
+    >>> simplify(Add(Mul('a', Add(1, 0)), Mul(Add(2, 3), 0)))
+    'a'
+
+Replacements get the bound names as keyword arguments, like the handlers of
+a :class:`pyfpm.matcher.Matcher`, and return the new subterm; returning the
+matched term itself leaves it as it is. Replacements are rewritten in turn,
+so the result is a normal form. A term that rewrites back into itself
+through a cycle of rules is left at the point where the cycle closes.
+
+With the default :data:`BOTTOM_UP` strategy, the children of a term are
+rewritten before the term itself; with :data:`TOP_DOWN`, rules are tried
+on a term first, and again after its children changed.
+
+Subterms are hash-consed into canonical keys, built from the keys of their
+children, and their normal forms are kept in a memo table, so that each
+distinct subterm is matched against the rules once: repeated subtrees, and
+subtrees already in normal form, are looked up instead of matched again
+(with :data:`TOP_DOWN`, only the very same objects are, before their
+children have been rewritten). The memo table lives as long as the
+rewriter's rules don't change, and is cleared whenever it grows beyond
+`memo_size` subterms. Lists, which can be modified, and subterms with lists
+or unhashable leaves in them aren't memoized, and neither are the normal
+forms that have them, so that no call gets a normal form shared with an
+earlier one.
+
+"""
+from pyfpm.matcher import Matcher
+from pyfpm.parser import _get_caller_globals
+
+BOTTOM_UP = 'bottom-up'
+TOP_DOWN = 'top-down'
+
+# the memo entry of a subterm that is being rewritten
+_IN_PROGRESS = object()
+_NO_RULE = object()
+
+_VISIT, _BUILD, _STORE = range(3)
+
+def _shape(cls):
+    """The function that builds a term of class `cls` from its children, or
+    `None` if its instances are leaves."""
+    if cls is tuple or cls is list:
+        return cls
+    if issubclass(cls, tuple):
+        return getattr(cls, '_make', cls)
+    if issubclass(cls, list):
+        return cls
+    return None
+
+def _signature(term, shape):
+    """A hashable stand-in for `term` that compares its children by identity
+    only, since replacements are built from the subterms of the matched
+    terms."""
+    if shape is not None:
+        return (term.__class__,) + tuple(id(child) for child in term)
+    try:
+        hash(term)
+    except TypeError:
+        return id(term)
+    return (term.__class__, term)
+
+class Rewriter(object):
+    """
+    Rewrites terms with pattern rules.
+
+    :param rules: an optional list of pattern-replacement pairs. String
+        patterns are automatically parsed.
+    :param strategy: :data:`BOTTOM_UP` or :data:`TOP_DOWN`
+    :param context: an optional context for the pattern parser. If absent,
+        it uses the caller's `globals()`
+    :type context: dict
+    :param memo_size: int -- the number of subterms after which the memo
+        table is cleared
+    :ivar matcher: the :class:`pyfpm.matcher.Matcher` the rules are tried
+        with
+
+    """
+    def __init__(self, rules=[], strategy=BOTTOM_UP, context=None,
+            memo_size=1 << 20):
+        if strategy not in (BOTTOM_UP, TOP_DOWN):
+            raise ValueError('unknown strategy: %r' % (strategy,))
+        if context is None:
+            context = _get_caller_globals()
+        self.strategy = strategy
+        self.memo_size = memo_size
+        self.matcher = Matcher(context=context)
+        # canonical key of each distinct subterm structure
+        self._keys = {}
+        # canonical key -> (normal form, its canonical key)
+        self._memo = {}
+        self._shapes = {}
+        for pattern, replacement in rules:
+            self.register(pattern, replacement)
+
+    def register(self, pattern, replacement):
+        """
+        Add a rule, tried after the existing ones.
+
+        :param pattern: Pattern or str -- the pattern
+        :param replacement: callable -- gets the bound names as keyword
+            arguments and returns the new subterm
+        :returns: the :class:`pyfpm.matcher.Case` handle of the rule
+
+        """
+        self.clear()
+        return self.matcher.register(pattern, replacement)
+
+    def rule(self, pattern):
+        """
+        Decorator for registering replacements, with the same effect as
+        :func:`register`:
+
+            >>> double_negation = Rewriter()
+            >>> @double_negation.rule("['not', ['not', x]]")
+            ... def remove(x):
+            ...     return x
+            >>> double_negation(('and', ('not', ('not', 'a')), 'b'))
+            ('and', 'a', 'b')
+
+        """
+        def _reg(function):
+            self.register(pattern, function)
+            return function
+        return _reg
+
+    def clear(self):
+        """Empty the memo table."""
+        self._keys.clear()
+        self._memo.clear()
+
+    def _apply(self, term):
+        result = self.matcher.try_match(term, default=_NO_RULE)
+        if result is term:
+            return _NO_RULE
+        return result
+
+    def _shape_of(self, cls):
+        try:
+            return self._shapes[cls]
+        except KeyError:
+            shape = self._shapes[cls] = _shape(cls)
+            return shape
+
+    def _key(self, structure):
+        keys = self._keys
+        try:
+            key = keys.get(structure)
+        except TypeError:
+            # unhashable leaf
+            return None
+        if key is None:
+            key = keys[structure] = len(keys)
+        return key
+
+    def rewrite(self, term):
+        """
+        Rewrite `term` until no rule applies to it or to any of its
+        subterms.
+
+        :returns: the normal form of `term`
+
+        """
+        if len(self._keys) > self.memo_size:
+            self.clear()
+        memo = self._memo
+        in_progress = []
+        try:
+            return self._rewrite(term, memo, in_progress)
+        finally:
+            for key in in_progress:
+                if memo.get(key) is _IN_PROGRESS:
+                    del memo[key]
+
+    def _rewrite(self, term, memo, in_progress):
+        top_down = self.strategy == TOP_DOWN
+        shape_of = self._shape_of
+        # id(subterm) -> (subterm, normal form, key), for this call
+        seen = {}
+        # (normal form, key) of the subterms rewritten so far
+        results = []
+        todo = [(_VISIT, term, None)]
+        while todo:
+            action, node, arg = todo.pop()
+            if action == _VISIT:
+                entry = seen.get(id(node))
+                if entry is not None:
+                    results.append(entry[1:])
+                    continue
+                shape = shape_of(node.__class__)
+                if top_down:
+                    # signature -> term, for the terms this one replaced, to
+                    # stop at a cycle; they are kept alive so that the ids
+                    # in the signatures stay theirs
+                    chain = arg if arg is not None else {}
+                    chain[_signature(node, shape)] = node
+                    replaced = self._apply(node)
+                    if replaced is not _NO_RULE and _signature(replaced,
+                            shape_of(replaced.__class__)) not in chain:
+                        todo.append((_STORE, node, None))
+                        todo.append((_VISIT, replaced, chain))
+                        continue
+                todo.append((_BUILD, node, shape))
+                if shape is not None:
+                    todo.extend((_VISIT, child, None)
+                            for child in reversed(node))
+            elif action == _BUILD:
+                if arg is None:
+                    term = node
+                    key = self._key((node.__class__, node))
+                else:
+                    count = len(node)
+                    children = results[len(results) - count:]
+                    del results[len(results) - count:]
+                    if any(child is not old for ((child, _), old)
+                            in zip(children, node)):
+                        term = arg([child for (child, _) in children])
+                    else:
+                        term = node
+                    child_keys = tuple(key for (_, key) in children)
+                    if None in child_keys or isinstance(node, list):
+                        key = None
+                    else:
+                        key = self._key((node.__class__,) + child_keys)
+                if key is not None:
+                    entry = memo.get(key)
+                    if entry is _IN_PROGRESS:
+                        # a cycle of rules closed here
+                        results.append((term, key))
+                        continue
+                    if entry is not None:
+                        seen[id(node)] = (node,) + entry
+                        results.append(entry)
+                        continue
+                if top_down and term is node:
+                    # the rules were tried when it was visited
+                    replaced = _NO_RULE
+                else:
+                    replaced = self._apply(term)
+                if replaced is _NO_RULE:
+                    if key is not None:
+                        memo[key] = (term, key)
+                    seen[id(node)] = (node, term, key)
+                    results.append((term, key))
+                else:
+                    if key is not None:
+                        memo[key] = _IN_PROGRESS
+                        in_progress.append(key)
+                    todo.append((_STORE, node, key))
+                    todo.append((_VISIT, replaced, None))
+            else:
+                result = results[-1]
+                if arg is not None:
+                    if result[1] is not None:
+                        memo[arg] = result
+                    else:
+                        del memo[arg]
+                seen[id(node)] = (node,) + result
+        (result, key), = results
+        return result
+
+    def __call__(self, term):
+        """Same as :func:`rewrite`."""
+        return self.rewrite(term)
@@ -0,0 +1,201 @@
+"""
+Deep search of nested structures.
+
+Patterns match objects at the root. :func:`search` walks a structure of
+nested sequences, mappings and named tuples, depth first and lazily, and
+yields every subobject that matches a pattern, along with the path to it:
+
+    >>> config = {'servers': [{'host': 'a', 'port': 80},
+    ...     {'host': 'b', 'port': 8080}], 'admin': {'port': 22}}
+    >>> [(path, match.ctx) for (path, match)
+    ...     in search("{'port': p:int} if p > 1024", config)]
+    [(('servers', 1), {'p': 8080})]
+
+A path is the tuple of the keys and indexes that lead from the root to the
+subobject, so that `obj[path[0]][path[1]]...` gets it back. Parents come
+before their children, which are visited in order.
+
+:func:`findall` looks for several patterns in a single traversal:
+
+    >>> for path, position, match in findall(['x:str', '[_, _]'],
+    ...         ['a', ('b', 1), 2]):
+    ...     print('%s %d %s' % (path, position, match))
+    (0,) 0 Match({'x': 'a'})
+    (1,) 1 Match({})
+    (1, 0) 0 Match({'x': 'b'})
+
+Before a pattern is tried on a subobject, the subobject's type is checked
+against the types the pattern can match (instances of its class, named tuple
+and class patterns, mappings for mapping patterns, strings for regular
+expressions...), once per type, and sized objects against the lengths
+sequence patterns accept, so that most of the tree is skipped without
+calling into the patterns. Strings and binary data are not looked into.
+
+String patterns are parsed in the caller's `globals()`, once per call site.
+The structure must not contain cycles.
+
+"""
+try:
+    # python 3.3+
+    from collections.abc import Sequence as _Sequence
+except ImportError:
+    # python 2.6+
+    from collections import Sequence as _Sequence
+
+from pyfpm import optimizer
+from pyfpm.matcher import _parse_at_call_site
+from pyfpm.pattern import (_basestring, _BINARY_TYPES, _Mapping,
+        InstanceOfPattern, RegexPattern, StructPattern, ListPattern,
+        BinaryPattern, NamedTuplePattern, MappingPattern, ClassPattern,
+        OrPattern)
+
+# objects that are matched but not looked into
+_ATOMS = (_basestring,) + _BINARY_TYPES
+
+_MAPPING, _SEQUENCE = range(2)
+
+def _prerequisites(pattern):
+    """
+    What an object must be for `pattern` to possibly match it: a
+    `(types, excluded, lengths)` tuple with the types it must be an instance
+    of (`None` for any), the types it must not be an instance of, and the
+    `(min, max)` length it must have if it's sized (`None` for any).
+
+    """
+    cls = pattern.__class__
+    if cls is InstanceOfPattern or cls is ClassPattern:
+        return (pattern.cls,), (), None
+    if cls is NamedTuplePattern:
+        return (pattern.casecls,), (), None
+    if cls is MappingPattern:
+        return (_Mapping,), (), None
+    if cls is RegexPattern:
+        if isinstance(pattern.regex.pattern, _basestring):
+            return (_basestring,), (), None
+        return _BINARY_TYPES, (), None
+    if cls is StructPattern or cls is BinaryPattern:
+        return _BINARY_TYPES, (), None
+    if isinstance(pattern, ListPattern):
+        # sequence patterns look mappings up by index
+        return None, (_Mapping,), pattern._lengths
+    if cls is OrPattern:
+        alternatives = [_prerequisites(p) for p in pattern.patterns]
+        types = ()
+        for alternative in alternatives:
+            if alternative[0] is None:
+                types = None
+                break
+            types += alternative[0]
+        # only the types every alternative excludes
+        excluded = tuple(t for t in alternatives[0][1]
+                if all(t in alternative[1] for alternative in alternatives))
+        return types, excluded, None
+    return None, (), None
+
+def _accepts(prerequisites, cls):
+    types, excluded, lengths = prerequisites
+    return ((types is None or issubclass(cls, types)) and
+            not (excluded and issubclass(cls, excluded)))
+
+def _kind(cls):
+    if issubclass(cls, _ATOMS):
+        return None
+    if cls is dict or issubclass(cls, _Mapping):
+        return _MAPPING
+    if cls is list or cls is tuple or issubclass(cls, (list, tuple,
+            _Sequence)):
+        return _SEQUENCE
+    return None
+
+def _path(link):
+    keys = []
+    while link is not None:
+        link, key = link
+        keys.append(key)
+    keys.reverse()
+    return tuple(keys)
+
+def _traverse(patterns, obj):
+    prerequisites = [_prerequisites(p) for p in patterns]
+    # per type: the positions of the patterns that may match its instances,
+    # and how to look into them
+    candidates = {}
+    kinds = {}
+    # (subobject, (parent link, key)) pairs
+    stack = [(obj, None)]
+    while stack:
+        node, link = stack.pop()
+        cls = node.__class__
+        try:
+            positions = candidates[cls]
+        except KeyError:
+            positions = candidates[cls] = tuple(i for (i, prerequisite)
+                    in enumerate(prerequisites) if _accepts(prerequisite, cls))
+            kinds[cls] = _kind(cls)
+        for position in positions:
+            lengths = prerequisites[position][2]
+            if lengths is not None:
+                try:
+                    length = len(node)
+                except TypeError:
+                    pass
+                else:
+                    low, high = lengths
+                    if length < low or (high is not None and length > high):
+                        continue
+            match = patterns[position].match(node)
+            if match:
+                yield _path(link), position, match
+        kind = kinds[cls]
+        if kind is _MAPPING:
+            items = list(node.items())
+            items.reverse()
+            stack.extend((value, (link, key)) for (key, value) in items)
+        elif kind is _SEQUENCE:
+            stack.extend((node[index], (link, index))
+                    for index in range(len(node) - 1, -1, -1))
+
+def _prepare(patterns):
+    """Parse the string patterns in the globals of the caller of the public
+    function that called :func:`_search` or :func:`_findall`, and optimize
+    them all."""
+    prepared = []
+    for pattern in patterns:
+        if isinstance(pattern, _basestring):
+            pattern = _parse_at_call_site(pattern, 3)[0]
+        prepared.append(optimizer.optimize(pattern))
+    return prepared
+
+def _search(pattern, obj):
+    return ((path, match) for (path, position, match)
+            in _traverse(_prepare([pattern]), obj))
+
+def _findall(patterns, obj):
+    return _traverse(_prepare(patterns), obj)
+
+def search(pattern, obj):
+    """
+    Find every subobject of `obj`, itself included, that matches `pattern`.
+
+    :param pattern: Pattern or str -- the pattern
+    :param obj: the root of the structure to look into
+    :returns: a generator of `(path, match)` pairs, where `match` is a
+        :class:`pyfpm.pattern.Match`
+
+    """
+    return _search(pattern, obj)
+
+def findall(patterns, obj):
+    """
+    Find every subobject of `obj`, itself included, that matches any of
+    `patterns`, in a single traversal.
+
+    :param patterns: a sequence of patterns (Pattern or str)
+    :param obj: the root of the structure to look into
+    :returns: a generator of `(path, position, match)` tuples, where
+        `position` is the position in `patterns` of the pattern that matched;
+        a subobject that matches several patterns is yielded once for each,
+        in their order
+
+    """
+    return _findall(patterns, obj)
@@ -0,0 +1,305 @@
+"""
+Vectorized matching of columnar batches with NumPy.
+
+:func:`match_columns` matches every row of a batch of homogeneous records,
+given as one array per tuple position, against a matcher's cases at once.
+Constants, type tests, alternatives and guards made of comparisons and
+boolean operators are evaluated as whole-column masks; the result is the
+position of the winning case for each row, or -1:
+
+    >>> import numpy as np
+    >>> from pyfpm.matcher import Matcher
+    >>> m = Matcher([
+    ...     ("['GET' | 'HEAD', status:int] if 200 <= status < 300",
+    ...         lambda status: 'ok'),
+    ...     ("[_, 404]", lambda: 'not found'),
+    ...     ("[method:str, _]", lambda method: method),
+    ...     ])
+    >>> methods = np.array(['GET', 'HEAD', 'POST', 'GET'])
+    >>> statuses = np.array([200, 204, 404, 404])
+    >>> match_columns(m, [methods, statuses]).tolist()
+    [0, 0, 1, 1]
+    >>> match_columns(m, [methods, statuses], dispatch=True)
+    ['ok', 'ok', 'not found', 'not found']
+
+Each row is matched as the tuple of its values converted to Python objects
+(as with `ndarray.tolist()`), so `x:int` matches the rows of an integer
+column. Cases that can't be vectorized (nested patterns, regular expressions,
+guards with function calls or containment tests...) are still matched by the
+pattern interpreter, row by row, but only on the rows that no earlier case
+has claimed.
+
+.. note:: this module requires NumPy.
+
+"""
+import ast
+import warnings
+
+import numpy as np
+
+from pyfpm.matcher import NoMatch, TailCall, _wrong_arity
+from pyfpm.parser import _IfCondition
+from pyfpm.pattern import (AnyPattern, EqualsPattern, InstanceOfPattern,
+        ListPattern, OrPattern)
+
+class _NotVectorizable(Exception):
+    pass
+
+# the Python type of the values in columns of these dtype kinds
+_KIND_TYPES = {
+    'b': bool,
+    'i': int,
+    'u': int,
+    'f': float,
+    'c': complex,
+    'U': type(u''),
+    'S': bytes,
+}
+
+class _Masks(ast.NodeTransformer):
+    """Rewrites boolean operators and comparison chains into their
+    element-wise equivalents. Function calls, attributes and subscripts
+    would apply to whole columns rather than to their values, so they're
+    rejected."""
+    def _reject(self, node):
+        raise _NotVectorizable(node.__class__.__name__)
+
+    visit_Call = visit_Attribute = visit_Subscript = _reject
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        result = node.values[0]
+        for value in node.values[1:]:
+            result = ast.BinOp(left=result, op=op, right=value)
+        return result
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        result = None
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn, ast.Is, ast.IsNot)):
+                raise _NotVectorizable(op.__class__.__name__)
+            comparison = ast.Compare(left=left, ops=[op], comparators=[right])
+            if result is None:
+                result = comparison
+            else:
+                result = ast.BinOp(left=result, op=ast.BitAnd(),
+                        right=comparison)
+            left = right
+        return result
+
+_mask_code_cache = {}
+
+def _mask_code(source):
+    """The code of the element-wise version of a condition, and the names it
+    uses."""
+    try:
+        return _mask_code_cache[source]
+    except KeyError:
+        pass
+    tree = _Masks().visit(ast.parse(source, mode='eval'))
+    code = compile(ast.fix_missing_locations(tree), '<pattern_condition>',
+            'eval')
+    names = frozenset(node.id for node in ast.walk(tree)
+            if isinstance(node, ast.Name))
+    _mask_code_cache[source] = code, names
+    return code, names
+
+def _as_mask(result, size, scalar=True):
+    """`result` as a mask of `size` rows. A single boolean is taken for
+    every row, unless `scalar` is false."""
+    result = np.asarray(result)
+    if result.dtype != bool:
+        raise _NotVectorizable('not a boolean mask')
+    if result.shape == ():
+        if not scalar:
+            raise _NotVectorizable('a single boolean for the whole column')
+        return np.full(size, bool(result))
+    if result.shape != (size,):
+        raise _NotVectorizable('mask of shape %r' % (result.shape,))
+    return result
+
+class _Batch(object):
+    def __init__(self, columns):
+        self.columns = columns
+        self.size = len(columns[0])
+        self._rows = None
+
+    def rows(self):
+        """The rows as tuples of Python objects."""
+        if self._rows is None:
+            self._rows = list(zip(*[c.tolist() for c in self.columns]))
+        return self._rows
+
+    def equals(self, i, obj):
+        if isinstance(obj, (list, tuple, dict, set, frozenset)):
+            raise _NotVectorizable('non-scalar constant')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return _as_mask(self.columns[i] == obj, self.size)
+
+    def instance_of(self, i, cls):
+        column = self.columns[i]
+        kind_type = _KIND_TYPES.get(column.dtype.kind)
+        if kind_type is not None:
+            return np.full(self.size, issubclass(kind_type, cls))
+        return np.fromiter((isinstance(value, cls)
+            for value in column.tolist()), bool, self.size)
+
+    def condition(self, condition, names):
+        if not isinstance(condition, _IfCondition) or condition.source is None:
+            raise _NotVectorizable('opaque condition')
+        namespace = dict((name, self.columns[i])
+                for (name, i) in names.items())
+        try:
+            code, used = _mask_code(condition.source)
+            with np.errstate(all='ignore'):
+                result = eval(code, condition.context, namespace)
+        except _NotVectorizable:
+            raise
+        except Exception as e:
+            raise _NotVectorizable(e)
+        # a condition on the columns must give a value per row
+        return _as_mask(result, self.size, used.isdisjoint(namespace))
+
+    def element(self, pattern, i, names):
+        """The mask for `pattern` matched against the values in column `i`,
+        given the names bound so far (mapped to their column)."""
+        cls = pattern.__class__
+        if cls is AnyPattern:
+            mask = np.ones(self.size, bool)
+        elif cls is EqualsPattern:
+            mask = self.equals(i, pattern.obj)
+        elif cls is InstanceOfPattern:
+            mask = self.instance_of(i, pattern.cls)
+        elif cls is OrPattern:
+            mask = np.zeros(self.size, bool)
+            bound = None
+            for alternative in pattern.patterns:
+                alternative_names = dict(names)
+                mask |= self.element(alternative, i, alternative_names)
+                if bound is None:
+                    bound = alternative_names
+                elif bound != alternative_names:
+                    raise _NotVectorizable('alternatives bind different names')
+            names.update(bound)
+        else:
+            raise _NotVectorizable(cls.__name__)
+        return mask & self.bind_and_test(pattern, i, names)
+
+    def bind_and_test(self, pattern, i, names):
+        mask = np.ones(self.size, bool)
+        name = pattern.bound_name
+        if name:
+            if name in names:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    mask &= _as_mask(self.columns[names[name]] ==
+                            self.columns[i], self.size)
+            else:
+                names[name] = i
+        if pattern.condition is not None:
+            mask &= self.condition(pattern.condition, names)
+        return mask
+
+    def case(self, pattern):
+        """The mask for a case and the column of each of the names it binds.
+        Rows are matched as tuples, so only list patterns with an element
+        pattern per column can be vectorized."""
+        names = {}
+        if pattern.bound_name is not None:
+            raise _NotVectorizable('binds the whole row')
+        if pattern.__class__ is AnyPattern:
+            return self.bind_and_test(pattern, None, names), names
+        if pattern.__class__ is not ListPattern:
+            raise _NotVectorizable(pattern.__class__.__name__)
+        plain = lambda node: node.bound_name is None and node.condition is None
+        heads = []
+        node = pattern
+        while (node.__class__ is ListPattern and node.head_pattern is not None
+                and (node is pattern or plain(node))):
+            heads.append(node.head_pattern)
+            node = node.tail_pattern
+        if (node.__class__ is ListPattern and node.head_pattern is None and
+                (node is pattern or plain(node))):
+            fits = len(heads) == len(self.columns)
+        elif node.__class__ is AnyPattern and plain(node):
+            fits = len(heads) <= len(self.columns)
+        else:
+            raise _NotVectorizable('tail pattern')
+        if not fits:
+            return np.zeros(self.size, bool), names
+        mask = np.ones(self.size, bool)
+        for i, head in enumerate(heads):
+            mask &= self.element(head, i, names)
+        if pattern.condition is not None:
+            mask &= self.condition(pattern.condition, names)
+        return mask, names
+
+def _as_columns(columns):
+    names = getattr(getattr(columns, 'dtype', None), 'names', None)
+    if names:
+        columns = [columns[name] for name in names]
+    else:
+        columns = [np.asarray(column) for column in columns]
+    if not columns:
+        raise ValueError('at least one column is needed')
+    if any(column.shape != (len(columns[0]),) for column in columns):
+        raise ValueError('columns must be one-dimensional and of equal '
+                'length')
+    return columns
+
+def match_columns(matcher, columns, dispatch=False, args=()):
+    """
+    Match each row of a columnar batch against `matcher`'s cases. See
+    :func:`pyfpm.matcher.Matcher.match_columns`.
+
+    """
+    batch = _Batch(_as_columns(columns))
+    winners = np.full(batch.size, -1, dtype=np.intp)
+    undecided = np.ones(batch.size, bool)
+    names = {}
+    for position, (pattern, handler) in enumerate(matcher.bindings):
+        if (matcher.prune and
+                matcher._cases_in_order[position] in matcher._unreachable):
+            continue
+        if not undecided.any():
+            break
+        try:
+            mask, names[position] = batch.case(pattern)
+            mask &= undecided
+        except _NotVectorizable:
+            rows = batch.rows()
+            mask = np.zeros(batch.size, bool)
+            for i in np.flatnonzero(undecided).tolist():
+                mask[i] = pattern.match(rows[i]) is not None
+        winners[mask] = position
+        undecided &= ~mask
+    if not dispatch:
+        return winners
+    if matcher.extra_args is not None and len(args) != matcher.extra_args:
+        _wrong_arity(matcher.extra_args, args)
+    results = []
+    rows = batch.rows()
+    for row, position in zip(rows, winners.tolist()):
+        if position < 0:
+            raise NoMatch(obj=row)
+        case = matcher._cases_in_order[position]
+        if position in names:
+            ctx = dict((name, row[i])
+                    for (name, i) in names[position].items())
+        else:
+            ctx = case.pattern.match(row).ctx
+        result = case.plan.call(case.handler, args, ctx)
+        if result.__class__ is TailCall:
+            result = result.matcher.match(result.obj, *result.args)
+        results.append(result)
+    return results
@@ -0,0 +1,118 @@
+import asyncio
+import unittest
+
+from pyfpm.matcher import Matcher, NoMatch
+
+def _run(coroutine):
+    return asyncio.run(coroutine)
+
+async def _collect(aiterable):
+    return [x async for x in aiterable]
+
+class TestAsyncMatch(unittest.TestCase):
+    def test_sync_handler(self):
+        m = Matcher([('x', lambda x: x)])
+        self.assertEqual(_run(m.amatch(1)), 1)
+
+    def test_async_handler(self):
+        m = Matcher()
+        @m.handler('x:int')
+        async def double(x):
+            await asyncio.sleep(0)
+            return x * 2
+        self.assertEqual(_run(m.amatch(2)), 4)
+
+    def test_extra_args(self):
+        async def f(extra, x):
+            return (extra, x)
+        m = Matcher([('x', f)])
+        self.assertEqual(_run(m.amatch(1, 'extra')), ('extra', 1))
+
+    def test_nomatch(self):
+        m = Matcher([('_:int', lambda: None)])
+        try:
+            _run(m.amatch('abc'))
+            self.fail('should fail with NoMatch')
+        except NoMatch:
+            pass
+
+class TestAsyncDispatch(unittest.TestCase):
+    def test_order(self):
+        async def slow(x):
+            await asyncio.sleep(0.01 * (3 - x))
+            return x
+        m = Matcher([('x:int', slow), ('x', lambda x: x)])
+        self.assertEqual(
+                _run(_collect(m.adispatch([0, 'a', 1, 2], concurrency=3))),
+                [0, 'a', 1, 2])
+
+    def test_async_iterable(self):
+        async def source():
+            for x in range(5):
+                await asyncio.sleep(0)
+                yield x
+        m = Matcher([('x', lambda x: -x)])
+        self.assertEqual(_run(_collect(m.adispatch(source()))),
+                [0, -1, -2, -3, -4])
+
+    def test_bounded_concurrency(self):
+        state = {'running': 0, 'peak': 0}
+        async def handler(x):
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+            await asyncio.sleep(0.001)
+            state['running'] -= 1
+            return x
+        m = Matcher([('x', handler)])
+        results = _run(_collect(m.adispatch(range(20), concurrency=4)))
+        self.assertEqual(results, list(range(20)))
+        self.assertTrue(state['peak'] <= 4)
+        self.assertTrue(state['peak'] > 1)
+
+    def test_backpressure(self):
+        pulled = []
+        def source():
+            for x in range(10):
+                pulled.append(x)
+                yield x
+        async def handler(x):
+            await asyncio.sleep(0)
+            return x
+        m = Matcher([('x', handler)])
+        async def first():
+            agen = m.adispatch(source(), concurrency=2)
+            result = await agen.__anext__()
+            await agen.aclose()
+            return result
+        self.assertEqual(_run(first()), 0)
+        self.assertTrue(len(pulled) <= 3)
+
+    def test_nomatch_in_order(self):
+        m = Matcher([('x:int', lambda x: x)])
+        results = []
+        async def consume():
+            async for x in m.adispatch([1, 2, 'a', 3], concurrency=2):
+                results.append(x)
+        try:
+            _run(consume())
+            self.fail('should fail with NoMatch')
+        except NoMatch:
+            pass
+        self.assertEqual(results, [1, 2])
+
+    def test_tailcall(self):
+        async def countdown(x):
+            await asyncio.sleep(0)
+            return m.tailcall(x - 1) if x else 'done'
+        m = Matcher([('x:int', countdown)])
+        self.assertEqual(
+                _run(_collect(m.adispatch([2, 0, 3], concurrency=2))),
+                ['done', 'done', 'done'])
+
+    def test_bad_concurrency(self):
+        m = Matcher([('x', lambda x: x)])
+        try:
+            _run(_collect(m.adispatch([1], concurrency=0)))
+            self.fail()
+        except ValueError:
+            pass
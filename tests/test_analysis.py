@@ -0,0 +1,242 @@
+import unittest
+import warnings
+
+from pyfpm import analysis
+from pyfpm.matcher import Matcher
+from pyfpm.parser import Parser
+from pyfpm.pattern import build as _, ClassPattern, InstanceOfPattern
+
+try:
+    from collections import namedtuple
+    Case2 = namedtuple('Case2', 'a b')
+except ImportError:
+    pass
+
+class Shape(object):
+    pass
+
+class Circle(Shape):
+    __match_args__ = ('radius',)
+
+class Polygon(Shape):
+    pass
+
+class Square(Polygon):
+    pass
+
+class Triangle(Polygon):
+    pass
+
+class TestSubsumes(unittest.TestCase):
+    def setUp(self):
+        self.parse = Parser()
+
+    def assertSubsumes(self, general, specific):
+        self.assertTrue(analysis.subsumes(self.parse(general),
+            self.parse(specific)), '%s should subsume %s' % (general, specific))
+
+    def assertNotSubsumes(self, general, specific):
+        self.assertFalse(analysis.subsumes(self.parse(general),
+            self.parse(specific)), '%s should not subsume %s' % (general,
+                specific))
+
+    def test_any(self):
+        self.assertSubsumes('x', '1')
+        self.assertSubsumes('_', '[a, b]')
+        self.assertSubsumes('_', 'x:int if x > 0')
+        self.assertNotSubsumes('1', '_')
+
+    def test_constants(self):
+        self.assertSubsumes('1', '1')
+        self.assertNotSubsumes('1', '2')
+        self.assertNotSubsumes('1', 'True')
+        self.assertNotSubsumes('1', '1.0')
+
+    def test_types(self):
+        self.assertSubsumes('_:str', '"a"')
+        self.assertSubsumes('_:object', '1')
+        self.assertSubsumes('_:int', '_:bool')
+        self.assertSubsumes('_:object', '[]')
+        self.assertSubsumes('_:Shape', 'Circle(r)')
+        self.assertSubsumes('_:tuple', 'Case2(1, 2)')
+        self.assertNotSubsumes('_:int', '"a"')
+        self.assertNotSubsumes('_:bool', '_:int')
+        self.assertNotSubsumes('_:tuple', '[]')
+
+    def test_lists(self):
+        self.assertSubsumes('[]', '[]')
+        self.assertSubsumes('[_, _]', '[1, "a"]')
+        self.assertSubsumes('h :: t', '[1, 2, 3]')
+        self.assertSubsumes('[_:str, x]', '["a", 2]')
+        self.assertNotSubsumes('[]', '[_]')
+        self.assertNotSubsumes('[_]', '[_, _]')
+        self.assertNotSubsumes('[_, _]', 'h :: t')
+
+    def test_long_lists(self):
+        items = list(range(5000))
+        self.assertTrue(analysis.subsumes(_(items), _(items)))
+        self.assertFalse(analysis.subsumes(_(items), _(items + [0])))
+
+    def test_tuples_of_types(self):
+        ints_or_strs = InstanceOfPattern((int, str))
+        self.assertTrue(analysis.subsumes(_(object), ints_or_strs))
+        self.assertTrue(analysis.subsumes(ints_or_strs, _(bool)))
+        self.assertFalse(analysis.subsumes(_(int), ints_or_strs))
+        self.assertTrue(analysis.subsumes(
+            ClassPattern(Shape), InstanceOfPattern((Circle, Square))))
+        self.assertFalse(analysis.subsumes(
+            ClassPattern(Circle), InstanceOfPattern((Circle, Square))))
+
+    def test_or(self):
+        self.assertSubsumes('1 | 2', '2')
+        self.assertSubsumes('_:str', '"a" | "b"')
+        self.assertSubsumes('1 | 2 | 3', '3 | 1')
+        self.assertNotSubsumes('1 | 2', '1 | 3')
+
+    def test_regex(self):
+        self.assertSubsumes('/a+/', '/a+/')
+        self.assertSubsumes('/a+/', '"aaa"')
+        self.assertNotSubsumes('/a+/', '"b"')
+
+    def test_named_tuples(self):
+        self.assertSubsumes('Case2(_, _)', 'Case2(1, x)')
+        self.assertSubsumes('Case2(a, b)', '_:Case2')
+        self.assertSubsumes('Case2(_:str, _)', 'Case2("a", x)')
+        self.assertNotSubsumes('Case2(1, _)', 'Case2(x, 1)')
+
+    def test_class_patterns(self):
+        self.assertSubsumes('Circle()', 'Circle(1)')
+        self.assertSubsumes('Circle(_)', 'Circle(radius=1)')
+        self.assertSubsumes('Circle(r)', '_:Circle')
+        self.assertSubsumes('Shape()', 'Circle(1)')
+        self.assertNotSubsumes('Circle(1)', 'Circle()')
+        self.assertNotSubsumes('Circle(x=_)', '_:Circle')
+
+    def test_mappings(self):
+        self.assertSubsumes('{}', "{'a': 1}")
+        self.assertSubsumes("{'a': _:str}", "{'a': 'b', 'b': 2}")
+        self.assertNotSubsumes("{'a': 1, 'b': 2}", "{'a': 1}")
+
+    def test_constants_of_open_types(self):
+        # 1 == 1.0 == Decimal(1), so `1` also matches objects of other types
+        self.assertNotSubsumes('_:int', '1')
+        self.assertNotSubsumes('_:int', '1 | 2')
+        self.assertNotSubsumes('[_:int, x]', '[1, 2]')
+        self.assertNotSubsumes('_:bytes', "b'a'")
+        for general, specific in [('_:int', '1'), ('_:int', '1 | 2'),
+                ('[_:int, x]', '[1, 2]'), ("{'a': _:int}", "{'a': 1}")]:
+            self.assertTrue(analysis.subsumes(Parser()(general),
+                Parser()(specific), loose=True))
+
+    def test_conditions_never_subsume(self):
+        self.assertNotSubsumes('x if True', '1')
+        self.assertFalse(analysis.subsumes(
+            _(_().if_(lambda: True), _()), _(1, 2)))
+
+    def test_repeated_names_never_subsume(self):
+        self.assertNotSubsumes('[x, x]', '[1, 1]')
+        self.assertSubsumes('[x, y]', '[x, x]')
+
+class TestUnreachable(unittest.TestCase):
+    def test_unreachable_cases(self):
+        bindings = [(_(int), None), (_(1), None), (_(), None), (_([]), None)]
+        self.assertEqual(analysis.unreachable_cases(bindings), [(3, 2)])
+        self.assertEqual(analysis.unreachable_cases(bindings, loose=True),
+                [(1, 0), (3, 2)])
+
+    def test_warning(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', analysis.UnreachableCaseWarning)
+            m = Matcher([('x', lambda x: x), ('1', lambda: 1)], analyze=True)
+        caught = [w for w in caught
+                if issubclass(w.category, analysis.UnreachableCaseWarning)]
+        self.assertEqual(len(caught), 1)
+        self.assertTrue(issubclass(caught[0].category,
+            analysis.UnreachableCaseWarning))
+        self.assertEqual(len(m.bindings), 2)
+
+    def test_no_warning_by_default(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', analysis.UnreachableCaseWarning)
+            Matcher([('x', lambda x: x), ('1', lambda: 1)])
+        self.assertEqual([w for w in caught
+            if issubclass(w.category, analysis.UnreachableCaseWarning)], [])
+
+    def test_prune(self):
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            m = Matcher([
+                ('_:str', lambda: 'str'),
+                ('"a"', lambda: 'a'),
+                ('x', lambda x: x),
+                ], prune=True)
+        self.assertEqual(len(m.bindings), 3)
+        self.assertEqual(len(m._cases('a')), 2)
+        self.assertEqual(m('a'), 'str')
+        self.assertEqual(m(1), 1)
+
+    def test_constants_of_open_types_not_pruned(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', analysis.UnreachableCaseWarning)
+            m = Matcher([
+                ('_:int', lambda: 'int'),
+                ('1', lambda: 'one'),
+                ('x', lambda x: 'other'),
+                ], prune=True)
+        caught = [w for w in caught
+                if issubclass(w.category, analysis.UnreachableCaseWarning)]
+        self.assertEqual(len(caught), 1)
+        self.assertTrue('equal objects of other types' in
+                str(caught[0].message))
+        self.assertEqual(m(1), 'int')
+        self.assertEqual(m(1.0), 'one')
+        self.assertEqual(m('a'), 'other')
+
+    def test_prune_long_patterns(self):
+        items = [int] * 5000
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            m = Matcher([
+                (_(*items), lambda: 'first'),
+                (_(*items), lambda: 'second'),
+                ], prune=True)
+        self.assertEqual(len(m._cases(list(range(5000)))), 1)
+
+    def test_prune_after_updates(self):
+        unreachable = lambda: [w for w in caught
+                if issubclass(w.category, analysis.UnreachableCaseWarning)]
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', analysis.UnreachableCaseWarning)
+            m = Matcher(prune=True)
+            ints = m.register('_:int', lambda: 'int')
+            m.register('1', lambda: 'one')
+            other = m.register('x', lambda x: x)
+            self.assertEqual(m(1), 'int')
+            m.unregister(ints)
+            self.assertEqual(m(1), 'one')
+            self.assertEqual(len(unreachable()), 1)
+            m.replace(other, '_:int', lambda: 'int')
+            self.assertEqual(len(unreachable()), 1)
+            m.replace(m._cases_in_order[0], 'x', lambda x: 'any')
+            self.assertEqual(len(unreachable()), 2)
+        self.assertEqual(len(m._cases(1)), 1)
+        self.assertEqual(m(1), 'any')
+
+class TestMissingCases(unittest.TestCase):
+    def test_exhaustive(self):
+        bindings = [(_(Circle), None), (_(Polygon), None)]
+        self.assertEqual(analysis.missing_cases(bindings, Shape), [])
+
+    def test_gaps(self):
+        bindings = [(ClassPattern(Circle, _(1)), None), (_(Square), None)]
+        self.assertEqual(analysis.missing_cases(bindings, Shape),
+                [Circle, Triangle])
+
+    def test_conditional_cases_dont_count(self):
+        bindings = [(_(Shape).if_(lambda: True), None)]
+        self.assertEqual(analysis.missing_cases(bindings, Shape),
+                [Circle, Square, Triangle])
+
+    def test_named_tuple_leaf(self):
+        bindings = [(_(Case2(_(), _())), None)]
+        self.assertEqual(analysis.missing_cases(bindings, Case2), [])
@@ -0,0 +1,129 @@
+import unittest
+from collections import namedtuple
+
+from pyfpm.matcher import Matcher, NoMatch
+from pyfpm.pattern import build as _, ClassPattern
+from pyfpm.codegen import compile_matcher, generate, NATIVE_MATCH
+
+Case2 = namedtuple('Case2', 'a b')
+
+class Point(object):
+    __match_args__ = ('x', 'y')
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+def _compare(test, m, objects):
+    f = compile_matcher(m)
+    for obj in objects:
+        try:
+            expected = m(obj)
+        except NoMatch:
+            try:
+                f(obj)
+                test.fail('%r should not match' % (obj,))
+            except NoMatch:
+                pass
+            continue
+        test.assertEquals(f(obj), expected)
+    return f
+
+@unittest.skipUnless(NATIVE_MATCH, 'no native match statement')
+class TestCodegen(unittest.TestCase):
+    def test_constants_and_types(self):
+        m = Matcher([
+            ('1 | 2', lambda: 'small'),
+            ('x:int', lambda x: x),
+            ('_:str', lambda: 'str'),
+            ])
+        f = _compare(self, m, [1, 2, 3, 'abc', None])
+        self.assertEquals(f.native, [0, 1, 2])
+
+    def test_sequences(self):
+        m = Matcher([
+            ('[]', lambda: 'empty'),
+            ('[x]', lambda x: ('one', x)),
+            ('a :: b :: rest', lambda a, b, rest: (a, b, rest)),
+            ])
+        _compare(self, m, [[], [1], (1, 2), [1, 2, 3], (1, 2, 3)])
+
+    def test_named_tuples_and_classes(self):
+        m = Matcher([
+            (_(Case2(1, _()%'b')), lambda b: ('case', b)),
+            (ClassPattern(Point, _(0), y=_()%'y'), lambda y: ('point', y)),
+            ])
+        _compare(self, m, [Case2(1, 2), Case2(2, 2), Point(0, 3),
+            Point(1, 3)])
+
+    def test_mappings(self):
+        m = Matcher([("{'type': 'add', 'args': [a, b]}", lambda a, b: a + b)])
+        _compare(self, m, [{'type': 'add', 'args': [1, 2], 'x': 0},
+            {'type': 'sub', 'args': [1, 2]}, {}])
+
+    def test_conditions(self):
+        m = Matcher([
+            ('[x, y] if x < y', lambda x, y: 'ascending'),
+            ('[x, y]', lambda x, y: 'other'),
+            ])
+        f = _compare(self, m, [[1, 2], [2, 1]])
+        self.assertEquals(f.native, [0, 1])
+
+    def test_repeated_names(self):
+        m = Matcher([('[x, x]', lambda x: x)])
+        _compare(self, m, [[1, 1], [1, 2]])
+
+    def test_fallback(self):
+        m = Matcher([
+            ('[x] | [_, y]', lambda **kwargs: kwargs),
+            ('s:str', lambda s: s.upper()),
+            ('[(h :: t) | []]', lambda **kwargs: kwargs),
+            ])
+        f = _compare(self, m, [[1], [1, 2], 'a', [[1, 2]], [[]], [1, 2, 3]])
+        self.assertEquals(f.native, [1])
+
+    def test_regex_fallback(self):
+        m = Matcher([
+            ('/(a+)b/', lambda: 'ab'),
+            ('s', lambda s: s),
+            ])
+        f = _compare(self, m, ['aab', 'b'])
+        self.assertEquals(f.native, [1])
+
+    def test_catch_all(self):
+        m = Matcher([('x', lambda x: x), ('y', lambda y: None)])
+        f = _compare(self, m, [1, 'a'])
+        self.assertEquals(f.native, [0])
+
+    def test_extra_args(self):
+        m = Matcher([('x', lambda extra, x: (extra, x))])
+        self.assertEquals(compile_matcher(m)(1, 'e'), ('e', 1))
+
+    def test_call_plans(self):
+        m = Matcher([('[x, y] if y > 0', lambda x: x),
+            ('[x, y] | [x, y, _]', lambda x, *rest: (x, rest)),
+            ('x', lambda extra, x: (extra, x))])
+        f = compile_matcher(m)
+        self.assertEquals(f([1, 2]), 1)
+        self.assertEquals(f([1, 0]), (1, ()))
+        self.assertEquals(f(1, 'e'), ('e', 1))
+        m = Matcher([('[x, y] if y > 0', lambda extra, x: (extra, x)),
+            ('x', lambda extra, x: (extra, x))], extra_args=1)
+        f = compile_matcher(m)
+        self.assertEquals(f([1, 2], 'e'), ('e', 1))
+        self.assertEquals(f(3, 'e'), ('e', 3))
+        self.assertRaises(TypeError, f, 3)
+
+    def test_tailcall(self):
+        m = Matcher()
+        m.register('0', lambda: 'done')
+        m.register('n:int', lambda n: m.tailcall(n - 1))
+        self.assertEquals(compile_matcher(m)(10000), 'done')
+
+    def test_generate(self):
+        source, namespace, native = generate([(_(1), None)])
+        self.assertTrue('match _subject:' in source)
+        self.assertEquals(native, [0])
+        self.assertEquals(namespace['_k'].c0, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+from collections import namedtuple
+
+from pyfpm.compact import CompactMatcher
+from pyfpm.matcher import Matcher, TailCall
+from pyfpm.pattern import build as _
+
+Point = namedtuple('Point', 'x y')
+
+SUBJECTS = [
+    1, 2, 'abc', 'GET /', (), [], '', (1, 2), (1, 2, 3), (1, (2, 3)),
+    ('a', 'a'), ('a', 'b'), [1, 'x', 2.5], {'type': 'a', 'n': 1},
+    {'type': 'b', 'n': -1}, {'type': 'a'}, Point(1, 2), Point(0, 2), None,
+    b'\x01\x02', set([1]),
+]
+
+class TestCompactMatcher(unittest.TestCase):
+    def assertSameResults(self, matcher):
+        compact = matcher.compact()
+        for subject in SUBJECTS:
+            try:
+                expected = matcher(subject)
+            except Exception as e:
+                # e.g. NoMatch, or KeyError for dicts against list patterns
+                self.assertRaises(e.__class__, compact, subject)
+            else:
+                self.assertEquals(compact(subject), expected)
+
+    def test_equivalence(self):
+        self.assertSameResults(Matcher([
+            ('[]', lambda: 'empty'),
+            ('[x, x]', lambda x: ('same', x)),
+            ('[x:int, [y, z]]', lambda x, y, z: ('nested', x, y, z)),
+            ('[_:int, _:str, f:float]', lambda f: ('typed', f)),
+            ('1 | 2 | None', lambda: 'small'),
+            ("{'type': 'a', 'n': n}", lambda n: ('a', n)),
+            ("{'type': t, 'n': n} if n < 0", lambda t, n: ('negative', t)),
+            ("'GET ' :: path", lambda path: ('get', path)),
+            ('Point(0, y)', lambda y: ('on axis', y)),
+            ('head :: tail', lambda head, tail: (head, tail)),
+            ]))
+
+    def test_alternatives(self):
+        self.assertSameResults(Matcher([
+            ('[x:int, 1] | [1, x:int]', lambda x: ('one', x)),
+            ('([x, y] | [x, y, _]) if x == y', lambda x, y: ('eq', x)),
+            ('[x:str] | [x:int, _] | [_, x:int, _]', lambda x: ('alt', x)),
+            ]))
+
+    def test_call_plans(self):
+        m = Matcher([('[x, y] if y > 0', lambda x: x),
+            ('x', lambda extra, x: (extra, x))])
+        compact = m.compact()
+        self.assertEquals(compact([1, 2]), 1)
+        self.assertEquals(compact(1, 'e'), ('e', 1))
+        m = Matcher([('x', lambda extra, x: (extra, x))], extra_args=1)
+        compact = m.compact()
+        self.assertEquals(compact(1, 'e'), ('e', 1))
+        self.assertRaises(TypeError, compact, 1)
+
+    def test_tailcall(self):
+        length = Matcher()
+        length.register('[]', lambda acc: acc)
+        length.register('_ :: tail',
+                lambda acc, tail: TailCall(compact, tail, (acc + 1,)))
+        compact = length.compact()
+        self.assertEquals(compact([None] * 5000, 0), 5000)
+
+    def test_index(self):
+        m = Matcher([("{'type': %d, 'n': n}" % i, lambda n, i=i: (i, n))
+            for i in range(50)])
+        compact = m.compact()
+        self.assertEquals(list(compact._index.cases({'type': 7})), [7])
+        self.assertEquals(compact({'type': 7, 'n': 'x'}), (7, 'x'))
+
+    def test_disassemble(self):
+        compact = CompactMatcher([(_(_(int)%'x', _()), None)])
+        self.assertEquals(compact.disassemble(0).split('\n'), [
+            '   0 LEN_EQ 2', '   2 ITEM 0', '   4 TYPE int', '   6 BIND \'x\'',
+            '   8 POP', '  10 DONE'])
@@ -0,0 +1,90 @@
+import unittest
+
+from pyfpm.explain import explain, NodeStats
+from pyfpm.matcher import Matcher
+from pyfpm.parser import Parser
+from pyfpm.pattern import build as _
+
+class TestExplain(unittest.TestCase):
+    def setUp(self):
+        self.parse = Parser()
+
+    def stats(self, explanation, label):
+        for node in explanation.nodes:
+            if node.label == label:
+                return node
+        self.fail('no node %s in\n%s' % (label, explanation))
+
+    def test_counts(self):
+        e = explain(self.parse('[x:int, _:str]'), (1, 'a'), (1, 2), ('a', 1),
+                [])
+        self.assertEquals((e.runs, e.matches), (4, 1))
+        top = e.nodes[0]
+        self.assertEquals((top.visits, top.matched, top.failed), (4, 1, 3))
+        x = self.stats(e, 'InstanceOfPattern(cls=int) x')
+        self.assertEquals((x.visits, x.matched, x.failed, x.first),
+                (3, 2, 1, 1))
+        s = self.stats(e, 'InstanceOfPattern(cls=str)')
+        self.assertEquals((s.visits, s.matched, s.failed, s.first),
+                (2, 1, 1, 1))
+        # the empty list is rejected by the top node itself
+        self.assertEquals(top.first, 1)
+
+    def test_or_branches(self):
+        e = explain(self.parse('1 | 2 | 3'), 3, 2, 4)
+        counts = [(n.visits, n.matched) for n in e.nodes[1:]]
+        self.assertEquals(counts, [(3, 0), (3, 1), (2, 1)])
+
+    def test_recovered_failures_not_first(self):
+        e = explain(self.parse('[1 | 2, 3]'), [2, 4])
+        self.assertEquals(self.stats(e, 'EqualsPattern(obj=1)').first, 0)
+        self.assertEquals(self.stats(e, 'EqualsPattern(obj=3)').first, 1)
+
+    def test_long_patterns(self):
+        e = explain(_(*range(5000)), [1])
+        self.assertEquals(len(e.nodes), 10001)
+        self.assertEquals(e.nodes[-2].depth, 5000)
+        self.assertEquals(self.stats(e, 'EqualsPattern(obj=0)').first, 1)
+
+    def test_guards(self):
+        e = explain(self.parse('[level:int, [a, b]] if level > 3'),
+                (1, (2, 3)), (5, (2, 3)))
+        guard = self.stats(e, 'if level > 3')
+        self.assertEquals((guard.visits, guard.matched, guard.failed,
+            guard.first), (2, 1, 1, 1))
+        # the failing guard rejects the object before the rest is visited
+        self.assertEquals(self.stats(e, 'AnyPattern a').visits, 1)
+
+    def test_original_untouched(self):
+        p = self.parse('[x, y] if x')
+        explain(p, (1, 2))
+        self.assertEquals(p, self.parse('[x, y] if x'))
+        self.assertFalse('match' in p.__dict__)
+
+    def test_result(self):
+        e = explain(_(int)%'x')
+        self.assertEquals(e.run(1).ctx, {'x': 1})
+        self.assertFalse(e.run('a'))
+
+    def test_report(self):
+        e = explain(self.parse('x:int'), 1)
+        report = e.report()
+        self.assertTrue(report.startswith('InstanceOfPattern(cls=int) x'))
+        self.assertTrue('time=' in report)
+        self.assertFalse('time=' in e.report(timing=False))
+        self.assertTrue(isinstance(e.nodes[0], NodeStats))
+
+class TestExplainMatcher(unittest.TestCase):
+    def test_dispatch_order(self):
+        m = Matcher([
+            ('_:int', lambda: 'int'),
+            ('_:str', lambda: 'str'),
+            ('_', lambda: 'other'),
+            ])
+        first, second, third = m.explain(1, 'a', None, 2)
+        self.assertEquals((first.runs, first.matches), (4, 2))
+        self.assertEquals((second.runs, second.matches), (2, 1))
+        self.assertEquals((third.runs, third.matches), (1, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from pyfpm import loader
+from pyfpm.loader import LoadError
+from pyfpm.matcher import Matcher, Case
+
+class Point(object):
+    __match_args__ = ('x', 'y')
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+def origin():
+    return 'origin'
+
+def ordered(x, y):
+    return 'ordered'
+
+class Handlers(object):
+    @staticmethod
+    def on_axis(y):
+        return 'on axis %d' % y
+
+not_callable = 42
+
+TABLE = u'''
+# points
+Point(0, 0) => origin
+Point(0, y:int) => Handlers.on_axis
+
+[x:int, y:int] if x < y => test_loader:ordered
+None => pyfpm.loader:not_found
+_ => origin
+'''
+
+class TestLoader(unittest.TestCase):
+    def setUp(self):
+        self.matcher = Matcher()
+        table = TABLE.replace('test_loader', __name__)
+        self.stream = StringIO(table)
+
+    def test_load_stream(self):
+        cases = self.matcher.load(self.stream)
+        self.assertEquals(len(cases), 5)
+        self.assertTrue(all(isinstance(case, Case) for case in cases))
+        self.assertEquals(self.matcher(Point(0, 0)), 'origin')
+        self.assertEquals(self.matcher(Point(0, 2)), 'on axis 2')
+        self.assertEquals(self.matcher((1, 2)), 'ordered')
+        self.assertEquals(self.matcher((2, 1)), 'origin')
+        self.assertEquals(self.matcher(None), None)
+
+    def test_load_path(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'routes.txt')
+            with open(path, 'w') as f:
+                f.write(self.stream.getvalue())
+            self.matcher.load(path)
+            self.matcher.load(path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEquals(len(self.matcher.bindings), 10)
+        self.assertEquals(self.matcher(Point(0, 2)), 'on axis 2')
+
+    def test_handlers_resolved_once(self):
+        self.matcher.load(StringIO(u'1 => origin\n2 => origin\n'))
+        first, second = self.matcher.bindings
+        self.assertTrue(first[1] is second[1] is origin)
+
+    def test_all_errors_reported(self):
+        self.matcher.register('_', origin)
+        table = StringIO(u'\n'.join([
+            '[x, => origin',
+            '1 => origin',
+            'no arrow',
+            'x:Unknown => origin',
+            '2 => missing',
+            '3 => not_callable',
+            '4 => no.such.module:f',
+            '/[a/ => origin',
+            ]))
+        try:
+            self.matcher.load(table)
+        except LoadError as e:
+            self.assertEquals([lineno for (lineno, message) in e.errors],
+                    [1, 3, 4, 5, 6, 7, 8])
+            self.assertTrue('line 5: cannot resolve handler missing' in
+                    str(e))
+            self.assertTrue('line 8: bad regular expression' in str(e))
+            self.assertTrue(str(e).startswith('7 errors in <stream>:'))
+        else:
+            self.fail('LoadError not raised')
+        self.assertEquals(len(self.matcher.bindings), 1)
+
+    def test_handler_arguments_checked(self):
+        self.matcher = Matcher(extra_args=0)
+        table = StringIO(u'\n'.join([
+            'x => origin',
+            '_ => Handlers.on_axis',
+            'Point(0, x) => Handlers.on_axis',
+            'Point(0, y) => Handlers.on_axis',
+            ]))
+        try:
+            self.matcher.load(table)
+        except LoadError as e:
+            self.assertEquals([lineno for (lineno, message) in e.errors],
+                    [2, 3])
+            self.assertTrue('line 2: handler on_axis requires y' in str(e))
+        else:
+            self.fail('LoadError not raised')
+        self.assertEquals(self.matcher.bindings, [])
+
+    def test_processes(self):
+        table = self.stream.getvalue() * 3
+        serial = Matcher()
+        serial.load(StringIO(table))
+        pooled = Matcher()
+        original, loader.CHUNK_LINES = loader.CHUNK_LINES, 2
+        try:
+            pooled.load(StringIO(table), processes=2)
+        finally:
+            loader.CHUNK_LINES = original
+        self.assertEquals(pooled.bindings, serial.bindings)
+        self.assertEquals(pooled((1, 2)), 'ordered')
+        self.assertEquals(pooled((2, 1)), 'origin')
+
+    def test_processes_need_a_module_context(self):
+        m = Matcher(context={'origin': origin})
+        self.assertRaises(ValueError, m.load, StringIO(u'_ => origin\n'),
+                processes=2)
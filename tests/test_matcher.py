@@ -1,7 +1,9 @@
 import unittest
 
-from pyfpm.matcher import Matcher, NoMatch, match_args, Unpacker
-from pyfpm.pattern import build as _
+from pyfpm import matcher
+from pyfpm.matcher import (Matcher, NoMatch, NO_MATCH, match_args,
+        Unpacker, unpack)
+from pyfpm.pattern import build as _, OrPattern
 
 class TestMatcher(unittest.TestCase):
     def test_constructor(self):
@@ -69,6 +71,350 @@ class TestMatcher(unittest.TestCase):
         self.assertEquals(m.bindings[0][0], _(TestMatcher)%'y')
         m(self)
 
+class TestKeyIndex(unittest.TestCase):
+    def setUp(self):
+        self.m = Matcher([
+            ("{'type': 'a', 'x': x}", lambda x: ('a', x)),
+            ("{'type': 'b'|'c'}", lambda: 'b or c'),
+            ("{'x': 1}", lambda: 'x is 1'),
+            ("{'type': 'a'}", lambda: 'just a'),
+            ('_', lambda: 'anything'),
+            ])
+
+    def test_dispatch(self):
+        m = self.m
+        self.assertEquals(m({'type': 'a', 'x': 2}), ('a', 2))
+        self.assertEquals(m({'type': 'a'}), 'just a')
+        self.assertEquals(m({'type': 'b'}), 'b or c')
+        self.assertEquals(m({'type': 'c', 'x': 1}), 'b or c')
+        self.assertEquals(m({'type': 'd', 'x': 1}), 'x is 1')
+        self.assertEquals(m({'x': 1}), 'x is 1')
+        self.assertEquals(m({'type': []}), 'anything')
+        self.assertEquals(m([]), 'anything')
+
+    def test_order_preserved(self):
+        m = Matcher([
+            ("{'type': 'a'} if False", lambda: 'never'),
+            ('{}', lambda: 'any mapping'),
+            ("{'type': 'a'}", lambda: 'a'),
+            ])
+        self.assertEquals(m({'type': 'a'}), 'any mapping')
+
+    def test_register_after_match(self):
+        m = Matcher([
+            ("{'type': 'a'}", lambda: 'a'),
+            ("{'type': 'b'}", lambda: 'b'),
+            ])
+        self.assertEquals(m({'type': 'a'}), 'a')
+        m.register("{'type': 'z'}", lambda: 'z')
+        m.register('_', lambda: 'anything')
+        self.assertEquals(m({'type': 'z'}), 'z')
+        self.assertEquals(m({'type': 'y'}), 'anything')
+
+    def test_equal_values(self):
+        m = Matcher([
+            ("{'n': 1}", lambda: 'one'),
+            ("{'n': 2}", lambda: 'two'),
+            ])
+        self.assertEquals(m({'n': 1.0}), 'one')
+        self.assertEquals(m({'n': True}), 'one')
+
+class TestTrieIndex(unittest.TestCase):
+    def setUp(self):
+        self.m = Matcher([
+            ("'GET /api/' :: rest", lambda rest: ('api', rest)),
+            ("'GET ' :: path", lambda path: ('get', path)),
+            ("'POST ' :: 'form/' :: name", lambda name: ('form', name)),
+            ("'HEAD' | 'OPTIONS'", lambda: 'meta'),
+            ('[x:str, y] if x == "GET "', lambda x, y: ('list', y)),
+            ("'POST ' :: body", lambda body: ('post', body)),
+            ('_', lambda: None),
+            ])
+
+    def test_dispatch(self):
+        m = self.m
+        self.assertEquals(m('GET /api/users'), ('api', 'users'))
+        self.assertEquals(m('GET /'), ('get', '/'))
+        self.assertEquals(m('POST form/x'), ('form', 'x'))
+        self.assertEquals(m('POST data'), ('post', 'data'))
+        self.assertEquals(m('HEAD'), 'meta')
+        self.assertEquals(m('OPTIONS'), 'meta')
+        self.assertEquals(m('HEADER'), None)
+        self.assertEquals(m('GET'), None)
+        self.assertEquals(m(''), None)
+        self.assertEquals(m(['GET ', 1]), ('get', [1]))
+        self.assertEquals(m(('x', 1)), None)
+
+    def test_candidates(self):
+        m = self.m
+        m('warm up the index')
+        self.assertEquals(len(m._cases('GET /api/x')), 4)
+        self.assertEquals(len(m._cases('PUT /')), 2)
+        self.assertEquals(len(m._cases(['GET '])), 7)
+
+    def test_order_preserved(self):
+        m = Matcher([
+            ("'a' :: x", lambda x: 'a'),
+            ('_:str', lambda: 'str'),
+            ("'ab' :: x", lambda x: 'ab'),
+            ])
+        self.assertEquals(m('abc'), 'a')
+        self.assertEquals(m('b'), 'str')
+
+class TestUpdates(unittest.TestCase):
+    def test_register_returns_case(self):
+        m = Matcher()
+        case = m.register('x:int', lambda x: x)
+        self.assertEquals(tuple(case), m.bindings[0])
+
+    def test_unregister(self):
+        m = Matcher()
+        one = m.register('1', lambda: 'one')
+        m.register('_', lambda: 'any')
+        self.assertEquals(m(1), 'one')
+        m.unregister(one)
+        self.assertEquals(m(1), 'any')
+        self.assertEquals(len(m.bindings), 1)
+        self.assertRaises(ValueError, m.unregister, one)
+        self.assertRaises(ValueError, Matcher().unregister, one)
+
+    def test_replace_keeps_position(self):
+        m = Matcher()
+        first = m.register('1', lambda: 'one')
+        m.register('x', lambda x: x)
+        m.replace(first, 'x:str', lambda x: 'str')
+        self.assertEquals(m('a'), 'str')
+        self.assertEquals(m(1), 1)
+        self.assertEquals(m.bindings[0][0], _(str)%'x')
+
+    def test_index_patched_in_place(self):
+        m = Matcher([("{'type': %d, 'n': n}" % i, lambda n, i=i: (i, n))
+            for i in range(10)])
+        self.assertEquals(m({'type': 3, 'n': 1}), (3, 1))
+        index = m._index
+        new = m.register("{'type': 3}", lambda: 'new')
+        fallback = m.register('_', lambda: 'fallback')
+        m.unregister(m._cases_in_order[3])
+        self.assertTrue(m._index is index)
+        self.assertEquals(m({'type': 3, 'n': 1}), 'new')
+        self.assertEquals(m({'type': 4, 'n': 1}), (4, 1))
+        self.assertEquals(m({'type': 42}), 'fallback')
+        m.replace(new, "{'type': 4}", lambda: 'four')
+        self.assertEquals(m({'type': 4, 'n': 1}), (4, 1))
+        self.assertEquals(m({'type': 3, 'n': 1}), 'fallback')
+        m.unregister(fallback)
+        self.assertRaises(NoMatch, m, {'type': 42})
+        self.assertTrue(m._index is index)
+
+    def test_trie_patched_in_place(self):
+        m = Matcher([("'GET ' :: path", lambda path: ('get', path)),
+            ("'POST ' :: path", lambda path: ('post', path))])
+        self.assertEquals(m('GET /'), ('get', '/'))
+        index = m._index
+        api = m.register("'GET /api/' :: rest", lambda rest: ('api', rest))
+        m.register('_', lambda: None)
+        self.assertEquals(m('GET /api/x'), ('get', '/api/x'))
+        self.assertEquals(m('PUT /'), None)
+        m.unregister(m._cases_in_order[0])
+        self.assertEquals(m('GET /api/x'), ('api', 'x'))
+        self.assertEquals(m('GET /'), None)
+        m.unregister(api)
+        self.assertEquals(m('GET /api/x'), None)
+        self.assertTrue(m._index is index)
+
+    def test_batch(self):
+        m = Matcher([(str(i), lambda i=i: i) for i in range(10)])
+        m(0)
+        index = m._index
+        with m.batch():
+            case = m.register('_', lambda: None)
+            self.assertEquals(m(42), None)
+            m.unregister(case)
+        self.assertTrue(m._index is index)
+        self.assertRaises(NoMatch, m, 42)
+        with m.batch():
+            for case in m._cases_in_order[:8]:
+                m.unregister(case)
+        self.assertEquals(m._index, None)
+        self.assertEquals(m(9), 9)
+        self.assertRaises(NoMatch, m, 0)
+
+    def test_replace_in_batch(self):
+        m = Matcher([("{'type': %r}" % t, lambda t=t: t) for t in 'abcdefghijklmnop'])
+        m({'type': 'a'})
+        index = m._index
+        with m.batch():
+            m.replace(m._cases_in_order[0], "{'type': 'z'}", lambda: 'zed')
+            added = m.register("{'type': 'y'}", lambda: 'why')
+            m.replace(added, "{'type': 'x'}", lambda: 'ex')
+        self.assertTrue(m._index is index)
+        self.assertEquals(m({'type': 'z'}), 'zed')
+        self.assertRaises(NoMatch, m, {'type': 'a'})
+        self.assertEquals(m({'type': 'x'}), 'ex')
+        self.assertRaises(NoMatch, m, {'type': 'y'})
+
+    def test_replace_in_batch_trie(self):
+        m = Matcher([("'GET ' :: p", lambda p: ('get', p)),
+            ("'POST ' :: p", lambda p: ('post', p)),
+            ("'PUT ' :: p", lambda p: ('put', p)),
+            ('_', lambda: None)])
+        m('GET /')
+        index = m._index
+        with m.batch():
+            m.replace(m._cases_in_order[0], "'DELETE ' :: p",
+                    lambda p: ('delete', p))
+        self.assertTrue(m._index is index)
+        self.assertEquals(m('DELETE /'), ('delete', '/'))
+        self.assertEquals(m('GET /'), None)
+        self.assertEquals(m('POST /'), ('post', '/'))
+
+class Slices(object):
+    """A sequence that counts how many slices were taken."""
+    def __init__(self, items):
+        self.items = items
+        self.slices = 0
+    def __len__(self):
+        return len(self.items)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            self.slices += 1
+        return self.items[i]
+
+class TestUnusedNames(unittest.TestCase):
+    def test_unused_names_not_bound(self):
+        m = Matcher([('[x, y, z]', lambda y: y)])
+        self.assertEquals(m((1, 2, 3)), 2)
+        self.assertEquals(m.bindings[0][0].head_pattern.bound_name, None)
+
+    def test_unused_tail_not_sliced(self):
+        items = Slices([1, 2, 3])
+        self.assertEquals(Matcher([('x :: tail', lambda x: x)])(items), 1)
+        self.assertEquals(items.slices, 0)
+        self.assertEquals(Matcher([("'GET ' :: path", lambda: 'get')])(
+            'GET /'), 'get')
+        m = Matcher([('x :: tail', lambda x, tail: tail)])
+        self.assertEquals(m(items), [2, 3])
+        self.assertEquals(items.slices, 1)
+
+    def test_kwargs_handler_gets_everything(self):
+        m = Matcher([('x :: tail', lambda **kwargs: sorted(kwargs))])
+        self.assertEquals(m((1, 2)), ['tail', 'x'])
+
+    def test_match_args(self):
+        @match_args('[x, y]')
+        def f(x):
+            return x
+        self.assertEquals(f(1, 2), 1)
+
+class TestCallPlan(unittest.TestCase):
+    def test_positional(self):
+        m = Matcher()
+        case = m.register('[y, x]', lambda x, y: (x, y))
+        self.assertEquals(case.plan.names, ['x', 'y'])
+        self.assertEquals(m((1, 2)), (2, 1))
+
+    def test_extra_args(self):
+        m = Matcher([('[x]', lambda extra, x: (extra, x))], extra_args=1)
+        self.assertEquals(m((1,), 'e'), ('e', 1))
+        self.assertRaises(TypeError, m, (1,))
+        self.assertRaises(TypeError, m, (1,), 'e', 'f')
+
+    def test_extra_args_checked(self):
+        m = Matcher(extra_args=1)
+        self.assertRaises(TypeError, m.register, '[x]', lambda x: x)
+        self.assertRaises(TypeError, m.register, '[x]', lambda: None)
+        case = m.register('[x]', lambda *args: args)
+        self.assertEquals(case.plan.names, None)
+        self.assertEquals(m((1,), 'e'), ('e',))
+
+    def test_undeclared_extra_args(self):
+        m = Matcher([('[x]', lambda extra, x: (extra, x)),
+            ('_', lambda *args: args)])
+        self.assertEquals(m((1,), 'e'), ('e', 1))
+        self.assertEquals(m('a', 1, 2), (1, 2))
+        self.assertRaises(TypeError, m, (1,))
+        self.assertRaises(TypeError, m, (1,), 'e', 'f')
+
+    def test_pattern_binds_nothing(self):
+        m = Matcher(extra_args=0)
+        self.assertRaises(TypeError, m.register, '_', lambda user: user)
+        self.assertRaises(TypeError, m.register, '[]', lambda x: x)
+        self.assertEquals(m.bindings, [])
+
+    def test_pattern_binds_other_name(self):
+        m = Matcher(extra_args=0)
+        self.assertRaises(TypeError, m.register, 'x', lambda y: y)
+        self.assertRaises(TypeError, m.register, '[x, y]', lambda z, x: x)
+        self.assertEquals(m.bindings, [])
+
+    def test_required_names_checked(self):
+        m = Matcher()
+        self.assertRaises(TypeError, m.register, '[x] | [x, y]',
+                lambda x, y: y)
+        self.assertRaises(TypeError, m.register, '[x]', lambda x, y: y)
+        self.assertEquals(m.bindings, [])
+        case = m.register('[x] | [x, y]', lambda x, y=None: (x, y))
+        self.assertEquals(case.plan.names, None)
+        self.assertEquals(m([1]), (1, None))
+        self.assertEquals(m([1, 2]), (1, 2))
+        self.assertRaises(TypeError, m.replace, case, '[x]', lambda x, y: y)
+        self.assertEquals(m([1]), (1, None))
+
+    def test_names_not_taken_are_not_passed(self):
+        m = Matcher([('[x, x]', lambda: 'pair'),
+            ('[x] if x > 0', lambda: 'positive')])
+        self.assertEquals(m([1, 1]), 'pair')
+        self.assertEquals(m([1]), 'positive')
+        m = Matcher([('[x, y] | [x, y, z] if y > 0',
+            lambda x, z=None: (x, z))])
+        self.assertEquals(m([1, 2]), (1, None))
+        self.assertEquals(m([1, 2, 3]), (1, 3))
+
+class CountingOr(OrPattern):
+    calls = 0
+
+    def _does_match(self, other, ctx):
+        CountingOr.calls += 1
+        return super(CountingOr, self)._does_match(other, ctx)
+
+class TestSharedPatterns(unittest.TestCase):
+    def test_shared_prefix_tested_once(self):
+        option = lambda: CountingOr(_('-o'), _('--optim'))
+        m = Matcher()
+        m.register(_(option(), _(1)), lambda: 'one')
+        m.register(_(option(), _(2)), lambda: 'two')
+        m.register(_(option(), _()%'x'), lambda x: x)
+        self.assertTrue(m.bindings[0][0].head_pattern is
+                m.bindings[2][0].head_pattern)
+        CountingOr.calls = 0
+        self.assertEquals(m(('-o', 3)), 3)
+        self.assertEquals(CountingOr.calls, 1)
+        self.assertEquals(m(('--optim', 2)), 'two')
+        self.assertEquals(CountingOr.calls, 2)
+
+    def test_long_patterns(self):
+        m = Matcher()
+        m.register(_(*[int]*10000), lambda: 'ints')
+        tail = _()%'rest'
+        for i in range(9999):
+            tail = _(int) + tail
+        m.register(tail, lambda rest: rest)
+        self.assertEquals(m(list(range(10000))), 'ints')
+        self.assertEquals(m(list(range(9999)) + ['a']), ['a'])
+        self.assertTrue(m.bindings[0][0].head_pattern is
+                m.bindings[1][0].head_pattern)
+
+    def test_long_memoized_patterns(self):
+        ints = _(*[int]*5000)
+        m = Matcher([(ints, lambda: 'first'), (ints, lambda: 'second'),
+            (_(), lambda: 'other')])
+        self.assertEquals(m(list(range(5000))), 'first')
+        self.assertEquals(m(list(range(4999)) + ['a']), 'other')
+
+    def test_constants_of_different_types(self):
+        m = Matcher([('1', lambda: 'one'), ('True', lambda: 'true')])
+        self.assertTrue(m.bindings[1][0].obj is True)
+
 class TestMatchArgsDecorator(unittest.TestCase):
     def test_decorator(self):
         @match_args('[]')
@@ -81,6 +427,14 @@ class TestMatchArgsDecorator(unittest.TestCase):
         except NoMatch:
             pass
 
+    def test_default(self):
+        @match_args('[x:int]', default='nope')
+        def f(x):
+            return x
+        self.assertEquals(f(1), 1)
+        self.assertEquals(f('a'), 'nope')
+        self.assertEquals(f(), 'nope')
+
     def test_head_tail(self):
         @match_args('head :: tail')
         def f(head, tail):
@@ -115,3 +469,115 @@ class TestUnpacker(unittest.TestCase):
             self.fail('no var x')
         except AttributeError:
             pass
+
+    def test_try_unpack(self):
+        unpacker = Unpacker()
+        self.assertFalse(unpacker('[x:str]').try_unpack([1]))
+        self.assertFalse(hasattr(unpacker, 'x'))
+        self.assertTrue(unpacker('[x:int]').try_unpack([1]))
+        self.assertEquals(unpacker.x, 1)
+
+    def test_call_site_cache(self):
+        unpacker = Unpacker()
+        before = len(matcher._call_sites)
+        for i in range(3):
+            unpacker('[n:int, rest]') << (i, 'x')
+            self.assertEquals(unpacker.n, i)
+        self.assertEquals(len(matcher._call_sites), before + 1)
+
+    def test_unpack(self):
+        head, tail = unpack('head :: tail', (1, 2, 3))
+        self.assertEquals((head, tail), (1, (2, 3)))
+        self.assertEquals(unpack('[x, [y, x]]', (1, (2, 1))), (1, 2))
+        self.assertEquals(unpack(_(_()%'a', _()%'b'), [1, 2]), (1, 2))
+        self.assertEquals(unpack('[]', []), ())
+        self.assertRaises(NoMatch, unpack, '[x:str]', [1])
+        self.assertEquals(unpack('[x:str]', [1], default=None), None)
+
+    def test_unpack_per_call_site(self):
+        patterns = ['[a, b]', 'a :: b']
+        results = [unpack(pattern, (1, 2)) for pattern in patterns]
+        self.assertEquals(results, [(1, 2), (1, (2,))])
+
+class Reprs(object):
+    count = 0
+    def __repr__(self):
+        Reprs.count += 1
+        return 'Reprs()'
+
+class TestNoMatch(unittest.TestCase):
+    def test_try_match(self):
+        m = Matcher([('x:int', lambda x: x), ('None', lambda: None)])
+        self.assertEquals(m.try_match(1), 1)
+        self.assertEquals(m.try_match(None), None)
+        self.assertTrue(m.try_match('a') is NO_MATCH)
+        self.assertEquals(m.try_match('a', default=0), 0)
+        self.assertEquals(repr(NO_MATCH), 'NO_MATCH')
+
+    def test_try_match_extra_args(self):
+        m = Matcher([('x', lambda extra, x: (extra, x))])
+        self.assertEquals(m.try_match(1, 'e', default=None), ('e', 1))
+        try:
+            m.try_match(1, bad=1)
+            self.fail()
+        except TypeError:
+            pass
+
+    def test_try_match_after_tailcall(self):
+        m = Matcher([('x:int', lambda x: m.tailcall(str(x)))])
+        self.assertEquals(m.try_match(1, default='no'), 'no')
+
+    def test_lazy_message(self):
+        Reprs.count = 0
+        m = Matcher([('_:int', lambda: None)])
+        for i in range(3):
+            try:
+                m(Reprs())
+                self.fail()
+            except NoMatch as e:
+                error = e
+        self.assertEquals(Reprs.count, 0)
+        self.assertEquals(str(error), 'no registered pattern could match '
+                'Reprs()')
+        self.assertEquals(Reprs.count, 1)
+        self.assertTrue(isinstance(error.obj, Reprs))
+
+    def test_explicit_message(self):
+        self.assertEquals(str(NoMatch('custom')), 'custom')
+
+    def test_pattern_message(self):
+        @match_args('[x:int]')
+        def f(x):
+            return x
+        try:
+            f('a')
+            self.fail()
+        except NoMatch as e:
+            self.assertEquals(e.obj, ('a',))
+            self.assertTrue(str(e).endswith("doesn't match ('a',)"))
+
+class TestTailCall(unittest.TestCase):
+    def test_deep_recursion(self):
+        length = Matcher()
+        length.register('_ :: tail',
+                lambda acc, tail: length.tailcall(tail, acc + 1))
+        length.register('[]', lambda acc: acc)
+        self.assertEquals(length((None,) * 5000, 0), 5000)
+
+    def test_mutual_recursion(self):
+        even = Matcher()
+        odd = Matcher()
+        even.register('0', lambda: True)
+        even.register('n:int', lambda n: odd.tailcall(n - 1))
+        odd.register('0', lambda: False)
+        odd.register('n:int', lambda n: even.tailcall(n - 1))
+        self.assertTrue(even(10000))
+        self.assertFalse(even(10001))
+
+    def test_nomatch_after_tailcall(self):
+        m = Matcher([('x:int', lambda x: m.tailcall(str(x)))])
+        try:
+            m(1)
+            self.fail('should fail with NoMatch')
+        except NoMatch:
+            pass
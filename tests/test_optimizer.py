@@ -0,0 +1,139 @@
+import unittest
+from collections import namedtuple
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from pyfpm.matcher import Matcher
+from pyfpm.optimizer import (optimize, flatten_alternatives, skip_noops,
+        reorder_checks, check_lengths, cost, format_tree, unbind)
+from pyfpm.parser import Parser, _bound_names
+from pyfpm.pattern import (build as _, AnyPattern, InstanceOfPattern,
+        RegexPattern, OrPattern, NamedTuplePattern, MappingPattern,
+        ListPattern)
+
+Triple = namedtuple('Triple', 'a b c')
+
+class Items(object):
+    """A sequence that counts how many items were looked at."""
+    def __init__(self, items):
+        self.items = items
+        self.lookups = 0
+    def __len__(self):
+        return len(self.items)
+    def __getitem__(self, i):
+        self.lookups += 1
+        return self.items[i]
+
+class TestOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.parse = Parser()
+
+    def assertSameMatches(self, pattern, objects):
+        optimized = optimize(pattern)
+        for obj in objects:
+            self.assertEquals(optimized.match(obj), pattern.match(obj))
+
+    def test_flatten_alternatives(self):
+        nested = OrPattern(_(1), OrPattern(_(2), OrPattern(_(3), _(1))))
+        p = optimize(nested, [flatten_alternatives])
+        self.assertEquals(p.patterns, (_(1), _(2), _(3)))
+        self.assertEquals(len(nested.patterns), 2)
+        p = optimize(OrPattern(OrPattern(_(1), _(2))%'x', _(3)),
+                [flatten_alternatives])
+        self.assertEquals(len(p.patterns), 2)
+        self.assertEquals(optimize(OrPattern(_(1), _(1)),
+            [flatten_alternatives]), _(1))
+
+    def test_skip_noop_alternatives(self):
+        p = optimize(_(1) | _() | _(2), [skip_noops])
+        self.assertEquals(p.patterns, (_(1), _()))
+        self.assertEquals(optimize(_() | _(1), [skip_noops]), _())
+
+    def test_skip_noop_items(self):
+        p = optimize(self.parse('[_, x, _]'), [skip_noops])
+        self.assertTrue(p._skip_head)
+        self.assertFalse(p.tail_pattern._skip_head)
+        self.assertSameMatches(self.parse('[_, x, _]'),
+                [(1, 2, 3), (1, 2), [], 'abc'])
+        self.assertSameMatches(self.parse('x :: _'), [(1, 2), (1,), ()])
+
+    def test_reorder_checks(self):
+        guard = AnyPattern()%'x' / (lambda x: x > 0)
+        p = NamedTuplePattern(Triple, guard, RegexPattern('a'), str)
+        optimized = optimize(p, [reorder_checks])
+        self.assertEquals([i for (i, field) in optimized._checks], [2, 1, 0])
+        # the original pattern is left as it was
+        self.assertEquals([i for (i, field) in p._checks], [0, 1, 2])
+        self.assertSameMatches(p, [Triple(1, 'a', 'b'), Triple(0, 'a', 'b'),
+            Triple(1, 'b', 'b'), Triple(1, 'a', 2)])
+        self.assertTrue(cost(RegexPattern('a')) > cost(InstanceOfPattern(str)))
+        self.assertTrue(cost(guard) > cost(RegexPattern('a')))
+
+    def test_conditions_keep_their_names(self):
+        p = MappingPattern({'a': _()%'x',
+            'b': _()%'y' / (lambda x, y: y > x), 'c': 1})
+        optimized = optimize(p, [reorder_checks])
+        keys = list(optimized.mapping)
+        self.assertTrue(keys.index('a') < keys.index('b'))
+        self.assertSameMatches(p, [{'a': 1, 'b': 2, 'c': 1},
+            {'a': 2, 'b': 1, 'c': 1}, {'a': 1, 'b': 2}])
+
+    def test_check_lengths(self):
+        p = optimize(self.parse('[x, y, z]'), [check_lengths])
+        self.assertEquals(p._lengths, (3, 3))
+        p = optimize(self.parse('x :: y :: z'), [check_lengths])
+        self.assertEquals(p._lengths, (2, None))
+        items = Items(list(range(10)))
+        self.assertEquals(optimize(self.parse('[x, y, z]')).match(items),
+                None)
+        self.assertEquals(items.lookups, 0)
+        self.assertSameMatches(self.parse('[x, [y], _:int]'),
+                [(1, (2,), 3), (1, (2, 3), 3), (1, (2,)), (1, (2,), 3, 4)])
+
+    def test_dump(self):
+        stream = StringIO()
+        m = Matcher([('[1 | 2]', lambda: None)], dump=stream)
+        self.assertEquals(stream.getvalue(), 'before:\n%s\nafter:\n%s\n' % (
+            format_tree(self.parse('[1 | 2]')),
+            format_tree(m.bindings[0][0])))
+        self.assertTrue('len=1' in stream.getvalue())
+
+    def test_matcher_switch(self):
+        nested = OrPattern(_(1), OrPattern(_(2), _(3)))
+        literal = Matcher([(nested, lambda: None)], optimize=False)
+        self.assertEquals(len(literal.bindings[0][0].patterns), 2)
+        optimized = Matcher([(nested, lambda: None)])
+        self.assertEquals(len(optimized.bindings[0][0].patterns), 3)
+
+class TestUnbind(unittest.TestCase):
+    def setUp(self):
+        self.parse = Parser()
+
+    def test_unbind(self):
+        p = self.parse('[x, y, z:int]')
+        unbound = unbind(p, lambda a, y, b=1: y)
+        self.assertEquals(_bound_names(unbound), ['y'])
+        self.assertEquals(_bound_names(p), ['x', 'y', 'z'])
+        self.assertEquals(unbound.match((1, 2, 3)).ctx, {'y': 2})
+        self.assertFalse(unbound << (1, 2, 'a'))
+
+    def test_names_kept(self):
+        p = self.parse('[x, x, y]')
+        self.assertEquals(_bound_names(unbind(p, lambda: 0)), ['x'])
+        p = self.parse('[x, y, z] if x < len(y)')
+        self.assertEquals(_bound_names(unbind(p, lambda: 0)), ['x', 'y'])
+        p = _(_()%'x', _()%'y') / (lambda **ctx: True)
+        self.assertTrue(unbind(p, lambda: 0) is p)
+        p = _(_()%'x', _()%'y') / (lambda y: y)
+        self.assertEquals(_bound_names(unbind(p, lambda: 0)), ['y'])
+        p = self.parse('[x, y]')
+        self.assertTrue(unbind(p, lambda **kwargs: 0) is p)
+        self.assertTrue(unbind(p, lambda x, y: 0) is p)
+
+    def test_unbound_regex_groups(self):
+        p = ListPattern(RegexPattern('(a)(b)')%'groups')
+        self.assertEquals(p.match(('ab',)).ctx, {'groups': ('a', 'b')})
+        self.assertEquals(unbind(p, lambda: 0).match(('ab',)).ctx, {})
@@ -1,8 +1,10 @@
+import pickle
 import re
 import unittest
 
 from pyfpm import parser
-from pyfpm.pattern import build as _
+from pyfpm.pattern import build as _, Match as _m, ClassPattern,\
+        StructPattern
 
 _has_named_tuple = False
 try:
@@ -13,6 +15,9 @@ try:
 except ImportError:
     pass
 
+class Point(object):
+    __match_args__ = ('x', 'y')
+
 class TestParser(unittest.TestCase):
     def setUp(self):
         self.parse = parser.Parser()
@@ -96,6 +101,16 @@ class TestParser(unittest.TestCase):
         self.assertEquals(self.parse('"abc"'), _('abc'))
         self.assertEquals(self.parse("'abc'"), _('abc'))
 
+    def test_bytes_constant(self):
+        self.assertEquals(self.parse("b'abc'"), _(b'abc'))
+        self.assertEquals(self.parse(r'b"\x01\n"'), _(b'\x01\n'))
+
+    def test_struct_var(self):
+        self.assertEquals(self.parse('n:u16be'), StructPattern('>H')%'n')
+        self.assertEquals(self.parse('_ : i32le'), StructPattern('<i'))
+        self.assertEquals(self.parse(r"b'\x01' :: n:u8 :: rest"),
+                _(b'\x01') + StructPattern('B')%'n' + _()%'rest')
+
     def test_regex_constant(self):
         self.assertEquals(self.parse('/abc/'), _(re.compile('abc')))
         self.assertEquals(self.parse(r'/\//'), _(re.compile('/')))
@@ -124,11 +139,47 @@ class TestParser(unittest.TestCase):
         self.assertEquals(self.parse('[x | y]'), _([_()%'x' | _()%'y']))
         self.assertEquals(self.parse('[(x | y)]'), _([_()%'x' | _()%'y']))
 
+    def test_mapping(self):
+        self.assertEquals(self.parse('{}'), _({}))
+        self.assertEquals(self.parse("{'type': 'order', 'items': items}"),
+                _({'type': 'order', 'items': _()%'items'}))
+        self.assertEquals(self.parse('{1: x:int, 1.5: [a, b]}'),
+                _({1: _(int)%'x', 1.5: _(_()%'a', _()%'b')}))
+        self.assertEquals(self.parse("{'a': {'b': 1 | 2}}"),
+                _({'a': {'b': _(1) | _(2)}}))
+
     if _has_named_tuple:
         def test_case_classes(self):
             self.assertEquals(self.parse('Case3(1, 2, 3)'), _(Case3(1, 2, 3)))
             self.assertEquals(self.parse('Case0()'), _(Case0()))
 
+    def test_class_patterns(self):
+        self.assertEquals(self.parse('Point(x, 1)'),
+                ClassPattern(Point, _()%'x', _(1)))
+        self.assertEquals(self.parse('Point(y=[a, _], x = 2)'),
+                ClassPattern(Point, x=_(2), y=_(_()%'a', _())))
+        self.assertEquals(self.parse('Point(0, y=b:int)'),
+                ClassPattern(Point, 0, y=_(int)%'b'))
+        self.assertEquals(self.parse('int(x)'), ClassPattern(int, _()%'x'))
+        for expr in ('Point(1, 2, 3)', 'Point(1, x=1)', 'int(1, 2)'):
+            try:
+                self.parse(expr)
+                self.fail(expr)
+            except parser.ParseException:
+                pass
+
+    if _has_named_tuple:
+        def test_case_class_keywords(self):
+            self.assertEquals(self.parse('Case3(b=x)'),
+                    _(Case3(_(), _()%'x', _())))
+            self.assertEquals(self.parse('Case3(1, c=x)'),
+                    _(Case3(1, _(), _()%'x')))
+            try:
+                self.parse('Case3(d=1)')
+                self.fail()
+            except parser.ParseException:
+                pass
+
     def test_conditional_pattern(self):
         p = self.parse('_ if False')
         self.assertFalse(p << 1)
@@ -154,8 +205,78 @@ class TestParser(unittest.TestCase):
         except SyntaxError:
             pass
 
+    def test_early_conditions(self):
+        class Exploding(object):
+            def __getitem__(self, i):
+                raise AssertionError('should not be traversed')
+            def __len__(self):
+                return 2
+        p = self.parse('[level:int, [a, b]] if level > 3')
+        self.assertFalse(p << (1, Exploding()))
+        self.assertEquals(p << (4, (1, 2)), _m({'level': 4, 'a': 1, 'b': 2}))
+        self.assertEquals(p.head_pattern.condition.source, 'level > 3')
+        self.assertEquals(p.condition, None)
+
+    def test_early_conjuncts(self):
+        p = self.parse('[x, y, z] if len(x) > 1 and x[1] == z and y')
+        self.assertEquals(p.head_pattern.condition.source, 'len(x) > 1')
+        z = p.tail_pattern.tail_pattern.head_pattern
+        self.assertEquals(z.condition.source, '(x[1] == z) and (y)')
+        self.assertEquals(p << ('ab', 1, 'b'), _m({'x': 'ab', 'y': 1, 'z': 'b'}))
+        self.assertFalse(p << ('ab', 0, 'b'))
+        # the order of the conjuncts is kept, so x[1] is never evaluated
+        # for a short x
+        self.assertFalse(p << ('a', 1, 'b'))
+
+    def test_conditions_not_hoisted_into_alternatives(self):
+        p = self.parse('[x:int | [x:int], y] if x > 1')
+        self.assertEquals(p.head_pattern.condition.source, 'x > 1')
+        self.assertFalse(p << ([1], 2))
+        self.assertTrue(p << ([2], 2))
+
+    def test_conditions_on_names_bound_by_some_alternatives(self):
+        p = self.parse('[(x:int | _:str), x] if x > 0')
+        self.assertEquals(p.head_pattern.condition, None)
+        self.assertEquals(p << ('a', 5), _m({'x': 5}))
+        self.assertFalse(p << ('a', -1))
+        self.assertEquals(p << (3, 3), _m({'x': 3}))
+        self.assertFalse(p << (3, 4))
+        p = self.parse('[(x:int | _:str), y] if x > 0')
+        self.assertEquals(p.condition.source, 'x > 0')
+        self.assertFalse(p << (-1, 2))
+        p = self.parse('[(x:int | [x:int]), y] if x > 0')
+        self.assertEquals(p.head_pattern.condition.source, 'x > 0')
+
+    def test_conditions_on_unknown_names(self):
+        p = self.parse('[x, y] if x > 1 and w')
+        self.assertEquals(p.head_pattern.condition.source, 'x > 1')
+        self.assertEquals(p.condition.source, 'w')
+
     def test_conditional_pattern_equality(self):
         self.assertEquals(self.parse('x if x'), self.parse('x if x'))
         self.assertNotEquals(self.parse('x if not x'), self.parse('x if x'))
         self.assertTrue(str(self.parse('x if x').condition).startswith(
             '_IfCondition(code='))
+
+    def test_pickled_conditions(self):
+        p = self.parse('[x:int, y] if x < y')
+        q = pickle.loads(pickle.dumps(p))
+        self.assertEquals(q, p)
+        self.assertTrue(q << (1, 2))
+        self.assertFalse(q << (2, 1))
+        local = parser.Parser({})('x if x')
+        self.assertRaises(pickle.PicklingError, pickle.dumps, local)
+
+    def test_type_names_resolved_once(self):
+        class A(object): pass
+        class B(object): pass
+        context = {'A': A}
+        p = parser.Parser(context)
+        self.assertEquals(p('x:A'), _(A)%'x')
+        self.assertEquals(p('x:A'), _(A)%'x')
+        context['A'] = B
+        self.assertEquals(p('x:A'), _(B)%'x')
+        del context['A']
+        self.assertEquals(p('A'), _()%'A')
+        context['A'] = A
+        self.assertRaises(parser.ParseException, p, 'A')
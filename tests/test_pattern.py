@@ -1,3 +1,4 @@
+import abc
 import re
 import unittest
 
@@ -38,6 +39,39 @@ class TestInstance(unittest.TestCase):
     def test_not_match_different_type(self):
         self.assertFalse(_iof(int)%'x'<<'abc')
 
+    def test_abc_verdicts(self):
+        Shape = abc.ABCMeta('Shape', (object,), {})
+        class Square(object):
+            pass
+        p = _iof(Shape)
+        self.assertFalse(p<<Square())
+        self.assertEquals(pattern._type_verdicts.tables[Shape], {Square: False})
+        # registering forgets the verdicts
+        Shape.register(Square)
+        self.assertTrue(p<<Square())
+        self.assertTrue(_iof((int, Shape))<<Square())
+
+    def test_faked_class(self):
+        Shape = abc.ABCMeta('Shape', (object,), {})
+        class Square(object):
+            pass
+        Shape.register(Square)
+        class Disguised(Square):
+            __class__ = property(lambda self: int)
+        p = _iof(Shape)
+        self.assertFalse(p<<1)
+        self.assertTrue(p<<Disguised())
+
+    def test_custom_instancecheck_not_cached(self):
+        class EvenMeta(type):
+            def __instancecheck__(cls, obj):
+                return isinstance(obj, int) and obj % 2 == 0
+        Even = EvenMeta('Even', (object,), {})
+        p = _iof(Even)
+        self.assertTrue(p<<2)
+        self.assertFalse(p<<3)
+        self.assertFalse(Even in pattern._type_verdicts.tables)
+
 _regex = pattern.RegexPattern
 class TestRegex(unittest.TestCase):
     def test_match_simple(self):
@@ -84,6 +118,37 @@ class TestList(unittest.TestCase):
             self.assertFalse(_l() << x)
             self.assertFalse(_l(_any()) << x)
 
+    def test_bound_tails(self):
+        p = _l(_any()%'a', _l(_any()%'b', _l())%'rest' / (
+            lambda a, b, rest: rest == (b,) and a < b))
+        self.assertEquals(p<<(1, 2), _m({'a': 1, 'b': 2, 'rest': (2,)}))
+        self.assertFalse(p<<(2, 1))
+        self.assertFalse(_l(_any()%'x', _l(_any())%'x')<<[[2], 1])
+        self.assertEquals(_l(_any()%'x', _l(_any())%'x')<<[[1], 1],
+                _m({'x': [1]}))
+
+    def test_long_sequences(self):
+        items = list(range(100000))
+        p = pattern.build(*[_iof(int)]*len(items))
+        self.assertTrue(p<<items)
+        self.assertTrue(p<<tuple(items))
+        self.assertFalse(p<<items[:-1])
+        self.assertFalse(p<<items + ['a'])
+        p = _any()%'last'
+        for i in range(len(items) - 1):
+            p = _l(_any(), p)
+        self.assertEquals(p<<items, _m({'last': [99999]}))
+
+    def test_deep_nesting(self):
+        obj = 'x'
+        for i in range(10000):
+            obj = [obj]
+        self.assertEquals(pattern.build(obj)<<obj, _m())
+        p = _any()%'x'
+        for i in range(10000):
+            p = _l(p)
+        self.assertEquals(p<<obj, _m({'x': 'x'}))
+
     # TODO: more tests
 
 _has_named_tuple = False
@@ -114,7 +179,243 @@ if _has_named_tuple:
                                                     Case3(1, 2, 3),
                             _m({'head': 1, 'tail': (2, 3), 'x': Case3(1, 2, 3)}))
 
-        # TODO: more tests
+        def test_no_match_other_class(self):
+            self.assertFalse(_c(Case3, _any(), _any(), _any()) << (1, 2, 3))
+            self.assertFalse(_c(Case1, _any()) << Case3(1, 2, 3))
+
+        def test_subclass(self):
+            class SubCase3(Case3):
+                pass
+            self.assertEquals(_c(Case3, _any()%'a', _any(), _any()) <<
+                    SubCase3(1, 2, 3), _m({'a': 1}))
+
+        def test_arity(self):
+            self.assertFalse(_c(Case3, _any(), _any()) << Case3(1, 2, 3))
+            self.assertFalse(_c(Case3, _any(), _any(), _any(), _any()) <<
+                    Case3(1, 2, 3))
+            self.assertFalse(_c(Case3, _any() + _any() + _any() + _any()%'x' +
+                _any()) << Case3(1, 2, 3))
+
+        def test_list_fields(self):
+            self.assertEquals(_c(Case3, _l(_any()%'a', _l(_any(), _l(_eq(3)))))
+                    << Case3(1, 2, 3), _m({'a': 1}))
+            self.assertEquals(_c(Case3, _l(_any(), _l(_any(), _l(_eq(3))))),
+                    _c(Case3, _any(), _any(), _eq(3)))
+
+        def test_wide_record(self):
+            Wide = namedtuple('Wide', ['f%d' % i for i in range(40)])
+            wide = Wide(*range(40))
+            patterns = [_any()] * 40
+            patterns[0] = _eq(0)
+            patterns[39] = _any()%'last'
+            self.assertEquals(_c(Wide, *patterns) << wide, _m({'last': 39}))
+            patterns[39] = _eq(0)
+            self.assertFalse(_c(Wide, *patterns) << wide)
+
+        def test_any_instance(self):
+            self.assertTrue(_c(Case3) << Case3(1, 2, 3))
+
+_map = pattern.MappingPattern
+class TestMapping(unittest.TestCase):
+    def test_match_empty(self):
+        self.assertEquals(_map()%'x'<<{}, _m({'x': {}}))
+        self.assertEquals(_map()<<{'a': 1}, _m())
+
+    def test_match_keys(self):
+        p = _map({'a': _eq(1), 'b': _any()%'y'})
+        self.assertEquals(p<<{'a': 1, 'b': 2, 'c': 3}, _m({'y': 2}))
+        self.assertFalse(p<<{'a': 2, 'b': 2})
+        self.assertFalse(p<<{'a': 1})
+
+    def test_not_match_non_mapping(self):
+        for x in ([], (), 'abc', 1, None, [('a', 1)]):
+            self.assertFalse(_map({'a': _any()}) << x)
+            self.assertFalse(_map() << x)
+
+    def test_no_default_insertion(self):
+        from collections import defaultdict
+        d = defaultdict(int)
+        self.assertFalse(_map({'a': _any()}) << d)
+        self.assertEquals(dict(d), {})
+
+    def test_nested(self):
+        p = _map({'a': _map({'b': _any()%'x'})})
+        self.assertEquals(p<<{'a': {'b': 1}}, _m({'x': 1}))
+
+_prefix = pattern.PrefixPattern
+class TestPrefix(unittest.TestCase):
+    def test_build(self):
+        self.assertTrue(isinstance(_eq('a') + _any(), _prefix))
+        self.assertTrue(isinstance(_eq('a') + _eq('b') + _any(), _prefix))
+        self.assertFalse(isinstance(_eq(1) + _any(), _prefix))
+
+    def test_match_string(self):
+        p = _eq('GET ') + _any()%'path'
+        self.assertEquals(p << 'GET /', _m({'path': '/'}))
+        self.assertEquals(p << 'GET ', _m({'path': ''}))
+        self.assertFalse(p << 'GET')
+        self.assertFalse(p << 'POST /')
+
+    def test_chain(self):
+        p = _eq('a') + _eq('b')%'b' + _any()%'rest'
+        self.assertEquals(p << 'abc', _m({'b': 'b', 'rest': 'c'}))
+        self.assertFalse(p << 'acb')
+        self.assertEquals((_eq('a') + _l()) << 'a', _m())
+        self.assertFalse((_eq('a') + _l()) << 'ab')
+
+    def test_head_condition(self):
+        p = _eq('a')%'x' / (lambda x: False) + _any()
+        self.assertFalse(p << 'abc')
+
+    def test_list_semantics(self):
+        p = _eq('a') + _any()%'rest'
+        self.assertEquals(p << ['a', 1], _m({'rest': [1]}))
+        self.assertFalse(p << ['b'])
+        self.assertFalse(p << 1)
+
+_struct = pattern.StructPattern
+_bin = pattern.BinaryPattern
+class TestBinary(unittest.TestCase):
+    def test_struct(self):
+        self.assertEquals(_struct('u16be')%'x' << b'\x01\x02',
+                _m({'x': 258}))
+        self.assertEquals(_struct('<H')%'x' << bytearray(b'\x01\x02'),
+                _m({'x': 513}))
+        self.assertEquals(_struct('u8')%'x' << b'\x00', _m({'x': 0}))
+        self.assertEquals(_struct('>BB')%'x' << b'\x01\x02',
+                _m({'x': (1, 2)}))
+        self.assertEquals(_struct('u16be'), _struct('>H'))
+
+    def test_struct_not_match(self):
+        for x in (b'\x01', b'\x01\x02\x03', 258, [1, 2], u'ab'):
+            self.assertFalse(_struct('u16be') << x)
+
+    def test_head_tail(self):
+        p = _eq(b'\x01') + _struct('u16be')%'n' + _any()%'payload'
+        self.assertTrue(isinstance(p, _bin))
+        for data in (b'\x01\x00\x03abc', bytearray(b'\x01\x00\x03abc'),
+                memoryview(b'\x01\x00\x03abc')):
+            match = p << data
+            self.assertEquals(match.ctx['n'], 3)
+            self.assertEquals(match.ctx['payload'], b'abc')
+        self.assertFalse(p << b'\x02\x00\x03abc')
+        self.assertFalse(p << b'\x01\x00')
+        self.assertFalse(p << [1, 0, 3])
+
+    def test_zero_copy(self):
+        data = bytearray(b'\x01abc')
+        match = (_eq(b'\x01') + _any()%'payload') << data
+        payload = match.ctx['payload']
+        self.assertTrue(isinstance(payload, memoryview))
+        data[1:2] = b'x'
+        self.assertEquals(payload, b'xbc')
+
+    def test_closed_tail(self):
+        p = _struct('u8')%'a' + _struct('u8')%'b' + _l()
+        self.assertEquals(p << b'\x01\x02', _m({'a': 1, 'b': 2}))
+        self.assertFalse(p << b'\x01\x02\x03')
+
+    def test_or_head(self):
+        p = (_eq(b'\x01') | _eq(b'\x02')) + _any()%'rest'
+        self.assertTrue(isinstance(p, _bin))
+        self.assertEquals(bytes((p << b'\x02a').ctx['rest']), b'a')
+        self.assertFalse(isinstance((_eq(b'a') | _eq(b'bc')) + _any(), _bin))
+
+    def test_list_semantics(self):
+        p = _eq(b'ab') + _any()%'t'
+        self.assertTrue(isinstance(p, _bin))
+        self.assertEquals(p << [b'ab', 1], _m({'t': [1]}))
+        self.assertEquals(p << (b'ab',), _m({'t': ()}))
+        self.assertFalse(p << [b'a', b'b'])
+        self.assertFalse(p << [])
+        p = _struct('u8')%'n' + _any()%'t'
+        self.assertEquals(p << [b'\x07', 1], _m({'n': 7, 't': [1]}))
+
+    def test_not_binary_head(self):
+        self.assertFalse(isinstance(_eq('a') + _any(), _bin))
+        try:
+            _bin(_any(), _any())
+            self.fail()
+        except TypeError:
+            pass
+
+class Point(object):
+    __match_args__ = ('x', 'y')
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+class SlotPoint(object):
+    __slots__ = ('x', 'y')
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+class SlotPoint3(SlotPoint):
+    __slots__ = 'z'
+    def __init__(self, x, y, z):
+        super(SlotPoint3, self).__init__(x, y)
+        self.z = z
+
+_cls = pattern.ClassPattern
+class TestClassPattern(unittest.TestCase):
+    def test_match_instance(self):
+        point = Point(1, 2)
+        self.assertEquals(_cls(Point)%'p' << point, _m({'p': point}))
+        self.assertFalse(_cls(Point) << (1, 2))
+
+    def test_match_args(self):
+        p = _cls(Point, _eq(1), _any()%'y')
+        self.assertEquals(p << Point(1, 2), _m({'y': 2}))
+        self.assertFalse(p << Point(2, 2))
+
+    def test_keyword(self):
+        p = _cls(Point, y=_iof(int)%'y')
+        self.assertEquals(p << Point('a', 2), _m({'y': 2}))
+        self.assertFalse(p << Point(1, 'a'))
+        self.assertEquals(_cls(Point, _eq(1)), _cls(Point, x=_eq(1)))
+
+    def test_missing_attribute(self):
+        self.assertFalse(_cls(Point, z=_any()) << Point(1, 2))
+        self.assertFalse(_cls(SlotPoint, _any(), _any()) <<
+                SlotPoint.__new__(SlotPoint))
+
+    def test_slots(self):
+        p = _cls(SlotPoint3, _any()%'x', _any(), _eq(3))
+        self.assertEquals(p << SlotPoint3(1, 2, 3), _m({'x': 1}))
+        self.assertFalse(p << SlotPoint3(1, 2, 4))
+
+    def test_too_many_positional(self):
+        for args in ((Point, 1, 2, 3), (int, 1, 2)):
+            try:
+                _cls(*args)
+                self.fail()
+            except TypeError:
+                pass
+        try:
+            _cls(Point, 1, x=1)
+            self.fail()
+        except TypeError:
+            pass
+
+    def test_self_matching_builtins(self):
+        self.assertEquals(_cls(int, _any()%'x') << 1, _m({'x': 1}))
+        self.assertFalse(_cls(int, _any()%'x') << '1')
+        self.assertEquals(_cls(tuple, _any()%'x') << (1,), _m({'x': (1,)}))
+
+    try:
+        import dataclasses
+        def test_dataclass(self):
+            import dataclasses
+            @dataclasses.dataclass
+            class Data(object):
+                a: int
+                b: str = 'b'
+            p = _cls(Data, _any()%'a', _eq('b'))
+            self.assertEquals(p << Data(1), _m({'a': 1}))
+            self.assertFalse(p << Data(1, 'c'))
+    except ImportError:
+        pass
 
 _or = pattern.OrPattern
 class TestOr(unittest.TestCase):
@@ -159,6 +460,18 @@ class TestPBuilder(unittest.TestCase):
     def test_regex(self):
         self.assertEquals(_(re.compile('abc')), _regex('abc'))
 
+    def test_dict(self):
+        self.assertEquals(_({}), _map())
+        self.assertEquals(_({'a': 1, 'b': str}),
+                _map({'a': _eq(1), 'b': _iof(str)}))
+
+    def test_nested(self):
+        self.assertEquals(_([{'a': [1]}, ()]), _l(_map({'a': _l(_eq(1))}),
+            _l(_l())))
+        if _has_named_tuple:
+            self.assertEquals(_([Case3(1, [2], 3)]), _l(_c(Case3, _eq(1),
+                _l(_eq(2)), _eq(3))))
+
 class TestOperators(unittest.TestCase):
     def test_mul(self):
         self.assertEquals(_()*2, _l(_any(), _l(_any())))
@@ -197,3 +510,80 @@ class TestCondition(unittest.TestCase):
         p.if_(lambda x: x > 1)
         self.assertFalse(p << 1)
         self.assertTrue(p << 2)
+
+class Counting(pattern.Pattern):
+    def __init__(self, pattern, counter):
+        super(Counting, self).__init__()
+        self.pattern = pattern
+        self.counter = counter
+
+    def children(self):
+        return (self.pattern,)
+
+    def _does_match(self, other, ctx):
+        self.counter.append(other)
+        return self.pattern.match(other, ctx)
+
+class TestHashConsing(unittest.TestCase):
+    def test_hash(self):
+        self.assertEquals(hash(_(1, str)), hash(_(1, str)))
+        self.assertEquals(hash(_({'a': [1]})), hash(_({'a': [1]})))
+        self.assertEquals(len(set([_(1), _(1), _(2), _(1)%'x'])), 3)
+        self.assertNotEquals(_(1)%'x', _(1))
+
+    def test_long_pattern_hash(self):
+        items = [int] * 50000
+        self.assertEquals(hash(_(*items)), hash(_(*items)))
+
+    def test_unhashable_constant(self):
+        p = _eq(set([1]))
+        self.assertEquals(hash(p), hash(_eq(set([1]))))
+
+    def test_share(self):
+        table = pattern.PatternTable()
+        a = table.share(_(_(1) | _(2), _()%'x'))
+        b = table.share(_(_(1) | _(2), _()%'y'))
+        self.assertTrue(a.head_pattern is b.head_pattern)
+        self.assertTrue(a.tail_pattern is not b.tail_pattern)
+        self.assertEquals(a, _(_(1) | _(2), _()%'x'))
+        self.assertTrue(table.share(_(_(1) | _(2), _()%'x')) is a)
+
+    def test_share_keeps_constant_types(self):
+        table = pattern.PatternTable()
+        one = table.share(_(1))
+        true = table.share(_(True))
+        self.assertTrue(one is not true)
+        self.assertTrue(true.obj is True)
+        self.assertTrue(table.share(_([True])).head_pattern is true)
+
+    def test_share_does_not_modify(self):
+        original = _(_(1) | _(2), _()%'x')
+        table = pattern.PatternTable()
+        table.share(_(_(1) | _(2), _()))
+        shared = table.share(original)
+        self.assertTrue(shared is not original)
+        self.assertTrue(shared.head_pattern is not original.head_pattern)
+
+    def test_memoize_pure_shared_only(self):
+        table = pattern.PatternTable()
+        a = table.share(_(_(1) | _(2), _()%'x'))
+        self.assertFalse(table.memoizing)
+        b = table.share(_(_(1) | _(2), _()%'y'))
+        self.assertTrue(table.memoizing)
+        self.assertTrue(a.head_pattern._memoize)
+        bound = table.share(_(1) | _(2)%'z')
+        table.share(_(1) | _(2)%'z')
+        self.assertFalse(bound._memoize)
+
+    def test_memo(self):
+        counter = []
+        table = pattern.PatternTable()
+        a = table.share(_(Counting(_(1) | _(2), counter), 'a'))
+        b = table.share(_(Counting(_(1) | _(2), counter), 'b'))
+        obj = (1, 'b')
+        with pattern.Memo():
+            self.assertFalse(a << obj)
+            self.assertTrue(b << obj)
+        self.assertEquals(len(counter), 1)
+        self.assertFalse(a << obj)
+        self.assertEquals(len(counter), 2)
@@ -0,0 +1,81 @@
+import unittest
+from collections import namedtuple
+
+from pyfpm.rewrite import Rewriter, BOTTOM_UP, TOP_DOWN
+
+Add = namedtuple('Add', 'left right')
+Mul = namedtuple('Mul', 'left right')
+
+class Counted(object):
+    """A replacement that counts its calls."""
+    def __init__(self, function):
+        self.function = function
+        self.calls = 0
+    def __call__(self, **kwargs):
+        self.calls += 1
+        return self.function(**kwargs)
+
+class TestRewriter(unittest.TestCase):
+    def setUp(self):
+        self.add_zero = Counted(lambda x: x)
+        self.fold = Counted(lambda x, y: x + y)
+        self.rules = [
+            ('Add(0, x) | Add(x, 0)', self.add_zero),
+            ('Mul(1, x) | Mul(x, 1)', lambda x: x),
+            ('Add(x:int, y:int)', self.fold),
+            ]
+
+    def test_strategies(self):
+        term = Add(Mul(Add('a', 0), Add(0, 1)), Add(Add(2, 3), 0))
+        for strategy in (BOTTOM_UP, TOP_DOWN):
+            rewriter = Rewriter(self.rules, strategy=strategy)
+            self.assertEquals(rewriter(term), Add('a', 5))
+        distribute = [('Mul(Add(a, b), c)',
+            lambda a, b, c: Add(Mul(a, c), Mul(b, c))),
+            ('Add(x, 0)', lambda x: x)]
+        term = Mul(Add('y', 0), 'z')
+        self.assertEquals(Rewriter(distribute)(term), Mul('y', 'z'))
+        self.assertEquals(Rewriter(distribute, strategy=TOP_DOWN)(term),
+                Add(Mul('y', 'z'), Mul(0, 'z')))
+        self.assertRaises(ValueError, Rewriter, strategy='sideways')
+
+    def test_distinct_subterms_rewritten_once(self):
+        rewriter = Rewriter(self.rules)
+        terms = [Add(Add('a', 0), Add(1, 2)) for i in range(100)]
+        self.assertEquals(rewriter(terms), [Add('a', 3)] * 100)
+        self.assertEquals((self.add_zero.calls, self.fold.calls), (1, 1))
+        # the memo table is kept across calls, until the rules change
+        self.assertEquals(rewriter(Add(Add('a', 0), 0)), 'a')
+        self.assertEquals(self.add_zero.calls, 1)
+        rewriter.register('_:str', lambda: 'b')
+        self.assertEquals(rewriter(Add(Add('a', 0), 0)), 'b')
+        self.assertEquals(self.add_zero.calls, 2)
+
+    def test_cycles(self):
+        commute = [('Add(x, y)', lambda x, y: Add(y, x))]
+        for strategy in (BOTTOM_UP, TOP_DOWN):
+            result = Rewriter(commute, strategy=strategy)(Add(1, 2))
+            self.assertTrue(result in (Add(1, 2), Add(2, 1)))
+
+    def test_deep_terms(self):
+        term = 'a'
+        for i in range(10000):
+            term = Add(term, 0)
+        self.assertEquals(Rewriter(self.rules)(term), 'a')
+        self.assertEquals(Rewriter(self.rules, strategy=TOP_DOWN)(term), 'a')
+
+    def test_lists_and_unhashable_leaves(self):
+        rewriter = Rewriter(self.rules)
+        self.assertEquals(rewriter([Add({'k': 1}, 0), [Add(1, 1)]]),
+                [{'k': 1}, [2]])
+        self.assertEquals(rewriter([Add({'k': 1}, 0)]), [{'k': 1}])
+        self.assertEquals(self.add_zero.calls, 2)
+
+    def test_lists_not_shared_between_calls(self):
+        rewriter = Rewriter([('Add(x, 0)', lambda x: x),
+            ('Mul(x, 1)', lambda x: [x])])
+        first = rewriter((Add([1], 0), Mul('a', 1)))
+        first[0].append(2)
+        first[1].append('b')
+        self.assertEquals(rewriter((Add([1], 0), Mul('a', 1))),
+                ([1], ['a']))
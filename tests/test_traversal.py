@@ -0,0 +1,100 @@
+import unittest
+from collections import namedtuple
+from functools import reduce
+from operator import getitem
+
+import pyfpm
+from pyfpm import traversal
+from pyfpm.optimizer import optimize
+from pyfpm.parser import Parser
+from pyfpm.pattern import build as _, RegexPattern
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+Point = namedtuple('Point', 'x y')
+
+class Exploding(Mapping):
+    """A mapping that can't be looked into."""
+    def __getitem__(self, key):
+        raise AssertionError('looked into')
+    def __iter__(self):
+        raise AssertionError('looked into')
+    def __len__(self):
+        return 1
+
+TREE = {
+    'points': [Point(0, 1), Point(2, 3)],
+    'nested': {'deeper': [[Point(4, 5)], 'Point(6, 7)', b'xy']},
+    'numbers': (1, 2, 3),
+}
+
+class TestSearch(unittest.TestCase):
+    def test_search(self):
+        found = list(traversal.search('Point(x, y)', TREE))
+        self.assertEquals([(path, match.ctx) for (path, match) in found], [
+            (('points', 0), {'x': 0, 'y': 1}),
+            (('points', 1), {'x': 2, 'y': 3}),
+            (('nested', 'deeper', 0, 0), {'x': 4, 'y': 5}),
+            ])
+        for path, match in found:
+            self.assertEquals(reduce(getitem, path, TREE),
+                    Point(**match.ctx))
+
+    def test_package_functions(self):
+        self.assertEquals([path for (path, match)
+            in pyfpm.search('Point(0, _)', TREE)], [('points', 0)])
+        self.assertEquals([(path, position) for (path, position, match)
+            in pyfpm.findall(['Point(x, _) if x > 2', _(1)], TREE)],
+            [(('points', 0, 1), 1), (('nested', 'deeper', 0, 0), 0),
+                (('numbers', 0), 1)])
+
+    def test_root_and_conditions(self):
+        self.assertEquals([path for (path, match)
+            in traversal.search('x:int if x % 2', [1, [2, [3]]])],
+            [(0,), (1, 1, 0)])
+        self.assertEquals(list(traversal.search('_:str', 'abc')),
+                [((), _(str).match('abc'))])
+
+    def test_findall(self):
+        found = traversal.findall([_(int), _(_(), _()), '[x, y, z]'], TREE)
+        self.assertEquals([(path, position) for (path, position, match)
+            in found], [
+                (('points',), 1),
+                (('points', 0), 1),
+                (('points', 0, 0), 0),
+                (('points', 0, 1), 0),
+                (('points', 1), 1),
+                (('points', 1, 0), 0),
+                (('points', 1, 1), 0),
+                (('nested', 'deeper'), 2),
+                (('nested', 'deeper', 0, 0), 1),
+                (('nested', 'deeper', 0, 0, 0), 0),
+                (('nested', 'deeper', 0, 0, 1), 0),
+                (('nested', 'deeper', 2), 1),
+                (('numbers',), 2),
+                (('numbers', 0), 0),
+                (('numbers', 1), 0),
+                (('numbers', 2), 0),
+                ])
+
+    def test_lazy(self):
+        found = traversal.search(_(int), [1, Exploding()])
+        self.assertEquals(next(found)[0], (0,))
+        self.assertRaises(AssertionError, next, found)
+
+    def test_prerequisites(self):
+        # these patterns would raise on objects of the wrong type
+        self.assertEquals([path for (path, match) in traversal.search(
+            RegexPattern('P'), TREE)], [('nested', 'deeper', 1)])
+        self.assertEquals(len(list(traversal.search('[_, _]', TREE))), 5)
+        parse = Parser()
+        self.assertEquals(traversal._prerequisites(optimize(parse(
+            '[x, y]')))[2], (2, 2))
+        self.assertEquals(traversal._prerequisites(parse('x:int | _:str')),
+                ((int, str), (), None))
+        types, excluded, lengths = traversal._prerequisites(parse(
+            '[x] | [x, y]'))
+        self.assertEquals((types, excluded), (None, (Mapping,)))
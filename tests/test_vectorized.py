@@ -0,0 +1,161 @@
+import unittest
+
+from pyfpm.matcher import Matcher, NoMatch
+
+try:
+    import numpy as np
+    from pyfpm.vectorized import _as_mask, _Batch, _NotVectorizable
+except ImportError:
+    np = None
+
+def _per_row(m, columns):
+    positions = []
+    for row in zip(*[c.tolist() for c in columns]):
+        for position, (pattern, handler) in enumerate(m.bindings):
+            if pattern << row:
+                positions.append(position)
+                break
+        else:
+            positions.append(-1)
+    return positions
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestMatchColumns(unittest.TestCase):
+    def setUp(self):
+        self.columns = [
+            np.array([1, 2, 3, 4, 5, 6]),
+            np.array([0.5, 1.5, -1., 2., 0., 7.]),
+            np.array(['a', 'b', 'c', 'a', 'b', 'c']),
+            ]
+
+    def assertVectorized(self, m, vectorized=True):
+        batch = _Batch(self.columns)
+        for pattern, handler in m.bindings:
+            try:
+                batch.case(pattern)
+                self.assertTrue(vectorized, pattern)
+            except _NotVectorizable:
+                self.assertFalse(vectorized, pattern)
+
+    def assertSameAsPerRow(self, m):
+        self.assertEquals(m.match_columns(self.columns).tolist(),
+                _per_row(m, self.columns))
+
+    def test_constants_and_types(self):
+        m = Matcher([
+            ("[1 | 2, _, 'a']", lambda: None),
+            ("[_, _:int, _]", lambda: None),
+            ("[_, _:float, 'b']", lambda: None),
+            ("[5, x, y]", lambda x, y: None),
+            ])
+        self.assertVectorized(m)
+        self.assertSameAsPerRow(m)
+        self.assertEquals(m.match_columns(self.columns).tolist(),
+                [0, 2, -1, -1, 2, -1])
+
+    def test_guards(self):
+        m = Matcher([
+            ('[n, x, _] if 2 <= n <= 4 and not x < 0', lambda n, x: None),
+            ('[n, x, s] if s == "c" or x > n', lambda n, x, s: None),
+            ('_ if True', lambda: None),
+            ])
+        self.assertVectorized(m)
+        self.assertSameAsPerRow(m)
+        self.assertEquals(m.match_columns(self.columns).tolist(),
+                [2, 0, 1, 0, 2, 1])
+
+    def test_guards_with_calls(self):
+        self.columns = [np.array(['ab', 'abcdef', 'x', 'y']),
+                np.array([1, 2, 3, 4])]
+        m = Matcher([
+            ('[name:str, n] if len(name) > 3', lambda name: 'long'),
+            ('[name, n] if name.startswith("x")', lambda name: 'x'),
+            ('[name, n] if name[0] == "y"', lambda name: 'y'),
+            ('_', lambda: 'other'),
+            ])
+        batch = _Batch(self.columns)
+        for pattern, handler in m.bindings[:3]:
+            self.assertRaises(_NotVectorizable, batch.case, pattern)
+        self.assertSameAsPerRow(m)
+        self.assertEquals(m.match_columns(self.columns, dispatch=True),
+                ['other', 'long', 'x', 'y'])
+
+    def test_scalar_guards_on_columns(self):
+        batch = _Batch(self.columns)
+        m = Matcher([('[n, x, _] if (n > 0) is not None', lambda n: n),
+            ('[n, x, _] if bool(n.all())', lambda n: n)])
+        for pattern, handler in m.bindings:
+            self.assertRaises(_NotVectorizable, batch.case, pattern)
+        self.assertRaises(_NotVectorizable, _as_mask, np.bool_(True), 6,
+                False)
+
+    def test_repeated_names(self):
+        self.columns = [np.array([1, 2, 3]), np.array([1, 0, 3])]
+        m = Matcher([('[x, x]', lambda x: x)])
+        self.assertVectorized(m)
+        self.assertEquals(m.match_columns(self.columns).tolist(), [0, -1, 0])
+
+    def test_arity(self):
+        m = Matcher([('[a, b]', lambda a, b: None),
+            ('a :: b :: _', lambda a, b: None)])
+        self.assertVectorized(m)
+        self.assertEquals(m.match_columns(self.columns).tolist(), [1] * 6)
+
+    def test_fallback(self):
+        m = Matcher([
+            ('[n, _, s] if s in ("a", "b") and n > 3', lambda n, s: None),
+            ('[_, _, /c/]', lambda: None),
+            ('row', lambda row: None),
+            ])
+        self.assertVectorized(m, False)
+        self.assertSameAsPerRow(m)
+
+    def test_dispatch(self):
+        m = Matcher([
+            ("[n, _, 'a']", lambda n: n),
+            ("[_, _, /(b)/]", lambda: 'b'),
+            ('row', lambda row: row),
+            ])
+        self.assertEquals(m.match_columns(self.columns, dispatch=True),
+                [1, 'b', (3, -1.0, 'c'), 4, 'b', (6, 7.0, 'c')])
+
+    def test_dispatch_call_plans(self):
+        m = Matcher([
+            ("[n, x, _] if x > 0", lambda n: n),
+            ('row', lambda row: row[0]),
+            ])
+        self.assertEquals(m.match_columns(self.columns, dispatch=True)[:3],
+                [1, 2, 3])
+        m = Matcher([("[n, x, _] if x > 0", lambda extra, n: (extra, n)),
+            ('_', lambda extra: extra)], extra_args=1)
+        self.assertEquals(m.match_columns(self.columns, dispatch=True,
+            args=('e',))[:3], [('e', 1), ('e', 2), 'e'])
+        self.assertRaises(TypeError, m.match_columns, self.columns,
+                dispatch=True)
+
+    def test_dispatch_nomatch(self):
+        m = Matcher([('[1, _, _]', lambda: None)])
+        try:
+            m.match_columns(self.columns, dispatch=True)
+            self.fail('should fail with NoMatch')
+        except NoMatch:
+            pass
+
+    def test_structured_array(self):
+        records = np.array([(1, 2.5), (2, 0.)],
+                dtype=[('id', 'i8'), ('score', 'f8')])
+        m = Matcher([('[i, s] if s > 1', lambda i, s: i),
+            ('[i, _]', lambda i: -i)])
+        self.assertEquals(m.match_columns(records, dispatch=True), [1, -2])
+
+    def test_bad_columns(self):
+        m = Matcher([('_', lambda: None)])
+        for columns in ([], [np.array([1, 2]), np.array([1])]):
+            try:
+                m.match_columns(columns)
+                self.fail()
+            except ValueError:
+                pass
+
+if __name__ == '__main__':
+    unittest.main()